@@ -63,6 +63,7 @@ MIDDLEWARE = [
     
     #custom middleware
     'dash.middleware.LoginRequiredMiddleware',
+    'dash.middleware.PortfolioSyncMiddleware',
 ]
 
 ROOT_URLCONF = 'core.urls'
@@ -119,13 +120,110 @@ AUTH_PASSWORD_VALIDATORS = [
     },
 ]
 
-# Cache memory for chart data
-CACHES = {
-    "default": {
-        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
-        "LOCATION": "chart-data-cache",
+# Cache for chart data and the shared version counters (FX matrix, symbol
+# index, per-user data version). They are bumped by the worker processes
+# too, so the default is the database cache shared by every process
+# (`manage.py createcachetable`, run by entrypoint.sh). CACHE_URL can point
+# it at redis://host:6379/0 (needs `redis`), memcached://host:11211 (needs
+# `pymemcache`), another db://table, or locmem:// (per process: only for a
+# single process without workers, chart cache kept 1 minute).
+CACHE_URL = urlparse(os.getenv("CACHE_URL") or "db://dash_cache")
+if CACHE_URL.scheme in ("redis", "rediss"):
+    CACHES = {"default": {"BACKEND": "django.core.cache.backends.redis.RedisCache",
+                          "LOCATION": CACHE_URL.geturl()}}
+elif CACHE_URL.scheme == "memcached":
+    CACHES = {"default": {"BACKEND": "django.core.cache.backends.memcached.PyMemcacheCache",
+                          "LOCATION": CACHE_URL.netloc}}
+elif CACHE_URL.scheme == "locmem":
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            "LOCATION": "chart-data-cache",
+        }
     }
+else:
+    # MAX_ENTRIES mặc định (300) bị cull ngay với chart cache 7 ngày:
+    # ~ số user × vài chart (interval / fx) × số version trong 7 ngày
+    CACHES = {"default": {"BACKEND": "django.core.cache.backends.db.DatabaseCache",
+                          "LOCATION": CACHE_URL.netloc or "dash_cache",
+                          "OPTIONS": {"MAX_ENTRIES": int(os.getenv("CACHE_MAX_ENTRIES", "100000"))}}}
+# Chart data is cached under the user's data version (bumped by every write
+# that changes it), so it can live long in a shared cache
+CHART_CACHE_TIMEOUT = int(os.getenv(
+    "CHART_CACHE_TIMEOUT", str(60 if CACHE_URL.scheme == "locmem" else 7 * 24 * 3600)
+))
+
+# AccountBalance storage: 'daily' keeps one row per account per day,
+# 'changes' only keeps the days where balance / fee / tax / principal /
+# float change (expanded back to a daily series by utils_iter_balances)
+ACCOUNT_BALANCE_STORAGE = os.getenv("ACCOUNT_BALANCE_STORAGE", "daily")
+
+# Price providers (dash/providers.py): base URLs (point them at a local fake
+# server in tests), parallel requests per provider and the overall deadline
+# of one refresh. Providers not listed use their own rate-limit defaults.
+PRICE_API_URLS = {
+    "eodhd": os.getenv("EODHD_BASE_URL", "https://eodhd.com/api"),
+    "yahoo": os.getenv("YAHOO_BASE_URL", "https://query1.finance.yahoo.com"),
+    "finnhub": os.getenv("FINNHUB_BASE_URL", "https://finnhub.io/api/v1"),
+    "alpha_vantage": os.getenv("ALPHA_VANTAGE_BASE_URL", "https://www.alphavantage.co"),
 }
+PRICE_FETCH_CONCURRENCY = {
+    "eodhd": int(os.getenv("EODHD_CONCURRENCY", "4")),
+    "yahoo": int(os.getenv("YAHOO_CONCURRENCY", "8")),
+}
+PRICE_REFRESH_DEADLINE = float(os.getenv("PRICE_REFRESH_DEADLINE", "20"))
+# Instruments less than PRICE_BATCH_MAX_GAP_DAYS behind are refreshed with
+# multi-symbol requests (EODHD bulk last day, Yahoo spark) of this many symbols
+PRICE_BATCH_SIZE = {"eodhd": 500, "yahoo": 20}
+PRICE_BATCH_MAX_GAP_DAYS = 5
+# Provider scheduler (dash/scheduler.py): retries of 429 / 5xx / network
+# errors with exponential backoff + jitter, circuit breaker per API key
+PRICE_RETRY_ATTEMPTS = int(os.getenv("PRICE_RETRY_ATTEMPTS", "3"))
+PRICE_RETRY_BACKOFF = 0.5       # giây, nhân đôi mỗi lần thử lại
+PRICE_RETRY_BACKOFF_MAX = 8.0
+PRICE_BREAKER_THRESHOLD = 5     # số lần gọi lỗi liên tiếp trước khi ngắt
+PRICE_BREAKER_COOLDOWN = 60     # giây trước khi cho 1 request thử lại
+# Rate limits are kept per process: each process calling providers gets
+# 1/PRICE_RATE_PROCESSES of them. Default 3 = web + worker + prices of
+# docker-compose; add one per extra `run_workers --processes` process
+PRICE_RATE_PROCESSES = max(1, int(os.getenv("PRICE_RATE_PROCESSES", "3")))
+# 'replay' answers provider requests from the JSON fixtures in
+# PRICE_PROVIDER_FIXTURES (no network), 'record' saves real responses there
+PRICE_PROVIDER_REPLAY = os.getenv("PRICE_PROVIDER_REPLAY") or None
+PRICE_PROVIDER_FIXTURES = os.getenv("PRICE_PROVIDER_FIXTURES", str(BASE_DIR / "dash" / "testdata" / "providers"))
+# Scheduled refresh (`manage.py refresh_prices`, dash/markets.py): an
+# instrument is stale when it lacks the bar of the last session closed
+# PRICE_REFRESH_AFTER_CLOSE minutes ago on its exchange; a stale instrument
+# is not re-fetched within PRICE_STALE_TTL seconds of the previous attempt
+PRICE_MARKET_CLOSE = {
+    **dict.fromkeys(["US", "NMS", "NYQ", "NGM", "NCM", "ASE", "PCX", "BTS", "NASDAQ", "NYSE"],
+                    ("America/New_York", "16:00")),
+    **dict.fromkeys(["TO", "V", "NEO"], ("America/Toronto", "16:00")),
+    **dict.fromkeys(["LSE", "L", "LON"], ("Europe/London", "16:30")),
+    **dict.fromkeys(["XETRA", "GER", "DE", "F"], ("Europe/Berlin", "17:30")),
+    **dict.fromkeys(["PA", "PAR", "AS", "AMS", "BR", "MC"], ("Europe/Paris", "17:30")),
+    **dict.fromkeys(["T", "TYO", "JPX"], ("Asia/Tokyo", "15:30")),
+    **dict.fromkeys(["HK", "HKG"], ("Asia/Hong_Kong", "16:00")),
+    **dict.fromkeys(["VN", "HOSE", "HNX", "UPCOM"], ("Asia/Ho_Chi_Minh", "15:00")),
+    **dict.fromkeys(["AU", "ASX"], ("Australia/Sydney", "16:00")),
+}
+PRICE_MARKET_CLOSE_DEFAULT = ("UTC", "22:00")  # FX & sàn chưa khai báo
+PRICE_REFRESH_AFTER_CLOSE = int(os.getenv("PRICE_REFRESH_AFTER_CLOSE", "30"))
+PRICE_STALE_TTL = int(os.getenv("PRICE_STALE_TTL", "3600"))
+# Security search (dash/search.py): providers queried concurrently, overall
+# deadline of the response in seconds, LRU of results per (provider, query)
+SECURITY_SEARCH_PROVIDERS = ["yahoo", "eodhd"]
+SECURITY_SEARCH_DEADLINE = float(os.getenv("SECURITY_SEARCH_DEADLINE", "3"))
+SECURITY_SEARCH_TIMEOUT = 5  # request của một provider (chạy tiếp sau deadline để lấp cache)
+SECURITY_SEARCH_CACHE_SIZE = 512
+SECURITY_SEARCH_CACHE_TTL = 600
+# Local symbol index (autocomplete): providers are only asked when it has
+# fewer hits than SYMBOL_INDEX_MIN_HITS; a fuzzy match needs this share of the
+# query's trigrams in its code / name / ISIN
+SYMBOL_INDEX_MIN_HITS = 3
+SYMBOL_INDEX_MIN_SIMILARITY = 0.5
+# Symbols remembered by other processes are added to the index this often (seconds)
+SYMBOL_INDEX_REFRESH = int(os.getenv("SYMBOL_INDEX_REFRESH", "60"))
 
 # Internationalization
 # https://docs.djangoproject.com/en/3.2/topics/i18n/
@@ -5,7 +5,9 @@ from .models import (Indicator,
                      Transaction,
                      AccountBalance, 
                      Security, 
-                     SecurityPrice, 
+                     Instrument,
+                     InstrumentPrice, 
+                     Symbol,
                      TradeExit, 
                      TradeEntry, 
                      PortfolioPerformance, 
@@ -13,7 +15,8 @@ from .models import (Indicator,
                      Currency,
                      Country,
                      UserPreference,
-                     UserAPIKey)
+                     UserAPIKey,
+                     RecalcJob)
 # Register your models here.
 
 @admin.register(Indicator)
@@ -51,16 +54,28 @@ class AccountBalanceAdmin(admin.ModelAdmin):
 
 @admin.register(Security)
 class SecurityAdmin(admin.ModelAdmin):
-    list_display = ('code', 'name', 'exchange', 'user')
+    list_display = ('code', 'name', 'exchange', 'user', 'instrument')
     search_fields = ('code', 'name', 'exchange')
     list_filter = ('exchange', 'api_source')
     ordering = ('-code',)
 
-@admin.register(SecurityPrice)
-class SecurityPriceAdmin(admin.ModelAdmin):
-    list_display = ('security', 'date', 'close', 'volume')
-    list_filter = ('security', 'date')
-    search_fields = ('security__code',)
+@admin.register(Instrument)
+class InstrumentAdmin(admin.ModelAdmin):
+    list_display = ('code', 'exchange', 'api_source')
+    list_filter = ('api_source', 'exchange')
+    search_fields = ('code',)
+
+@admin.register(InstrumentPrice)
+class InstrumentPriceAdmin(admin.ModelAdmin):
+    list_display = ('instrument', 'date', 'close', 'volume')
+    list_filter = ('date',)
+    search_fields = ('instrument__code',)
+
+@admin.register(Symbol)
+class SymbolAdmin(admin.ModelAdmin):
+    list_display = ('code', 'exchange', 'name', 'api_source', 'updated_at')
+    list_filter = ('api_source', 'exchange')
+    search_fields = ('code', 'name', 'isin')
 
 class TradeExitInline(admin.TabularInline):
     model = TradeExit
@@ -111,4 +126,11 @@ class UserPreferenceAdmin(admin.ModelAdmin):
 @admin.register(UserAPIKey)
 class UserAPIKeyAdmin(admin.ModelAdmin):
     list_display = ('user', 'key_eodhd', 'key_finhub', 'key_alpha_vantage', 'key_yahoo')
-    search_fields = ('user__username',)
\ No newline at end of file
+    search_fields = ('user__username',)
+
+
+@admin.register(RecalcJob)
+class RecalcJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'kind', 'user', 'account', 'security', 'start_date', 'status', 'progress', 'rows', 'updated_at')
+    list_filter = ('status', 'kind')
+    search_fields = ('user__username',)
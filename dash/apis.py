@@ -1,17 +1,35 @@
+import copy
+from datetime import date, timedelta
 from decimal import Decimal
-import requests
 import json
-from collections import defaultdict, OrderedDict
+from array import array
+from django.conf import settings
 from django.core.cache import cache
+from django.db.models import Sum
 
-from django.http import HttpResponseNotAllowed, JsonResponse
+from django.http import HttpResponseNotAllowed, JsonResponse, StreamingHttpResponse
 from django.views.decorators.http import require_POST, require_http_methods
 
 from django.shortcuts import get_object_or_404
 
-from .models import Account, Transaction, Security, Country, TradeEntry, TradeExit, PortfolioPerformance, UserAPIKey, UserPreference, DailyHoldingEquity
+from .models import Account, Transaction, Security, Country, TradeEntry, TradeExit, PortfolioPerformance, UserPreference, DailyHoldingEquity, RecalcJob
 from .forms import AccountForm, TransactionForm, EntryForm, ExitForm
-from .utils import utils_update_account, utils_update_security_prices_for_user, utils_convert_currency, utils_recalc_daily_holdings
+from .utils import utils_sync_ledger_change, utils_lock_accounts, utils_ledger_touches_float, utils_refresh_instruments, utils_chart_cache_key, utils_is_fx_symbol, CHART_INTERVALS, utils_filter_dates, utils_period_ends, utils_downsample, utils_chart_changes, utils_period_start, utils_pivot_holdings
+from .series import FxRateMatrix
+from .jobs import enqueue_recalc, job_status
+from .providers import provider_keys
+from .search import autocomplete, remember_symbols, search_securities
+
+
+def _queue_replay(user, jobs):
+    """`replay` for utils_sync_ledger_change: queue the account replay instead of running it here."""
+    def replay(account, start_date):
+        jobs.append(enqueue_recalc("account", user, start_date, account=account).id)
+    return replay
+
+
+def _queue_holdings(user, jobs, security, start_date):
+    jobs.append(enqueue_recalc("holdings", user, start_date, security=security).id)
 
 
 
@@ -26,9 +44,11 @@ def api_transaction_create(request):
     if form.is_valid():
         transaction = form.save(commit=False)
         transaction.user = request.user
-        transaction.save()
-        utils_update_account(transaction.account, transaction.date)
-        return JsonResponse({'success': True, 'id': transaction.id})
+        jobs = []
+        with utils_lock_accounts(transaction):
+            transaction.save()
+            utils_sync_ledger_change(None, transaction, replay=_queue_replay(request.user, jobs))
+        return JsonResponse({'success': True, 'id': transaction.id, 'jobs': jobs})
     else:
         return JsonResponse({'success': False, 'errors': form.errors}, status=400)
 
@@ -47,29 +67,30 @@ def api_transaction_update(request, id):
         except json.JSONDecodeError:
             return JsonResponse({'success': False, 'errors': 'Invalid JSON'}, status=400)
 
-        old_date = transaction.date  # lấy ngày trước khi update
+        old = copy.copy(transaction)  # snapshot trước khi form ghi đè instance
 
         form = TransactionForm(data, instance=transaction, user=request.user)
         if form.is_valid():
-            updated_transaction = form.save()
-            min_date = min(old_date, updated_transaction.date)
-            utils_update_account(updated_transaction.account, min_date)
+            jobs = []
+            with utils_lock_accounts(old, form.instance):
+                updated_transaction = form.save()
+                utils_sync_ledger_change(old, updated_transaction, replay=_queue_replay(request.user, jobs))
             # Debug output
             print("=== Transaction Update Debug ===")
-            print("Old date:", old_date)
+            print("Old date:", old.date)
             print("New date:", updated_transaction.date)
-            print("Max date used:", min_date)
             print("Account ID:", updated_transaction.account.id)
             print("Account Name:", updated_transaction.account.name)  # assuming there's a name field
             print("================================")
-            return JsonResponse({'success': True, 'id': transaction.id})
+            return JsonResponse({'success': True, 'id': transaction.id, 'jobs': jobs})
 
     elif request.method == "DELETE":
-        recalc_date = transaction.date
-        account = transaction.account
-        transaction.delete()
-        utils_update_account(account, recalc_date)
-        return JsonResponse({'success': True})
+        old = copy.copy(transaction)
+        jobs = []
+        with utils_lock_accounts(old):
+            transaction.delete()
+            utils_sync_ledger_change(old, None, replay=_queue_replay(request.user, jobs))
+        return JsonResponse({'success': True, 'jobs': jobs})
 
     else:
         return HttpResponseNotAllowed(['PUT', 'PATCH', 'DELETE'])
@@ -124,38 +145,33 @@ def api_security_search(request):
     q = request.GET.get('q', '')
     if not q:
         return JsonResponse({'error': 'Missing query'}, status=400)
-    
-    yahoo_results = []
-    eodhd_results = []
 
-    # Yahoo
-    try:
-        yahoo_url = 'https://query1.finance.yahoo.com/v1/finance/search'
-        yahoo_headers = {'User-Agent': 'Mozilla/5.0'}
-        yahoo_resp = requests.get(yahoo_url, params={'q': q}, headers=yahoo_headers, timeout=5, verify=False)
-        if yahoo_resp.ok != 200:
-            print(f"Yahoo respond OK")
-            yahoo_data = yahoo_resp.json()
-            yahoo_results = yahoo_data.get('quotes', [])
-    except Exception as e:
-        print('Yahoo API error:', e)
-
-    print(f"Yahoo results: {len(yahoo_results)}")
-    # EODHD
+    # Các provider chạy song song, chung một deadline; provider chậm → bỏ qua lần này
+    results, timed_out = search_securities(q, keys=provider_keys(request.user))
+    remember_symbols(results)
+    for name, items in results.items():
+        print(f"{name} results: {len(items)}")
+    if timed_out:
+        print(f"Search '{q}' timed out for {', '.join(timed_out)}")
+    return JsonResponse({'results': results, 'timeout': timed_out})
+
+
+@require_http_methods(["GET"])
+def api_security_autocomplete(request):
+    """
+    Autocomplete from the local symbol index (Security + remembered search
+    results); the providers are only asked when it finds too few hits.
+    """
+    q = request.GET.get('q', '').strip()
+    if not q:
+        return JsonResponse({'results': [], 'source': 'local', 'timeout': []})
     try:
-        user_api, _ = UserAPIKey.objects.get_or_create(user=request.user)
-        eodhd_key = user_api.key_eodhd
-        if eodhd_key:
-            eodhd_url = f'https://eodhd.com/api/search/{q}'
-            eodhd_params = {'api_token': eodhd_key, 'limit': 20, 'fmt': 'json'}
-            eodhd_resp = requests.get(eodhd_url, params=eodhd_params, timeout=5, verify=False)
-            if eodhd_resp.ok:
-                print(f"EODHD respond OK")
-                eodhd_results = eodhd_resp.json()
-    except Exception as e:
-        print('EODHD API error:', e)
-    print(f"EODHD results: {len(eodhd_results)}")
-    return JsonResponse({'yahoo': yahoo_results, 'eodhd': eodhd_results})
+        limit = min(max(int(request.GET.get('limit', 10)), 1), 50)
+    except ValueError:
+        return JsonResponse({'error': 'Invalid limit'}, status=400)
+
+    results, source, timed_out = autocomplete(q, keys=provider_keys(request.user), limit=limit)
+    return JsonResponse({'results': results, 'source': source, 'timeout': timed_out})
 
 
 def api_security_add(request):
@@ -181,7 +197,9 @@ def api_security_add(request):
         }
     )
 
-    utils_update_security_prices_for_user(request.user)
+    # Chỉ mã vừa thêm; các mã khác do `refresh_prices` lo
+    if security.instrument:
+        utils_refresh_instruments([security.instrument], keys=provider_keys(request.user), label=request.user.username)
     return JsonResponse({'status': 'ok' if created else 'exists'})
 
 @require_http_methods(["DELETE"])
@@ -194,6 +212,8 @@ def api_security_update(request, id):
     
     if request.method == "DELETE":
         securitiy.delete()
+        if utils_is_fx_symbol(securitiy.code):
+            FxRateMatrix.invalidate()
         return JsonResponse({'success': True})
 
     else:
@@ -210,11 +230,14 @@ def api_entry_add(request):
     form = EntryForm(data)
     if form.is_valid():
         entry = form.save(commit=False)
-        entry.save()
-
-        utils_update_account(entry.account, entry.date)
-        utils_recalc_daily_holdings(user=request.user,security= entry.security,from_date= entry.date)
-        return JsonResponse({'status': 'ok'})
+        entry.user = request.user
+
+        jobs = []
+        with utils_lock_accounts(entry):
+            entry.save()
+            utils_sync_ledger_change(None, entry, replay=_queue_replay(request.user, jobs))
+        _queue_holdings(request.user, jobs, entry.security, entry.date)
+        return JsonResponse({'status': 'ok', 'jobs': jobs})
     else:
         print('Form errors:', form.errors.as_json())
 
@@ -233,45 +256,121 @@ def api_entry_update(request, id):
         except json.JSONDecodeError:
             return JsonResponse({'success': False, 'errors': 'Invalid JSON'}, status=400)
 
-        old_date = entry.date  # lấy ngày cũ trước khi save
+        old = copy.copy(entry)  # snapshot trước khi form ghi đè instance
 
         form = EntryForm(data, instance=entry)
         if form.is_valid():
-            updated_entry = form.save()
-            min_date = min(old_date, updated_entry.date)
-            utils_update_account(updated_entry.account, min_date)
-            utils_recalc_daily_holdings(user=request.user,security= entry.security,from_date= min_date)
-            return JsonResponse({'success': True, 'id': entry.id})
+            jobs = []
+            with utils_lock_accounts(old, form.instance):
+                updated_entry = form.save()
+                utils_sync_ledger_change(old, updated_entry, replay=_queue_replay(request.user, jobs))
+            min_date = min(old.date, updated_entry.date)
+            if utils_ledger_touches_float(old, updated_entry):
+                _queue_holdings(request.user, jobs, updated_entry.security, min_date)
+                if old.security_id != updated_entry.security_id:
+                    _queue_holdings(request.user, jobs, old.security, old.date)
+            return JsonResponse({'success': True, 'id': entry.id, 'jobs': jobs})
         return JsonResponse({'success': False, 'errors': form.errors}, status=400)
 
     elif request.method == "DELETE":
-        entry.delete()
-        utils_update_account(entry.account, entry.date)
-        utils_recalc_daily_holdings(user=request.user,security= entry.security,from_date= entry.date)
-        return JsonResponse({'success': True})
+        old = copy.copy(entry)
+        jobs = []
+        with utils_lock_accounts(old):
+            entry.delete()
+            utils_sync_ledger_change(old, None, replay=_queue_replay(request.user, jobs))
+        _queue_holdings(request.user, jobs, old.security, old.date)
+        return JsonResponse({'success': True, 'jobs': jobs})
 
     else:
         return HttpResponseNotAllowed(['PUT', 'PATCH', 'DELETE'])
 
 
+def _chart_params(request):
+    """
+    `from` / `to` (YYYY-MM-DD, optional), `interval` (day / week / month)
+    and `max_points` (optional, ≥ 3) of a chart request.
+    """
+    interval = request.GET.get('interval', 'day')
+    if interval not in CHART_INTERVALS:
+        raise ValueError(f"interval must be one of {', '.join(CHART_INTERVALS)}")
+    start, end = (request.GET.get(name) for name in ('from', 'to'))
+    start = date.fromisoformat(start) if start else None
+    end = date.fromisoformat(end) if end else None
+    max_points = int(request.GET['max_points']) if request.GET.get('max_points') else None
+    if max_points is not None and max_points < 3:
+        raise ValueError("max_points must be at least 3")
+    return start, end, interval, max_points
+
+
+def _chart_delta(request, user_id, start, interval, fx):
+    """
+    Incremental fetch: `since` (last label the client holds) and `version`
+    (token of its copy) → (current token, start of the points to send).
+    The start is None when the client must replace its whole series; it is
+    aligned on the period start so a client drops its labels from there on.
+    Without `version`, history is assumed unchanged (only appended points).
+    """
+    since = request.GET.get('since')
+    version, delta_from = utils_chart_changes(user_id, request.GET.get('version'), fx=fx)
+    if not since:
+        return version, None
+    since = date.fromisoformat(since)
+    if 'version' in request.GET:
+        changed = delta_from
+        if changed is None:
+            return version, None
+        delta_from = min(changed, since + timedelta(days=1))
+    else:
+        delta_from = since + timedelta(days=1)
+    delta_from = utils_period_start(delta_from, interval)
+    if start and delta_from <= start:
+        return version, None
+    return version, delta_from
+
+
 def api_portfolio_chart(request):
     user = request.user
-    cache_key = f"portfolio_chart_{user.id}"
+    try:
+        start, end, interval, max_points = _chart_params(request)
+        # PortfolioPerformance đã quy đổi sẵn → không phụ thuộc version FX
+        version, delta_from = _chart_delta(request, user.id, start, interval, fx=False)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    cache_key = utils_chart_cache_key(
+        f"portfolio_chart_{start}_{end}_{interval}_{max_points}_{delta_from}", user.id, fx=False
+    )
     cached_data = cache.get(cache_key)
     if cached_data:
         return JsonResponse(cached_data)
 
-    perf_qs = PortfolioPerformance.objects.filter(user=user).order_by("date")
-    dates = [p.date for p in perf_qs]
+    perf_qs = utils_filter_dates(PortfolioPerformance.objects.filter(user=user), delta_from or start, end)
+    if interval == 'day':
+        perf = list(perf_qs.order_by("date"))
+        transactions = [float(p.transaction) for p in perf]
+    else:
+        # Giá trị cuối kỳ cho equity / principal, tổng cả kỳ cho transaction
+        periods = utils_period_ends(perf_qs, interval, transaction=Sum('transaction'))
+        perf = list(perf_qs.filter(date__in=list(periods)).order_by("date"))
+        transactions = [float(periods[p.date]['transaction']) for p in perf]
+
+    if max_points and len(perf) > max_points:
+        # Giữ dáng đường equity (LTTB); transaction dồn vào điểm được giữ kế tiếp
+        keep = utils_downsample([p.date.toordinal() for p in perf], [float(p.equity) for p in perf], max_points)
+        transactions = [sum(transactions[prev + 1:i + 1]) for prev, i in zip([-1] + keep, keep)]
+        perf = [perf[i] for i in keep]
 
     chart_data = {
-        "labels": [d.strftime('%Y-%m-%d') for d in dates],
-        "principal": [float(p.principal) for p in perf_qs],
-        "equity": [float(p.equity) for p in perf_qs],
-        "transactions": [float(p.transaction) for p in perf_qs],
+        "labels": [p.date.strftime('%Y-%m-%d') for p in perf],
+        "principal": [float(p.principal) for p in perf],
+        "equity": [float(p.equity) for p in perf],
+        "transactions": transactions,
+        "interval": interval,
+        "version": version,
+        "delta_from": delta_from and delta_from.isoformat(),
     }
 
-    cache.set(cache_key, chart_data, timeout=600)  # Cache data in 10 minutes
+    cache.set(cache_key, chart_data, timeout=settings.CHART_CACHE_TIMEOUT)
     return JsonResponse(chart_data)
 
 @require_http_methods(["POST", "PUT"])
@@ -291,11 +390,14 @@ def api_exit_add(request):
         if exit.entry.account.user != request.user: # Assuming TradeEntry has a 'user' ForeignKey
             return JsonResponse({'success': False, 'errors': 'Not authorized'}, status=403) # Forbidden
 
-        exit.save()
+        exit.user = request.user
        
-        utils_update_account(exit.entry.account, exit.date)
-        utils_recalc_daily_holdings(user=request.user,security= exit.security,from_date= exit.date)
-        return JsonResponse({'status': 'ok'})
+        jobs = []
+        with utils_lock_accounts(exit):
+            exit.save()
+            utils_sync_ledger_change(None, exit, replay=_queue_replay(request.user, jobs))
+        _queue_holdings(request.user, jobs, exit.entry.security, exit.date)
+        return JsonResponse({'status': 'ok', 'jobs': jobs})
     else:
         print('Form errors:', form.errors.as_json())
 
@@ -315,61 +417,94 @@ def api_exit_update(request, id):
         except json.JSONDecodeError:
             return JsonResponse({'success': False, 'errors': 'Invalid JSON'}, status=400)
 
-        old_date = exit.date  # lấy ngày cũ trước khi save
+        old = copy.copy(exit)  # snapshot trước khi form ghi đè instance
+        old_security = exit.entry.security  # form có thể chuyển exit sang entry khác
 
         form = ExitForm(data, instance=exit)
         if form.is_valid():
-            updated_exit = form.save()
-            min_date = min(old_date, updated_exit.date)
-            utils_update_account(updated_exit.account, min_date)
-            utils_recalc_daily_holdings(user=request.user,security= exit.security,from_date= min_date)
-            return JsonResponse({'success': True, 'id': exit.id})
+            jobs = []
+            with utils_lock_accounts(old, form.instance):
+                updated_exit = form.save()
+                utils_sync_ledger_change(old, updated_exit, replay=_queue_replay(request.user, jobs))
+            min_date = min(old.date, updated_exit.date)
+            if utils_ledger_touches_float(old, updated_exit):
+                _queue_holdings(request.user, jobs, exit.entry.security, min_date)
+                if old_security.pk != exit.entry.security_id:
+                    _queue_holdings(request.user, jobs, old_security, min_date)
+            return JsonResponse({'success': True, 'id': exit.id, 'jobs': jobs})
         return JsonResponse({'success': False, 'errors': form.errors}, status=400)
 
     elif request.method == "DELETE":
-        exit.delete()
-        utils_update_account(exit.entry.account, exit.date)
-        utils_recalc_daily_holdings(user=request.user,security= exit.security,from_date= exit.date)
-        return JsonResponse({'success': True})
+        old = copy.copy(exit)
+        jobs = []
+        with utils_lock_accounts(old):
+            exit.delete()
+            utils_sync_ledger_change(old, None, replay=_queue_replay(request.user, jobs))
+        _queue_holdings(request.user, jobs, old.entry.security, old.date)
+        return JsonResponse({'success': True, 'jobs': jobs})
 
     else:
         return HttpResponseNotAllowed(['PUT', 'PATCH', 'DELETE'])
 
-def api_holdings_data(request):
-    user = request.user
-    cache_key = f"holdings_data_{user.id}"
-    cached_data = cache.get(cache_key)
-    if cached_data:
-        return JsonResponse(cached_data)
 
-    target_currency = UserPreference.objects.get(user=user).currency.code
-    records = DailyHoldingEquity.objects.filter(user=user).order_by("date")
+@require_http_methods(["GET"])
+def api_job_status(request, id):
+    job = get_object_or_404(RecalcJob, id=id, user=request.user)
+    return JsonResponse(job_status(job))
 
-    if not records.exists():
-        return JsonResponse([], safe=False)
+def _stream_chart(chart_data):
+    """
+    JSON of a holdings chart written one dataset at a time: the float
+    columns are never turned into one big list / string.
+    """
+    def chunks():
+        yield '{"labels": %s, "datasets": {' % json.dumps(chart_data["labels"])
+        for i, (code, values) in enumerate(chart_data["datasets"].items()):
+            yield "%s%s: [%s]" % ("," if i else "", json.dumps(code), ",".join(map(repr, values)))
+        extra = {key: value for key, value in chart_data.items() if key not in ("labels", "datasets")}
+        yield "}, %s" % json.dumps(extra)[1:]
 
-    date_list = sorted(set(r.date.strftime("%Y-%m-%d") for r in records))
-    result = defaultdict(lambda: OrderedDict())
+    return StreamingHttpResponse(chunks(), content_type="application/json")
 
-    for r in records:
-        equity = r.equity
-        if r.currency != target_currency:
-            equity *= utils_convert_currency(r.currency, target_currency, r.date)
 
-        date_str = r.date.strftime("%Y-%m-%d")
-        result[r.security.code][date_str] = float(equity)
+def api_holdings_data(request):
+    user = request.user
+    try:
+        start, end, interval, max_points = _chart_params(request)
+        version, delta_from = _chart_delta(request, user.id, start, interval, fx=True)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
 
-    datasets = {
-        code: [data.get(date, 0) for date in date_list]
-        for code, data in result.items()
-    }
+    cache_key = utils_chart_cache_key(f"holdings_data_{start}_{end}_{interval}_{max_points}_{delta_from}", user.id)
+    cached_data = cache.get(cache_key)
+    if cached_data:
+        return _stream_chart(cached_data)
+
+    target_currency = UserPreference.objects.get(user=user).currency.code
+    records = utils_filter_dates(DailyHoldingEquity.objects.filter(user=user), delta_from or start, end)
+    if interval != 'day':
+        # Snapshot ngày cuối của mỗi kỳ
+        records = records.filter(date__in=list(utils_period_ends(records, interval)))
+    # Một query, mã chứng khoán join sẵn; chỉ giữ các cột, không tạo object ORM
+    rows = records.order_by("date").values_list("date", "security__code", "currency", "equity")
+    labels, datasets = utils_pivot_holdings(rows.iterator(chunk_size=2000), target_currency, FxRateMatrix.current())
+
+    if max_points and len(labels) > max_points:
+        # Chọn ngày theo dáng của tổng equity, áp dụng cho mọi mã
+        totals = [sum(values) for values in zip(*datasets.values())] if datasets else [0.0] * len(labels)
+        keep = utils_downsample([day.toordinal() for day in labels], totals, max_points)
+        labels = [labels[i] for i in keep]
+        datasets = {code: array('d', (values[i] for i in keep)) for code, values in datasets.items()}
 
     chart_data = {
-        "labels": date_list,
-        "datasets": datasets
+        "labels": [day.isoformat() for day in labels],
+        "datasets": datasets,
+        "interval": interval,
+        "version": version,
+        "delta_from": delta_from and delta_from.isoformat(),
     }
 
-    # Cache for 30 minutes (1800) — tweak as needed
-    cache.set(cache_key, chart_data, timeout=1800)
+    # Key đổi theo version dữ liệu → cache lâu được
+    cache.set(cache_key, chart_data, timeout=settings.CHART_CACHE_TIMEOUT)
 
-    return JsonResponse(chart_data)
+    return _stream_chart(chart_data)
@@ -0,0 +1,129 @@
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+
+from .models import RecalcJob
+from .utils import (
+    utils_defer_portfolio_sync,
+    utils_recalc_daily_holdings,
+    utils_refresh_stale_prices,
+    utils_update_account,
+    utils_user_instruments,
+)
+
+
+def enqueue_recalc(kind, user, start_date, account=None, security=None):
+    """
+    Queue a recalculation and return its RecalcJob. A pending job for the
+    same account / (user, security) absorbs the request: it is kept and its
+    start date moved back to the earliest one.
+    """
+    with transaction.atomic():
+        job = (
+            RecalcJob.objects.select_for_update()
+            .filter(kind=kind, user=user, account=account, security=security, status="pending")
+            .first()
+        )
+        if job:
+            if start_date < job.start_date:
+                job.start_date = start_date
+                job.save(update_fields=["start_date", "updated_at"])
+            return job
+
+        return RecalcJob.objects.create(
+            kind=kind, user=user, account=account, security=security, start_date=start_date
+        )
+
+
+def claim_next_job():
+    """
+    Mark the oldest runnable pending job as running and return it (None if
+    the queue is empty). Jobs whose target is already being recalculated by
+    another worker wait for it to finish.
+    """
+    busy = RecalcJob.objects.filter(
+        Q(kind="account", account=OuterRef("account"))
+        | Q(kind="holdings", security=OuterRef("security"))
+        | Q(kind="prices"),
+        status="running",
+        kind=OuterRef("kind"),
+        user=OuterRef("user"),
+    )
+    with transaction.atomic():
+        job = (
+            RecalcJob.objects.select_for_update(skip_locked=True)
+            .filter(status="pending")
+            .exclude(Exists(busy))
+            .order_by("created_at", "id")
+            .first()
+        )
+        if job:
+            job.status = "running"
+            job.save(update_fields=["status", "updated_at"])
+    return job
+
+
+PROGRESS_STEP = 5  # % giữa 2 lần ghi progress
+
+
+def _progress_reporter(job):
+    """
+    `progress(done, total)` callback saving the job's percentage of days
+    computed, at most every PROGRESS_STEP % (100 is set once the rows are written).
+    """
+    def report(done, total):
+        percent = min(99, done * 100 // max(total, 1))
+        if percent >= job.progress + PROGRESS_STEP:
+            job.progress = percent
+            # updated_at mới → requeue_stale_jobs không coi là worker chết
+            RecalcJob.objects.filter(pk=job.pk).update(progress=percent, updated_at=timezone.now())
+    return report
+
+
+def run_job(job):
+    """Execute a claimed job and record its outcome."""
+    progress = _progress_reporter(job)
+    try:
+        if job.kind == "prices":
+            report = utils_refresh_stale_prices(utils_user_instruments(job.user), label=job.user.username)
+            job.rows = sum(row["bars"] for row in report)
+        else:
+            with utils_defer_portfolio_sync():
+                if job.kind == "account":
+                    job.rows = utils_update_account(job.account, job.start_date, progress=progress)
+                else:
+                    job.rows = utils_recalc_daily_holdings(job.user, job.security, job.start_date, progress=progress)
+        job.status = "done"
+        job.progress = 100
+    except Exception as exc:
+        job.status = "failed"
+        job.error = repr(exc)
+        print(f"[JOB] #{job.id} failed: {exc!r}")
+
+    job.save(update_fields=["status", "progress", "rows", "error", "updated_at"])
+    return job
+
+
+def requeue_stale_jobs(older_than=timedelta(minutes=30)):
+    """Put back jobs left running by a worker that died."""
+    return RecalcJob.objects.filter(
+        status="running", updated_at__lt=timezone.now() - older_than
+    ).update(status="pending", progress=0, updated_at=timezone.now())
+
+
+def job_status(job):
+    # Chỉ đếm job của cùng user xếp trước job này (không lộ độ dài hàng đợi chung)
+    ahead = RecalcJob.objects.filter(user_id=job.user_id, status="pending", created_at__lt=job.created_at).count() \
+        if job.status == "pending" else 0
+    return {
+        "id": job.id,
+        "kind": job.kind,
+        "status": job.status,
+        "progress": job.progress,
+        "start_date": job.start_date.isoformat(),
+        "rows": job.rows,
+        "error": job.error,
+        "ahead": ahead,
+    }
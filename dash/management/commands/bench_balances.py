@@ -0,0 +1,51 @@
+from time import perf_counter
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Min
+
+from dash.models import Account, AccountBalance
+from dash.utils import utils_replay_ledger, utils_write_balances
+
+
+class Command(BaseCommand):
+    help = "Compare AccountBalance rows and write time for daily vs change-point storage (rolled back)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--account", type=int, action="append", help="Account id (repeatable), default: all")
+
+    def handle(self, *args, **options):
+        accounts = Account.objects.order_by("id")
+        if options["account"]:
+            accounts = accounts.filter(id__in=options["account"])
+
+        totals = {"daily": [0, 0.0], "changes": [0, 0.0]}
+        for account in accounts:
+            start = AccountBalance.objects.filter(account=account).aggregate(first=Min("date"))["first"]
+            if start is None:
+                continue
+
+            line = [f"{account.id:>5} {account.name[:20]:<20}"]
+            for storage in ("daily", "changes"):
+                rows = utils_replay_ledger(account, start)
+                with transaction.atomic():
+                    t0 = perf_counter()
+                    written = utils_write_balances(account, rows, storage=storage)
+                    elapsed = perf_counter() - t0
+                    transaction.set_rollback(True)
+
+                totals[storage][0] += written
+                totals[storage][1] += elapsed
+                line.append(f"{storage}: {written:>6} rows {elapsed * 1000:>8.1f} ms")
+            self.stdout.write("  ".join(line))
+
+        daily_rows, daily_time = totals["daily"]
+        changes_rows, changes_time = totals["changes"]
+        if not daily_rows:
+            self.stdout.write("No AccountBalance rows to benchmark.")
+            return
+
+        self.stdout.write(self.style.SUCCESS(
+            f"daily: {daily_rows} rows {daily_time:.3f}s | changes: {changes_rows} rows {changes_time:.3f}s "
+            f"({100 * (1 - changes_rows / daily_rows):.1f}% fewer rows)"
+        ))
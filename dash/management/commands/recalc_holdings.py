@@ -1,23 +1,106 @@
+import multiprocessing
+import os
+from collections import defaultdict
+from time import perf_counter
+
 from django.core.management.base import BaseCommand
 from django.contrib.auth import get_user_model
-from dash.models import TradeEntry
+from django.db import connections
+from django.db.models import Min
+from dash.models import Security, TradeEntry
 from dash.utils import utils_recalc_daily_holdings  # sửa lại path nếu khác
 
 
+def _recalc_user(shard):
+    """Worker: rebuild every (user, security) pair of one user → [(security_id, rows)]."""
+    user_id, pairs = shard
+    user = get_user_model().objects.get(pk=user_id)
+    securities = Security.objects.in_bulk([security_id for security_id, _ in pairs])
+
+    done = []
+    for security_id, first_date in pairs:
+        rows = utils_recalc_daily_holdings(user, securities[security_id], first_date)
+        done.append((security_id, rows))
+    return user_id, done
+
+
+def _init_worker():
+    # Mỗi process con mở kết nối DB riêng
+    connections.close_all()
+
+
 class Command(BaseCommand):
     help = "Recalculate all historical daily holdings for all users"
 
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=1, help="Processes, work is sharded by user")
+        parser.add_argument("--checkpoint", help="File of finished pairs; a rerun skips them")
+        parser.add_argument("--reset", action="store_true", help="Ignore and truncate the checkpoint file")
+
     def handle(self, *args, **options):
-        entries = TradeEntry.objects.select_related("security", "user").order_by("date")
-        seen = set()
+        checkpoint = options["checkpoint"]
+        finished = set() if options["reset"] else self.load_checkpoint(checkpoint)
+        if checkpoint and options["reset"]:
+            open(checkpoint, "w").close()
 
-        for entry in entries:
-            key = (entry.user, entry.security)
-            if key in seen:
+        pairs = (
+            TradeEntry.objects.values("user_id", "security_id")
+            .annotate(first_date=Min("date"))
+            .order_by("user_id", "security_id")
+        )
+        shards = defaultdict(list)
+        skipped = 0
+        for pair in pairs:
+            if (pair["user_id"], pair["security_id"]) in finished:
+                skipped += 1
                 continue
+            shards[pair["user_id"]].append((pair["security_id"], pair["first_date"]))
+
+        total = sum(len(p) for p in shards.values())
+        self.stdout.write(f"{total} pairs to rebuild across {len(shards)} users ({skipped} already done)")
+
+        workers = max(1, options["workers"])
+        started = perf_counter()
+        done_pairs = done_rows = 0
+
+        if workers == 1:
+            results = map(_recalc_user, shards.items())
+            pool = None
+        else:
+            # fork: process con dùng lại cấu hình Django đã setup
+            connections.close_all()
+            pool = multiprocessing.get_context("fork").Pool(workers, initializer=_init_worker)
+            results = pool.imap_unordered(_recalc_user, shards.items())
+
+        try:
+            for user_id, done in results:
+                self.save_checkpoint(checkpoint, user_id, done)
+                done_pairs += len(done)
+                done_rows += sum(rows for _, rows in done)
+                elapsed = perf_counter() - started
+                self.stdout.write(
+                    f"[{done_pairs}/{total}] user {user_id}: {len(done)} pairs | "
+                    f"{done_pairs / elapsed:.1f} pairs/s, {done_rows / elapsed:.0f} rows/s"
+                )
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
 
-            seen.add(key)
-            utils_recalc_daily_holdings(entry.user, entry.security, entry.date)
+        elapsed = perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Recalculation completed: {done_pairs} pairs, {done_rows} rows in {elapsed:.1f}s."
+        ))
 
-        self.stdout.write(self.style.SUCCESS("Recalculation completed."))
+    def load_checkpoint(self, path):
+        if not path or not os.path.exists(path):
+            return set()
+        with open(path) as f:
+            return {tuple(int(v) for v in line.split()[:2]) for line in f if line.strip()}
 
+    def save_checkpoint(self, path, user_id, done):
+        if not path:
+            return
+        with open(path, "a") as f:
+            for security_id, rows in done:
+                f.write(f"{user_id} {security_id} {rows}\n")
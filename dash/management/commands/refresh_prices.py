@@ -0,0 +1,46 @@
+import time
+from collections import Counter
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.utils import timezone
+
+from dash.markets import next_refresh_at
+from dash.models import Instrument, Security
+from dash.utils import utils_refresh_stale_prices
+
+
+def _next_wake(now, max_sleep):
+    """Next exchange close (+ PRICE_REFRESH_AFTER_CLOSE) of any held instrument, at most `max_sleep` away."""
+    exchanges = set(
+        Instrument.objects.filter(pk__in=Security.objects.values('instrument')).values_list('exchange', flat=True)
+    )
+    wake = now + timedelta(seconds=max_sleep)
+    return min([wake] + [next_refresh_at(exchange, now) for exchange in exchanges])
+
+
+class Command(BaseCommand):
+    help = "Keep instrument prices fresh: refresh stale instruments after each exchange close"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true", help="Refresh stale instruments once and exit")
+        parser.add_argument("--deadline", type=float, default=120, help="Seconds allowed for one refresh round")
+        parser.add_argument("--max-sleep", type=int, default=900,
+                            help="Seconds between rounds at most (retries of instruments still stale)")
+
+    def handle(self, *args, **options):
+        while True:
+            close_old_connections()
+            started = time.monotonic()
+            report = utils_refresh_stale_prices(deadline=options["deadline"], label="daemon")
+            counts = Counter(row["status"] for row in report)
+            self.stdout.write(f"{timezone.now():%Y-%m-%d %H:%M} refreshed {len(report)} stale instruments "
+                              f"{dict(counts)} in {time.monotonic() - started:.1f}s")
+            if options["once"]:
+                return
+
+            now = timezone.now()
+            wake = _next_wake(now, options["max_sleep"])
+            self.stdout.write(f"Next round at {wake:%Y-%m-%d %H:%M %Z}")
+            time.sleep(max(1, (wake - now).total_seconds()))
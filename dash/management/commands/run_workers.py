@@ -0,0 +1,54 @@
+import multiprocessing
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from dash.jobs import claim_next_job, requeue_stale_jobs, run_job
+
+
+def _work(once, poll):
+    """Worker loop: claim → run until the queue is empty (`once`) or forever."""
+    connections.close_all()  # process con mở kết nối DB riêng
+    done = 0
+    while True:
+        job = claim_next_job()
+        if job is None:
+            if once:
+                return done
+            time.sleep(poll)
+            continue
+
+        started = time.perf_counter()
+        run_job(job)
+        done += 1
+        print(f"[JOB] #{job.id} {job.kind} from {job.start_date}: {job.status}, "
+              f"{job.rows} rows in {time.perf_counter() - started:.2f}s")
+
+
+class Command(BaseCommand):
+    help = "Run background recalc workers (DB-backed queue, no broker needed)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--processes", type=int, default=1, help="Worker processes (count them in PRICE_RATE_PROCESSES)")
+        parser.add_argument("--once", action="store_true", help="Exit when the queue is empty")
+        parser.add_argument("--poll", type=float, default=1.0, help="Seconds between polls of an empty queue")
+        parser.add_argument("--stale", type=int, default=30, help="Requeue jobs running for more than N minutes")
+
+    def handle(self, *args, **options):
+        requeued = requeue_stale_jobs(timedelta(minutes=options["stale"]))
+        if requeued:
+            self.stdout.write(f"Requeued {requeued} stale jobs")
+
+        processes = max(1, options["processes"])
+        args = (options["once"], options["poll"])
+        if processes == 1:
+            done = _work(*args)
+        else:
+            # fork: process con dùng lại cấu hình Django đã setup
+            connections.close_all()
+            with multiprocessing.get_context("fork").Pool(processes) as pool:
+                done = sum(pool.starmap(_work, [args] * processes))
+
+        self.stdout.write(self.style.SUCCESS(f"Workers finished: {done} jobs"))
@@ -0,0 +1,35 @@
+from datetime import datetime, time as dt_time, timedelta
+from zoneinfo import ZoneInfo
+
+from django.conf import settings
+
+
+def market_close(exchange):
+    """(ZoneInfo, close time) of `exchange` from PRICE_MARKET_CLOSE (default: PRICE_MARKET_CLOSE_DEFAULT)."""
+    tz, close = settings.PRICE_MARKET_CLOSE.get((exchange or "").upper(), settings.PRICE_MARKET_CLOSE_DEFAULT)
+    hour, minute = map(int, close.split(":"))
+    return ZoneInfo(tz), dt_time(hour, minute)
+
+
+def session_ready_at(exchange, day):
+    """When the bar of `day` can be fetched: close + PRICE_REFRESH_AFTER_CLOSE, aware datetime."""
+    tz, close = market_close(exchange)
+    return datetime.combine(day, close, tzinfo=tz) + timedelta(minutes=settings.PRICE_REFRESH_AFTER_CLOSE)
+
+
+def last_session_date(exchange, now):
+    """Latest weekday whose bar is final at `now` (aware) on `exchange`."""
+    tz, _ = market_close(exchange)
+    day = now.astimezone(tz).date()
+    while day.weekday() >= 5 or session_ready_at(exchange, day) > now:
+        day -= timedelta(days=1)
+    return day
+
+
+def next_refresh_at(exchange, now):
+    """First moment after `now` a new bar of `exchange` becomes final."""
+    tz, _ = market_close(exchange)
+    day = now.astimezone(tz).date()
+    while day.weekday() >= 5 or session_ready_at(exchange, day) <= now:
+        day += timedelta(days=1)
+    return session_ready_at(exchange, day)
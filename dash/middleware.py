@@ -1,6 +1,8 @@
 from django.shortcuts import redirect
 from django.urls import reverse
 
+from .utils import utils_defer_portfolio_sync
+
 class LoginRequiredMiddleware:
     def __init__(self, get_response):
         self.get_response = get_response
@@ -10,3 +12,14 @@ class LoginRequiredMiddleware:
         if not request.user.is_authenticated and request.path not in self.exempt_urls:
             return redirect('login')
         return self.get_response(request)
+
+
+class PortfolioSyncMiddleware:
+    """Run at most one portfolio recompute per user for each request."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with utils_defer_portfolio_sync():
+            return self.get_response(request)
@@ -0,0 +1,102 @@
+# Generated by Django 5.2.1 on 2026-10-18 12:23
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+PRICE_FIELDS = ('open', 'high', 'low', 'close', 'adjusted_close', 'volume')
+
+
+def copy_prices_to_instruments(apps, schema_editor):
+    """Link every Security to its shared Instrument and merge the per-user price rows."""
+    Security = apps.get_model('dash', 'Security')
+    SecurityPrice = apps.get_model('dash', 'SecurityPrice')
+    Instrument = apps.get_model('dash', 'Instrument')
+    InstrumentPrice = apps.get_model('dash', 'InstrumentPrice')
+
+    instrument_of = {}
+    for security in Security.objects.order_by('pk'):
+        instrument, _ = Instrument.objects.get_or_create(
+            code=security.code,
+            exchange=security.exchange or '',
+            api_source=security.api_source or 'yahoo',
+        )
+        security.instrument = instrument
+        security.save(update_fields=['instrument'])
+        instrument_of[security.pk] = instrument.pk
+
+    # Nhiều user cùng mã: giữ bản ghi đầu tiên của mỗi (instrument, date)
+    batch = []
+    prices = SecurityPrice.objects.filter(date__isnull=False).order_by('pk').values('security_id', 'date', *PRICE_FIELDS)
+    for row in prices.iterator(chunk_size=5000):
+        instrument_id = instrument_of.get(row.pop('security_id'))
+        if instrument_id is None:
+            continue
+        batch.append(InstrumentPrice(instrument_id=instrument_id, **row))
+        if len(batch) >= 5000:
+            InstrumentPrice.objects.bulk_create(batch, ignore_conflicts=True)
+            batch = []
+    InstrumentPrice.objects.bulk_create(batch, ignore_conflicts=True)
+
+
+def copy_prices_to_securities(apps, schema_editor):
+    Security = apps.get_model('dash', 'Security')
+    SecurityPrice = apps.get_model('dash', 'SecurityPrice')
+    InstrumentPrice = apps.get_model('dash', 'InstrumentPrice')
+
+    for security in Security.objects.exclude(instrument=None):
+        SecurityPrice.objects.bulk_create(
+            [
+                SecurityPrice(security_id=security.pk, date=row['date'], **{f: row[f] for f in PRICE_FIELDS})
+                for row in InstrumentPrice.objects.filter(instrument_id=security.instrument_id).values('date', *PRICE_FIELDS)
+            ],
+            batch_size=5000,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dash', '0009_recalcjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Instrument',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('code', models.CharField(max_length=20)),
+                ('exchange', models.CharField(max_length=20)),
+                ('api_source', models.CharField(default='yahoo', max_length=50)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('code', 'exchange', 'api_source'), name='unique_instrument')],
+            },
+        ),
+        migrations.AddField(
+            model_name='security',
+            name='instrument',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='securities', to='dash.instrument'),
+        ),
+        migrations.CreateModel(
+            name='InstrumentPrice',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('open', models.DecimalField(blank=True, decimal_places=6, max_digits=16, null=True)),
+                ('high', models.DecimalField(blank=True, decimal_places=6, max_digits=16, null=True)),
+                ('low', models.DecimalField(blank=True, decimal_places=6, max_digits=16, null=True)),
+                ('close', models.DecimalField(blank=True, decimal_places=6, max_digits=16, null=True)),
+                ('adjusted_close', models.DecimalField(blank=True, decimal_places=6, max_digits=16, null=True)),
+                ('volume', models.BigIntegerField(default=0)),
+                ('instrument', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='prices', to='dash.instrument')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='instrumentprice',
+            constraint=models.UniqueConstraint(fields=('instrument', 'date'), name='unique_instrument_date'),
+        ),
+        migrations.RunPython(copy_prices_to_instruments, copy_prices_to_securities),
+        migrations.DeleteModel(
+            name='SecurityPrice',
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.1 on 2026-10-18 12:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dash', '0010_instrument_shared_prices'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='instrument',
+            name='checked_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='recalcjob',
+            name='kind',
+            field=models.CharField(choices=[('account', 'Account balances'), ('holdings', 'Daily holdings'), ('prices', 'Stale prices')], max_length=20),
+        ),
+    ]
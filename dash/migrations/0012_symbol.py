@@ -0,0 +1,31 @@
+# Generated by Django 5.2.1 on 2026-10-18 12:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dash', '0011_instrument_checked_at_prices_job'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Symbol',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('code', models.CharField(max_length=20)),
+                ('exchange', models.CharField(blank=True, max_length=20)),
+                ('api_source', models.CharField(max_length=50)),
+                ('name', models.CharField(blank=True, max_length=255)),
+                ('isin', models.CharField(blank=True, max_length=20)),
+                ('type', models.CharField(blank=True, max_length=255)),
+                ('currency', models.CharField(blank=True, max_length=10)),
+                ('country', models.CharField(blank=True, max_length=100)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('code', 'exchange', 'api_source'), name='unique_symbol')],
+            },
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.1 on 2026-10-18 12:53
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dash', '0012_symbol'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='recalcjob',
+            name='progress',
+        ),
+    ]
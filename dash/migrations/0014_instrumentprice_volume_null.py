@@ -0,0 +1,18 @@
+# Generated by Django 5.2.1 on 2026-10-18 13:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dash', '0013_remove_recalcjob_progress'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='instrumentprice',
+            name='volume',
+            field=models.BigIntegerField(blank=True, default=0, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.1 on 2026-10-18 13:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dash', '0014_instrumentprice_volume_null'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recalcjob',
+            name='progress',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+    ]
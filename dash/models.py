@@ -301,9 +301,81 @@ class TradeExit(models.Model):
         return f"{self.date} - SELL {self.quantity} x {self.entry.security.code} @ {self.price}"
 
 
+class Instrument(models.Model):
+    """
+    A listed instrument as the price providers know it. Its price history
+    (InstrumentPrice) is shared by every user's Security pointing at it.
+    """
+    code = models.CharField(max_length=20)
+    exchange = models.CharField(max_length=20)
+    api_source = models.CharField(max_length=50, default='yahoo')
+    # lần refresh giá gần nhất (kể cả khi provider chưa có bar mới)
+    checked_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['code', 'exchange', 'api_source'], name='unique_instrument')
+        ]
+
+    @classmethod
+    def for_security(cls, security):
+        # api_source trống = yahoo (giống lúc refresh giá)
+        instrument, _ = cls.objects.get_or_create(
+            code=security.code,
+            exchange=security.exchange or '',
+            api_source=security.api_source or 'yahoo',
+        )
+        return instrument
+
+    def price_on(self, target_date: date) -> Decimal | None:
+        # Ưu tiên lấy giá trong quá khứ gần nhất, và close > 0
+        past = InstrumentPrice.objects.filter(
+            instrument=self, date__lte=target_date, close__gt=0
+        ).order_by('-date').first()
+        if past:
+            return past.close
+
+        # Nếu không có thì lấy giá trong tương lai gần nhất, và close > 0
+        future = InstrumentPrice.objects.filter(
+            instrument=self, date__gt=target_date, close__gt=0
+        ).order_by('date').first()
+        if future:
+            return future.close
+
+        return None
+
+    def __str__(self):
+        return f"{self.code}.{self.exchange} ({self.api_source})"
+
+
+class Symbol(models.Model):
+    """
+    A listing seen in provider search results, kept for the local symbol
+    index (dash/search.py `SymbolIndex`) next to the users' Security rows.
+    """
+    code = models.CharField(max_length=20)
+    exchange = models.CharField(max_length=20, blank=True)
+    api_source = models.CharField(max_length=50)
+    name = models.CharField(max_length=255, blank=True)
+    isin = models.CharField(max_length=20, blank=True)
+    type = models.CharField(max_length=255, blank=True)
+    currency = models.CharField(max_length=10, blank=True)
+    country = models.CharField(max_length=100, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['code', 'exchange', 'api_source'], name='unique_symbol')
+        ]
+
+    def __str__(self):
+        return f"{self.code}.{self.exchange} ({self.api_source})"
+
+
 class Security(models.Model):
 #    country = models.ForeignKey(Country, on_delete=models.CASCADE, related_name='country')
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='securities')
+    instrument = models.ForeignKey(Instrument, on_delete=models.SET_NULL, null=True, blank=True, related_name='securities')
     code = models.CharField(max_length=20)
     exchange = models.CharField(max_length=20)
     name = models.CharField(max_length=255)
@@ -324,44 +396,37 @@ class Security(models.Model):
             models.Index(fields=['user', 'code']),
         ]
 
-    def price_on(self, target_date: date) -> Decimal | None:
-        # Ưu tiên lấy giá trong quá khứ gần nhất, và close > 0
-        past = SecurityPrice.objects.filter(
-            security=self, date__lte=target_date, close__gt=0
-        ).order_by('-date').first()
-        if past:
-            return past.close
+    def save(self, *args, **kwargs):
+        # Gắn vào Instrument dùng chung theo (code, exchange, api_source)
+        self.instrument = Instrument.for_security(self)
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = {*kwargs['update_fields'], 'instrument'}
+        super().save(*args, **kwargs)
 
-        # Nếu không có thì lấy giá trong tương lai gần nhất, và close > 0
-        future = SecurityPrice.objects.filter(
-            security=self, date__gt=target_date, close__gt=0
-        ).order_by('date').first()
-        if future:
-            return future.close
-
-        return None
+    def price_on(self, target_date: date) -> Decimal | None:
+        return self.instrument.price_on(target_date) if self.instrument_id else None
 
 
     def __str__(self):
         return f"{self.code} - {self.name}"
 
 
-class SecurityPrice(models.Model):
-    security = models.ForeignKey('Security', on_delete=models.CASCADE, default=1)
-    date = models.DateField(null=True, blank=True)
+class InstrumentPrice(models.Model):
+    instrument = models.ForeignKey(Instrument, on_delete=models.CASCADE, related_name='prices')
+    date = models.DateField()
     open = models.DecimalField(max_digits=16, decimal_places=6, null=True, blank=True)
     high = models.DecimalField(max_digits=16, decimal_places=6, null=True, blank=True)
     low = models.DecimalField(max_digits=16, decimal_places=6,null=True, blank=True)
     close = models.DecimalField(max_digits=16, decimal_places=6, null=True, blank=True)
     adjusted_close = models.DecimalField(max_digits=16, decimal_places=6,null=True, blank=True)
-    volume = models.BigIntegerField(default=0)
+    volume = models.BigIntegerField(default=0, null=True, blank=True)
 
     class Meta:
         constraints = [
-            models.UniqueConstraint(fields=['security', 'date'], name='unique_security_date')
+            models.UniqueConstraint(fields=['instrument', 'date'], name='unique_instrument_date')
         ]
     def __str__(self):
-        return f"{self.security.code} - {self.date} - {self.close}"
+        return f"{self.instrument.code} - {self.date} - {self.close}"
 
 class DailyHoldingEquity(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='holdings')
@@ -369,3 +434,42 @@ class DailyHoldingEquity(models.Model):
     security = models.ForeignKey(Security, on_delete=models.CASCADE)
     equity = models.DecimalField(max_digits=20, decimal_places=4)
     currency = models.CharField(max_length=10)  # để convert khi hiển thị
+
+
+
+class RecalcJob(models.Model):
+    """
+    Background recalculation queued by the write APIs (or a price refresh
+    queued at login), run by `manage.py run_workers`.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='recalc_jobs')
+    kind = models.CharField(max_length=20, choices=[
+        ('account', 'Account balances'),
+        ('holdings', 'Daily holdings'),
+        ('prices', 'Stale prices'),
+    ])
+    account = models.ForeignKey(Account, on_delete=models.CASCADE, null=True, blank=True)
+    security = models.ForeignKey(Security, on_delete=models.CASCADE, null=True, blank=True)
+    start_date = models.DateField()
+
+    status = models.CharField(max_length=20, default='pending', choices=[
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ])
+    progress = models.PositiveSmallIntegerField(default=0)  # % số ngày đã tính
+    rows = models.IntegerField(default=0)
+    error = models.TextField(blank=True)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'created_at']),
+        ]
+
+    def __str__(self):
+        target = self.account or self.security
+        return f"#{self.id} {self.kind} {target} from {self.start_date} [{self.status}]"
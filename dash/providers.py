@@ -0,0 +1,494 @@
+import asyncio
+import hashlib
+import json
+import threading
+from collections import namedtuple
+from datetime import date, datetime, time as dt_time, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from pathlib import Path
+from urllib.parse import urlencode
+
+import requests
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import UserAPIKey
+from .scheduler import scheduler
+
+# per_minute: request budget per API key (per host for keyless providers),
+# concurrency: parallel requests, batch_size: symbols per `fetch_latest`
+# request (1 = no multi-symbol endpoint), host_per_minute: budget of the
+# provider across all keys (default: per_minute)
+RateLimit = namedtuple("RateLimit", "per_minute concurrency batch_size host_per_minute", defaults=(None,))
+
+PROVIDERS = {}
+
+
+def register(cls):
+    PROVIDERS[cls.name] = cls
+    return cls
+
+
+class PriceProvider:
+    """
+    Common interface of the price sources (`Instrument.api_source`).
+
+    Every fetch returns bars as dicts {'date', 'open', 'high', 'low',
+    'close', 'adjusted_close', 'volume'}. Errors are printed and give an
+    empty result, like the original fetch helpers. The `a*` variants run the
+    same call in a worker thread for asyncio callers.
+
+    Requests go through the shared ProviderScheduler (rate limits, retries,
+    circuit breaker); `interactive` providers get the priority lane.
+    """
+    name = None
+    key_field = None  # field of UserAPIKey holding the key, None = no key
+    rate_limit = RateLimit(per_minute=60, concurrency=4, batch_size=1)
+    search_limit = 10  # số kết quả tối đa của `search` (None = danh sách đầy đủ)
+
+    def __init__(self, key=None, session=None, interactive=False):
+        self.key = key
+        self.session = session or requests
+        self.interactive = interactive
+        self.base_url = settings.PRICE_API_URLS[self.name]
+
+    @property
+    def concurrency(self):
+        return settings.PRICE_FETCH_CONCURRENCY.get(self.name, self.rate_limit.concurrency)
+
+    @property
+    def batch_size(self):
+        return settings.PRICE_BATCH_SIZE.get(self.name, self.rate_limit.batch_size)
+
+    def get_json(self, path, params=None, timeout=10, **kwargs):
+        url = f"{self.base_url}{path}"
+        if isinstance(self.session, ReplaySession) and self.session.mode == "replay":
+            # offline: không cần giới hạn tốc độ
+            r = self.session.get(url, params=params, timeout=timeout, **kwargs)
+            r.raise_for_status()
+        else:
+            r = scheduler.get(self, url, params=params, timeout=timeout, verify=False, **kwargs)
+        return r.json()
+
+    def fetch_history(self, code, exchange, start_date, timeout=10):
+        raise NotImplementedError
+
+    def fetch_latest(self, codes, exchange, range_days=5, timeout=10):
+        """
+        Recent bars of many symbols → {code: [bar]}. Providers with a
+        multi-symbol endpoint override this; the default asks `fetch_history`
+        for the last `range_days` of each symbol.
+        """
+        start_date = timezone.now().date() - timedelta(days=range_days)
+        prices = {}
+        for code in codes:
+            bars = self.fetch_history(code, exchange, start_date, timeout=timeout)
+            if bars:
+                prices[code] = bars
+        return prices
+
+    def search(self, query, timeout=5):
+        """→ [{'code', 'exchange', 'name', 'type', 'currency', 'country', 'api_source'}]"""
+        raise NotImplementedError
+
+    async def afetch_history(self, *args, **kwargs):
+        return await asyncio.to_thread(self.fetch_history, *args, **kwargs)
+
+    async def afetch_latest(self, *args, **kwargs):
+        return await asyncio.to_thread(self.fetch_latest, *args, **kwargs)
+
+    async def asearch(self, *args, **kwargs):
+        return await asyncio.to_thread(self.search, *args, **kwargs)
+
+    def missing_key(self):
+        if self.key_field and not self.key:
+            print(f"[{self.name}] API key missing (UserAPIKey.{self.key_field}).")
+            return True
+        return False
+
+
+def _bar(row_date, open_, high, low, close, adjusted_close=None, volume=0):
+    close = Decimal(str(close))
+    return {
+        "date": row_date,
+        "open": None if open_ is None else Decimal(str(open_)),
+        "high": None if high is None else Decimal(str(high)),
+        "low": None if low is None else Decimal(str(low)),
+        "close": close,
+        "adjusted_close": close if adjusted_close is None else Decimal(str(adjusted_close)),
+        "volume": None if volume is None else int(volume),
+    }
+
+
+@register
+class YahooProvider(PriceProvider):
+    name = "yahoo"
+    rate_limit = RateLimit(per_minute=120, concurrency=8, batch_size=20)
+    headers = {
+        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36"
+    }
+
+    def fetch_history(self, code, exchange, start_date, timeout=10):
+        delta_days = (timezone.now().date() - start_date).days
+        try:
+            data = self.get_json(f"/v8/finance/chart/{code}", {"range": f"{delta_days}d", "interval": "1d"},
+                                 timeout=timeout, headers=self.headers)
+            timestamps = data['chart']['result'][0]['timestamp']
+            indicators = data['chart']['result'][0]['indicators']['quote'][0]
+        except (KeyError, IndexError, TypeError):
+            return []
+        except Exception as e:
+            print(f"Yahoo fetch error for {code}: {e}")
+            return []
+
+        adjclose = indicators.get('adjclose', [0] * len(timestamps))
+        prices = []
+        for i, ts in enumerate(timestamps):
+            prices.append({
+                'date': date.fromtimestamp(ts),
+                'open': indicators['open'][i] or 0,
+                'high': indicators['high'][i] or 0,
+                'low': indicators['low'][i] or 0,
+                'close': indicators['close'][i] or 0,
+                'volume': indicators['volume'][i] or 0,
+                'adjusted_close': adjclose[i] or 0,
+            })
+        return prices
+
+    def fetch_latest(self, codes, exchange, range_days=5, timeout=10):
+        """Daily closes of many symbols (`spark`).
+
+        Spark only returns closes: open/high/low/volume of these bars are None.
+        """
+        try:
+            data = self.get_json("/v8/finance/spark",
+                                 {"symbols": ",".join(codes), "range": f"{range_days}d", "interval": "1d"},
+                                 timeout=timeout, headers=self.headers)
+        except Exception as e:
+            print(f"Yahoo spark error for {len(codes)} symbols: {e}")
+            return {}
+
+        # 2 dạng response: {"AAPL": {"timestamp", "close"}} và {"spark": {"result": [chart...]}}
+        series = {}
+        if isinstance(data.get("spark"), dict):
+            for item in data["spark"].get("result") or []:
+                try:
+                    chart = item["response"][0]
+                    series[item["symbol"]] = (chart["timestamp"], chart["indicators"]["quote"][0]["close"])
+                except (KeyError, IndexError, TypeError):
+                    continue
+        else:
+            for symbol, item in data.items():
+                if isinstance(item, dict) and "timestamp" in item:
+                    series[symbol] = (item["timestamp"], item.get("close") or [])
+
+        return {
+            symbol: [_bar(date.fromtimestamp(ts), None, None, None, close, volume=None)
+                     for ts, close in zip(timestamps or [], closes) if close is not None]
+            for symbol, (timestamps, closes) in series.items()
+        }
+
+    def search(self, query, timeout=5):
+        try:
+            params = {"q": query, "quotesCount": self.search_limit, "newsCount": 0}
+            quotes = self.get_json("/v1/finance/search", params, timeout=timeout,
+                                   headers={"User-Agent": "Mozilla/5.0"}).get("quotes", [])
+        except Exception as e:
+            print('Yahoo API error:', e)
+            return []
+        return [
+            {
+                "code": item.get("symbol", ""),
+                "exchange": item.get("exchange", ""),
+                "name": item.get("shortname") or item.get("longname") or "",
+                "type": item.get("quoteType", ""),
+                "currency": item.get("currency", ""),
+                "country": item.get("country", ""),
+                "api_source": self.name,
+            }
+            for item in quotes
+        ]
+
+
+@register
+class EodhdProvider(PriceProvider):
+    name = "eodhd"
+    key_field = "key_eodhd"
+    rate_limit = RateLimit(per_minute=1000, concurrency=4, batch_size=500)
+    search_limit = 20
+
+    def fetch_history(self, code, exchange, start_date, timeout=10, period_days=90):
+        # free plan: tối đa 90 ngày gần nhất, lọc lại theo start_date
+        if self.missing_key():
+            return []
+        symbol = f"{code}.{exchange}"
+        try:
+            raw = self.get_json(f"/eod/{symbol}", {"period": f"{period_days}d", "api_token": self.key, "fmt": "json"},
+                                timeout=timeout)
+        except Exception as exc:
+            print(f"[EODHD] request failed for {symbol}: {exc}")
+            return []
+
+        if not isinstance(raw, list):
+            print(f"[EODHD] bad response for {symbol}: {raw}")
+            return []
+
+        prices = []
+        for row in raw:
+            try:
+                row_date = date.fromisoformat(row["date"])
+                if start_date and row_date < start_date:
+                    continue  # bỏ dữ liệu quá cũ
+                prices.append(_bar(row_date, row["open"], row["high"], row["low"], row["close"],
+                                   row.get("adjusted_close", row["close"]), row["volume"]))
+            except (KeyError, ValueError, TypeError) as exc:
+                print(f"[EODHD] parse error {symbol} {row}: {exc}")
+        return prices
+
+    def fetch_latest(self, codes, exchange, range_days=5, timeout=10):
+        """Last end-of-day bar of many symbols of one exchange (`eod-bulk-last-day`)."""
+        if self.missing_key():
+            return {}
+        try:
+            raw = self.get_json(f"/eod-bulk-last-day/{exchange}",
+                                {"api_token": self.key, "fmt": "json", "symbols": ",".join(codes)}, timeout=timeout)
+        except Exception as exc:
+            print(f"[EODHD] bulk request failed for {exchange}: {exc}")
+            return {}
+
+        if not isinstance(raw, list):
+            print(f"[EODHD] bad bulk response for {exchange}: {raw}")
+            return {}
+
+        prices = {}
+        for row in raw:
+            try:
+                prices.setdefault(row["code"], []).append(
+                    _bar(date.fromisoformat(row["date"]), row["open"], row["high"], row["low"], row["close"],
+                         row.get("adjusted_close", row["close"]), row["volume"])
+                )
+            except (KeyError, ValueError, TypeError) as exc:
+                print(f"[EODHD] bulk parse error {exchange} {row}: {exc}")
+        return prices
+
+    def search(self, query, timeout=5):
+        if not self.key:
+            return []
+        try:
+            rows = self.get_json(f"/search/{query}", {"api_token": self.key, "limit": self.search_limit, "fmt": "json"}, timeout=timeout)
+        except Exception as e:
+            print('EODHD API error:', e)
+            return []
+        return [
+            {
+                "code": item.get("Code", ""),
+                "exchange": item.get("Exchange", ""),
+                "name": item.get("Name", ""),
+                "type": item.get("Type", ""),
+                "currency": item.get("Currency", ""),
+                "country": item.get("Country", ""),
+                "isin": item.get("ISIN") or "",
+                "api_source": self.name,
+            }
+            for item in rows if isinstance(item, dict)
+        ]
+
+
+@register
+class FinnhubProvider(PriceProvider):
+    name = "finnhub"
+    key_field = "key_finhub"
+    rate_limit = RateLimit(per_minute=60, concurrency=4, batch_size=1)
+    search_limit = None
+
+    def fetch_history(self, code, exchange, start_date, timeout=10):
+        if self.missing_key():
+            return []
+        start = datetime.combine(start_date, dt_time.min, tzinfo=dt_timezone.utc)
+        params = {
+            "symbol": code,
+            "resolution": "D",
+            "from": int(start.timestamp()),
+            "to": int((timezone.now() + timedelta(days=1)).timestamp()),
+            "token": self.key,
+        }
+        try:
+            data = self.get_json("/stock/candle", params, timeout=timeout)
+        except Exception as exc:
+            print(f"[FINNHUB] request failed for {code}: {exc}")
+            return []
+
+        if data.get("s") != "ok":
+            return []
+        return [
+            _bar(datetime.fromtimestamp(ts, dt_timezone.utc).date(), o, h, l, c, None, v)
+            for ts, o, h, l, c, v in zip(data["t"], data["o"], data["h"], data["l"], data["c"], data["v"])
+        ]
+
+    def search(self, query, timeout=5):
+        if not self.key:
+            return []
+        try:
+            rows = self.get_json("/search", {"q": query, "token": self.key}, timeout=timeout).get("result", [])
+        except Exception as e:
+            print('Finnhub API error:', e)
+            return []
+        return [
+            {
+                "code": item.get("symbol", ""),
+                "exchange": "",
+                "name": item.get("description", ""),
+                "type": item.get("type", ""),
+                "currency": "",
+                "country": "",
+                "api_source": self.name,
+            }
+            for item in rows
+        ]
+
+
+@register
+class AlphaVantageProvider(PriceProvider):
+    name = "alpha_vantage"
+    key_field = "key_alpha_vantage"
+    rate_limit = RateLimit(per_minute=5, concurrency=1, batch_size=1)
+
+    def fetch_history(self, code, exchange, start_date, timeout=10):
+        if self.missing_key():
+            return []
+        outputsize = "compact" if (timezone.now().date() - start_date).days < 100 else "full"
+        params = {"function": "TIME_SERIES_DAILY", "symbol": code, "outputsize": outputsize, "apikey": self.key}
+        try:
+            series = self.get_json("/query", params, timeout=timeout).get("Time Series (Daily)", {})
+        except Exception as exc:
+            print(f"[ALPHA VANTAGE] request failed for {code}: {exc}")
+            return []
+
+        prices = []
+        for day, row in sorted(series.items()):
+            row_date = date.fromisoformat(day)
+            if row_date < start_date:
+                continue
+            prices.append(_bar(row_date, row["1. open"], row["2. high"], row["3. low"], row["4. close"],
+                               None, row["5. volume"]))
+        return prices
+
+    def search(self, query, timeout=5):
+        if not self.key:
+            return []
+        try:
+            rows = self.get_json("/query", {"function": "SYMBOL_SEARCH", "keywords": query, "apikey": self.key},
+                                 timeout=timeout).get("bestMatches", [])
+        except Exception as e:
+            print('Alpha Vantage API error:', e)
+            return []
+        return [
+            {
+                "code": item.get("1. symbol", ""),
+                "exchange": "",
+                "name": item.get("2. name", ""),
+                "type": item.get("3. type", ""),
+                "currency": item.get("8. currency", ""),
+                "country": item.get("4. region", ""),
+                "api_source": self.name,
+            }
+            for item in rows
+        ]
+
+
+class ReplayResponse:
+    def __init__(self, payload, status_code=200):
+        self.payload = payload
+        self.status_code = status_code
+        self.ok = status_code < 400
+
+    def json(self):
+        return self.payload
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise requests.HTTPError(f"{self.status_code} (replayed)")
+
+
+class ReplaySession:
+    """
+    Stand-in for the HTTP session of one provider that answers from JSON
+    fixtures on disk (`mode='replay'`) or performs the request and saves
+    the response (`mode='record'`).
+
+    `{base_url}/eod/AAPL.US?...` of eodhd maps to `<directory>/eodhd/eod_AAPL.US.json`;
+    a fixture for the exact query (`eod_AAPL.US@<hash>.json`, secrets left
+    out of the hash) wins over the generic one.
+    """
+    SECRET_PARAMS = {"api_token", "token", "apikey"}
+
+    def __init__(self, provider, directory, mode="replay", session=None):
+        self.provider = provider
+        self.base_url = settings.PRICE_API_URLS[provider]
+        self.directory = Path(directory) / provider
+        self.mode = mode
+        self.session = session or requests
+
+    def paths(self, url, params):
+        name = url[len(self.base_url):].strip("/").replace("/", "_") or "index"
+        query = urlencode(sorted((k, v) for k, v in (params or {}).items() if k not in self.SECRET_PARAMS))
+        digest = hashlib.sha1(query.encode()).hexdigest()[:10]
+        return self.directory / f"{name}@{digest}.json", self.directory / f"{name}.json"
+
+    def get(self, url, params=None, **kwargs):
+        exact, generic = self.paths(url, params)
+        if self.mode == "record":
+            response = self.session.get(url, params=params, **kwargs)
+            if response.ok:
+                exact.parent.mkdir(parents=True, exist_ok=True)
+                exact.write_text(json.dumps(response.json(), indent=1) + "\n")
+            return response
+
+        for path in (exact, generic):
+            if path.exists():
+                return ReplayResponse(json.loads(path.read_text()))
+        raise requests.ConnectionError(f"no recorded response for {url} ({generic.name})")
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def shared_session():
+    """Keep-alive requests.Session shared by all price fetch threads."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            # đủ connection cho tất cả các thread fetch song song
+            pool_size = sum(settings.PRICE_FETCH_CONCURRENCY.get(name, cls.rate_limit.concurrency)
+                            for name, cls in PROVIDERS.items())
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _session = session
+        return _session
+
+
+def get_provider(name, key=None, replay=None, interactive=False):
+    """
+    Provider instance for an `api_source` (None if unknown). `replay`
+    ('replay' / 'record', default `PRICE_PROVIDER_REPLAY`) routes its
+    requests through a ReplaySession on `PRICE_PROVIDER_FIXTURES`;
+    `interactive` puts its requests in the scheduler's priority lane.
+    """
+    cls = PROVIDERS.get(name or "yahoo")
+    if cls is None:
+        return None
+    replay = replay or settings.PRICE_PROVIDER_REPLAY
+    session = shared_session()
+    if replay:
+        session = ReplaySession(cls.name, settings.PRICE_PROVIDER_FIXTURES, replay, session)
+    return cls(key=key, session=session, interactive=interactive)
+
+
+def provider_keys(user):
+    """{provider name: key} from the user's UserAPIKey."""
+    api_keys, _ = UserAPIKey.objects.get_or_create(user=user)
+    return {name: getattr(api_keys, cls.key_field) for name, cls in PROVIDERS.items() if cls.key_field}
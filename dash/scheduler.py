@@ -0,0 +1,210 @@
+import random
+import threading
+import time
+
+import requests
+
+from django.conf import settings
+
+
+class CircuitOpenError(requests.ConnectionError):
+    """The provider failed too often recently; calls fail fast until the cooldown ends."""
+
+
+class TokenBucket:
+    """
+    `per_minute` requests with bursts of up to `capacity` (default: 10
+    seconds worth). Interactive callers waiting for a token go ahead of
+    background ones. `clock` (default time.monotonic) is the time source
+    of the refill and of the deadlines.
+    """
+
+    def __init__(self, per_minute, capacity=None, clock=time.monotonic):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity or max(1.0, per_minute / 6)
+        self.clock = clock
+        self.tokens = self.capacity
+        self.updated = clock()
+        self.interactive_waiting = 0
+        self.cond = threading.Condition()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, deadline, interactive=False):
+        """Take one token, waiting until `deadline` (on `clock`). False if none came in time."""
+        with self.cond:
+            if interactive:
+                self.interactive_waiting += 1
+            try:
+                while True:
+                    self._refill()
+                    if self.tokens >= 1 and (interactive or not self.interactive_waiting):
+                        self.tokens -= 1
+                        return True
+                    remaining = deadline - self.clock()
+                    if remaining <= 0:
+                        return False
+                    # chờ tới khi có token, hoặc tới lượt sau request interactive
+                    wait = (1 - self.tokens) / self.rate if self.tokens < 1 else 0.05
+                    self.cond.wait(min(wait, remaining))
+            finally:
+                if interactive:
+                    self.interactive_waiting -= 1
+                    self.cond.notify_all()
+
+    def pause(self, seconds):
+        """The provider asked us to slow down: hand out no token for `seconds`."""
+        with self.cond:
+            self._refill()
+            self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+
+class CircuitBreaker:
+    """
+    Opens after `threshold` failed calls in a row; once `cooldown` seconds
+    passed a single trial call is let through (half-open) and its outcome
+    closes or re-opens the circuit.
+    """
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if not self.trial and time.monotonic() - self.opened_at >= self.cooldown:
+                self.trial = True
+                return True
+            return False
+
+    def release(self):
+        """The allowed call never reached the provider."""
+        with self.lock:
+            self.trial = False
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial = False
+            if self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+
+def _retry_after(response):
+    try:
+        return max(0.0, float(response.headers.get("Retry-After")))
+    except (TypeError, ValueError):
+        return None
+
+
+class ProviderScheduler:
+    """
+    Every provider HTTP call goes through `get`: it waits for a token of the
+    provider bucket (per host) and of the API-key bucket, retries 429 / 5xx
+    / network errors with exponential backoff and full jitter (or the
+    provider's Retry-After), and trips a circuit breaker per (provider, key)
+    after repeated failed calls. A 429 pauses the buckets for every thread,
+    so parallel fetches slow down together instead of piling up errors.
+
+    Buckets live in the process: each one only gets 1/PRICE_RATE_PROCESSES
+    of a provider's limit, so the processes together stay within it.
+    """
+    RETRY_STATUS = {429, 500, 502, 503, 504}
+    # lỗi key / hết quota: thử lại cũng vô ích, tính là lỗi cho circuit breaker
+    FATAL_STATUS = {401, 402, 403}
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.breakers = {}
+
+    def reset(self):
+        with self.lock:
+            self.buckets.clear()
+            self.breakers.clear()
+
+    def bucket(self, key, per_minute):
+        """Bucket of `key`; buckets are per process → this process's share of `per_minute`."""
+        with self.lock:
+            if key not in self.buckets:
+                self.buckets[key] = TokenBucket(per_minute / settings.PRICE_RATE_PROCESSES)
+            return self.buckets[key]
+
+    def breaker(self, key):
+        with self.lock:
+            if key not in self.breakers:
+                self.breakers[key] = CircuitBreaker(settings.PRICE_BREAKER_THRESHOLD, settings.PRICE_BREAKER_COOLDOWN)
+            return self.breakers[key]
+
+    def get(self, provider, url, params=None, timeout=10, **kwargs):
+        """GET `url` for `provider` within `timeout` seconds in total (waits and retries included)."""
+        deadline = time.monotonic() + timeout
+        limits = provider.rate_limit
+        breaker = self.breaker((provider.name, provider.key or ""))
+        if not breaker.allow():
+            raise CircuitOpenError(f"{provider.name}: circuit open after repeated failures")
+
+        buckets = [self.bucket(provider.name, limits.host_per_minute or limits.per_minute)]
+        if provider.key:
+            buckets.append(self.bucket((provider.name, provider.key), limits.per_minute))
+
+        attempt = 0
+        while True:
+            if not all(bucket.acquire(deadline, provider.interactive) for bucket in buckets):
+                breaker.release()  # không phải lỗi provider, chỉ là hết thời gian chờ
+                raise requests.Timeout(f"{provider.name}: no request slot before the deadline")
+
+            retry_after = None
+            try:
+                response = provider.session.get(
+                    url, params=params, timeout=max(0.1, deadline - time.monotonic()), **kwargs
+                )
+            except requests.RequestException as exc:
+                error = exc
+            else:
+                if response.status_code < 400 or response.status_code not in self.RETRY_STATUS | self.FATAL_STATUS:
+                    # 404 & co.: provider vẫn sống, lỗi thuộc về request
+                    breaker.success()
+                    response.raise_for_status()
+                    return response
+                if response.status_code in self.FATAL_STATUS:
+                    breaker.failure()
+                    response.raise_for_status()
+
+                error = requests.HTTPError(f"{response.status_code} from {provider.name}", response=response)
+                retry_after = _retry_after(response)
+                if response.status_code == 429:
+                    for bucket in buckets:
+                        bucket.pause(retry_after or settings.PRICE_RETRY_BACKOFF * 2 ** attempt)
+
+            attempt += 1
+            delay = retry_after if retry_after is not None else random.uniform(
+                0, min(settings.PRICE_RETRY_BACKOFF_MAX, settings.PRICE_RETRY_BACKOFF * 2 ** attempt)
+            )
+            if attempt > settings.PRICE_RETRY_ATTEMPTS or time.monotonic() + delay >= deadline:
+                breaker.failure()
+                raise error
+            print(f"[{provider.name}] {error}, retry {attempt} in {delay:.2f}s")
+            time.sleep(delay)
+
+
+scheduler = ProviderScheduler()
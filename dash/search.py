@@ -0,0 +1,329 @@
+import heapq
+import threading
+import time
+from bisect import bisect_left, insort
+from collections import Counter, OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait as futures_wait
+from datetime import timedelta
+from itertools import chain
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from .models import Security, Symbol
+from .providers import get_provider
+from .series import bump_shared_version, shared_version
+
+SYMBOL_FIELDS = ["code", "exchange", "name", "isin", "type", "currency", "country", "api_source"]
+
+
+def normalize_query(query):
+    return " ".join((query or "").split()).casefold()
+
+
+class SearchCache:
+    """
+    In-process LRU of provider search results with a TTL, keyed by
+    (provider, normalised query).
+
+    `get` also answers a query from the cached results of one of its
+    prefixes ("app" → "appl") when that result list was complete, i.e.
+    shorter than the provider's `search_limit`: the results matching the
+    longer query are then a subset of it.
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _get(self, key):
+        item = self.items.get(key)
+        if item is None:
+            return None
+        stored_at, results, complete = item
+        if time.monotonic() - stored_at > self.ttl:
+            del self.items[key]
+            return None
+        self.items.move_to_end(key)
+        return results, complete
+
+    def get(self, provider, query):
+        with self.lock:
+            hit = self._get((provider, query))
+            if hit:
+                return hit[0]
+            for end in range(len(query) - 1, 1, -1):
+                hit = self._get((provider, query[:end]))
+                if hit and hit[1]:
+                    return [item for item in hit[0] if _matches(item, query)]
+        return None
+
+    def set(self, provider, query, results, complete):
+        with self.lock:
+            self.items[provider, query] = (time.monotonic(), results, complete)
+            self.items.move_to_end((provider, query))
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+def _matches(item, query):
+    return query in item["code"].casefold() or query in item["name"].casefold()
+
+
+search_cache = SearchCache(settings.SECURITY_SEARCH_CACHE_SIZE, settings.SECURITY_SEARCH_CACHE_TTL)
+
+
+def search_securities(query, keys=None, deadline=None):
+    """
+    Query the SECURITY_SEARCH_PROVIDERS concurrently (priority lane of the
+    scheduler) and return ({provider: [result]}, [providers that missed the
+    deadline]). Providers answering after `deadline` seconds (default
+    SECURITY_SEARCH_DEADLINE) are left out, but their request runs on until
+    SECURITY_SEARCH_TIMEOUT and the results land in the cache for the next
+    keystroke. Empty results are not cached: a provider error also gives an
+    empty list.
+    """
+    deadline = settings.SECURITY_SEARCH_DEADLINE if deadline is None else deadline
+    query = normalize_query(query)
+    keys = keys or {}
+
+    results = {}
+    providers = []
+    for name in settings.SECURITY_SEARCH_PROVIDERS:
+        provider = get_provider(name, keys.get(name), interactive=True)
+        if provider is None or (provider.key_field and not provider.key):
+            continue
+        cached = search_cache.get(name, query)
+        if cached is not None:
+            results[name] = cached
+        else:
+            providers.append(provider)
+
+    if not providers:
+        return results, []
+
+    def store(provider, future):
+        found = future.result() if not future.cancelled() else []
+        if found:
+            complete = provider.search_limit is None or len(found) < provider.search_limit
+            search_cache.set(provider.name, query, found, complete)
+
+    pool = ThreadPoolExecutor(len(providers), "search")
+    futures = {}
+    for provider in providers:
+        # timeout riêng ≥ deadline: câu trả lời muộn vẫn được cache
+        future = pool.submit(provider.search, query, timeout=max(deadline, settings.SECURITY_SEARCH_TIMEOUT))
+        future.add_done_callback(lambda f, provider=provider: store(provider, f))
+        futures[provider.name] = future
+    futures_wait(futures.values(), timeout=deadline)
+    pool.shutdown(wait=False)
+
+    timed_out = []
+    for name, future in futures.items():
+        if future.done():
+            results[name] = future.result()
+        else:
+            timed_out.append(name)
+    return results, timed_out
+
+
+def _trigrams(text):
+    text = f"  {text} "
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def _entry(row):
+    """Index entry of a Symbol / Security row ({field: value})."""
+    entry = {field: row.get(field) or "" for field in SYMBOL_FIELDS}
+    entry["api_source"] = entry["api_source"] or "yahoo"
+    return entry
+
+
+def _prefixed(keys, query):
+    """(key, entry) of the sorted `keys` starting with `query`."""
+    for i in range(bisect_left(keys, (query,)), len(keys)):
+        if not keys[i][0].startswith(query):
+            return
+        yield keys[i]
+
+
+class SymbolIndex:
+    """
+    In-memory autocomplete index over the users' Security rows and the
+    Symbol rows remembered from provider searches, one entry per
+    (code, exchange, api_source).
+
+    `search` ranks exact code matches, then code prefixes, then prefixes of
+    the ISIN, name or a word of the name (binary search in sorted key
+    lists), then fuzzy matches by the share of the query's trigrams found in
+    code / name / ISIN.
+
+    Like FxRateMatrix: `SymbolIndex.current()` is the shared instance of
+    the process, rebuilt after `SymbolIndex.invalidate()` in any process
+    (Security changes). Symbols remembered from searches are added in place
+    (`add`); other processes pick them up every SYMBOL_INDEX_REFRESH seconds
+    from the Symbol rows updated since, without a rebuild.
+    """
+
+    VERSION_KEY = "symbol_index_version"
+
+    _current = None
+    _current_version = None
+    _checked_at = None  # time.monotonic() của lần tìm Symbol mới gần nhất
+    _synced_at = None   # Symbol.updated_at đã có trong index đến thời điểm này
+
+    def __init__(self, entries):
+        # entries: [{field: value}] theo SYMBOL_FIELDS
+        self.entries = []
+        self.keys = set()
+        self.codes = []
+        self.words = []
+        self.postings = defaultdict(list)
+        self.lock = threading.Lock()
+        for entry in entries:
+            self._index(entry, list.append)
+        self.codes.sort()
+        self.words.sort()
+
+    def _index(self, entry, put):
+        i = len(self.entries)
+        self.entries.append(entry)
+        self.keys.add((entry["code"].upper(), entry["exchange"].upper(), entry["api_source"]))
+
+        code, name, isin = entry["code"].casefold(), entry["name"].casefold(), entry["isin"].casefold()
+        put(self.codes, (code, i))
+        for word in {name, isin, *name.split()} - {"", code}:
+            put(self.words, (word, i))
+
+        grams = _trigrams(code) | _trigrams(name) | (_trigrams(isin) if isin else set())
+        for gram in grams:
+            self.postings[gram].append(i)
+
+    def add(self, entries):
+        """Index the `entries` not indexed yet (binary insertion, no rebuild); returns how many."""
+        added = 0
+        with self.lock:
+            for entry in entries:
+                if (entry["code"].upper(), entry["exchange"].upper(), entry["api_source"]) not in self.keys:
+                    self._index(entry, insort)
+                    added += 1
+        return added
+
+    @classmethod
+    def load(cls):
+        entries = {}
+        # Security của user ghi đè Symbol từ provider (đã được chọn, có ISIN...)
+        rows = list(Symbol.objects.values(*SYMBOL_FIELDS)) + list(
+            Security.objects.values("code", "exchange", "name", "isin", "type", "api_source").distinct()
+        )
+        for row in rows:
+            entry = _entry(row)
+            entries[entry["code"].upper(), entry["exchange"].upper(), entry["api_source"]] = entry
+        return cls(list(entries.values()))
+
+    @classmethod
+    def current(cls):
+        version = shared_version(cls.VERSION_KEY)
+        if cls._current is None or cls._current_version != version:
+            cls._synced_at = timezone.now()
+            cls._current = cls.load()
+            cls._current_version = version
+            cls._checked_at = time.monotonic()
+        elif time.monotonic() - cls._checked_at >= settings.SYMBOL_INDEX_REFRESH:
+            cls._checked_at = time.monotonic()
+            # Lùi thêm một chu kỳ: dòng commit muộn hơn updated_at của nó vẫn được thấy
+            since = cls._synced_at - timedelta(seconds=settings.SYMBOL_INDEX_REFRESH)
+            cls._synced_at = timezone.now()
+            cls._current.add(map(_entry, Symbol.objects.filter(updated_at__gte=since).values(*SYMBOL_FIELDS)))
+        return cls._current
+
+    @classmethod
+    def invalidate(cls):
+        cls._current = None
+        bump_shared_version(cls.VERSION_KEY)
+
+    def search(self, query, limit=10):
+        """Best `limit` entries for `query`, each with its `score` (1 = exact code)."""
+        query = normalize_query(query)
+        if not query:
+            return []
+        with self.lock:  # `add` có thể đang chèn từ thread khác
+            return self._search(query, limit)
+
+    def _search(self, query, limit):
+        ranked = {}
+        # Mã trùng khớp (1.0) rồi mã bắt đầu bằng query (0.9), sau đó ISIN / tên / từ trong tên (0.8)
+        for code, entry in _prefixed(self.codes, query):
+            ranked[entry] = 1.0 if code == query else 0.9
+            if len(ranked) >= limit:
+                break
+        for _, entry in _prefixed(self.words, query):
+            if len(ranked) >= limit:
+                break
+            ranked.setdefault(entry, 0.8)
+
+        # Fuzzy: tỷ lệ trigram của query có trong code / name / ISIN; 1-2 ký tự thì chỉ prefix.
+        # Đã đủ `limit` kết quả prefix thì fuzzy (điểm ≤ 0.7) không lọt vào top → bỏ qua
+        if len(query) >= 3 and len(ranked) < limit:
+            grams = _trigrams(query)
+            need = settings.SYMBOL_INDEX_MIN_SIMILARITY * len(grams)
+            shared = Counter(chain.from_iterable(self.postings.get(gram, ()) for gram in grams))
+            for entry, count in shared.items():
+                if count >= need and entry not in ranked:
+                    ranked[entry] = 0.7 * count / len(grams)
+
+        best = heapq.nsmallest(limit, ranked.items(), key=lambda item: (-item[1], len(self.entries[item[0]]["code"])))
+        return [{**self.entries[entry], "score": round(score, 3)} for entry, score in best]
+
+
+def remember_symbols(results):
+    """Store provider search results ({provider: [result]}) new to the index as Symbol rows."""
+    index = SymbolIndex.current()
+    new = {}
+    for items in results.values():
+        for item in items:
+            key = (item["code"].upper(), item["exchange"].upper(), item["api_source"])
+            if item["code"] and key not in index.keys:
+                new[key] = {field: (item.get(field) or "")[:Symbol._meta.get_field(field).max_length]
+                            for field in SYMBOL_FIELDS}
+    if not new:
+        return 0
+
+    Symbol.objects.bulk_create(
+        [Symbol(**row) for row in new.values()],
+        update_conflicts=True,
+        unique_fields=["code", "exchange", "api_source"],
+        update_fields=["name", "isin", "type", "currency", "country", "updated_at"],
+    )
+    # Không bump version: process khác thấy các mã mới ở lần refresh kế tiếp
+    index.add(map(_entry, new.values()))
+    return len(new)
+
+
+def autocomplete(query, keys=None, limit=10):
+    """
+    Local index first; the network providers (`search_securities`) are only
+    asked when it has fewer than SYMBOL_INDEX_MIN_HITS hits and no exact
+    code match, and what they return is remembered for the next time. → (results, source, timed_out)
+    """
+    hits = SymbolIndex.current().search(query, limit)
+    if len(hits) >= min(limit, settings.SYMBOL_INDEX_MIN_HITS) or (hits and hits[0]["score"] == 1):
+        return hits, "local", []
+
+    results, timed_out = search_securities(query, keys)
+    remember_symbols(results)
+    seen = {(hit["code"].upper(), hit["exchange"].upper(), hit["api_source"]) for hit in hits}
+    for items in results.values():
+        for item in items:
+            key = (item["code"].upper(), item["exchange"].upper(), item["api_source"])
+            if key not in seen and len(hits) < limit:
+                seen.add(key)
+                hits.append({**{field: item.get(field) or "" for field in SYMBOL_FIELDS}, "score": None})
+    return hits, "network", timed_out
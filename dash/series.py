@@ -0,0 +1,261 @@
+import time
+from bisect import bisect_right
+from collections import defaultdict
+from datetime import date, timedelta
+from decimal import Decimal
+
+from django.core.cache import cache
+
+from .models import Instrument, InstrumentPrice, Security, TradeEntry, TradeExit
+
+
+def shared_version(key):
+    """
+    Version counter `key` of the shared cache. A missing key (never set, or
+    culled / evicted) starts again from the current time in µs, never from a
+    value a process or a cache key may already have seen.
+    """
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, time.time_ns() // 1000, timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def bump_shared_version(key):
+    """Move `key` to a new version; returns it, or None when the key had to be re-seeded."""
+    try:
+        return cache.incr(key)
+    except ValueError:  # chưa có hoặc đã bị cull
+        cache.add(key, time.time_ns() // 1000, timeout=None)
+        return None
+
+
+class PositionTimeline:
+    """
+    Quantity held per security over time, built from a single load of the
+    trade entries and their exits.
+
+    Each entry is a +quantity event on its date, each exit a -quantity event.
+    An exit never counts before its entry (same rule as
+    `TradeEntry.remaining_quantity_at`).
+    """
+
+    def __init__(self, events):
+        # events: iterable of (date, security_id, delta)
+        self.events = sorted(events, key=lambda e: e[0])
+        self.dates = [e[0] for e in self.events]
+
+    @classmethod
+    def from_entries(cls, entries):
+        """Build the timeline from a TradeEntry queryset (2 queries)."""
+        rows = list(entries.values_list("id", "security_id", "quantity", "date"))
+        by_id = {entry_id: (security_id, entry_date) for entry_id, security_id, _, entry_date in rows}
+
+        events = [(entry_date, security_id, quantity) for _, security_id, quantity, entry_date in rows]
+
+        exits = TradeExit.objects.filter(entry_id__in=by_id.keys()).values_list("entry_id", "quantity", "date")
+        for entry_id, quantity, exit_date in exits:
+            security_id, entry_date = by_id[entry_id]
+            events.append((max(exit_date, entry_date), security_id, -quantity))
+
+        return cls(events)
+
+    @classmethod
+    def for_account(cls, account):
+        return cls.from_entries(TradeEntry.objects.filter(account=account))
+
+    def holdings_on(self, on_date):
+        """Quantity per security held at the end of `on_date`."""
+        holdings = defaultdict(Decimal)
+        for _, security_id, delta in self.events[:bisect_right(self.dates, on_date)]:
+            holdings[security_id] += delta
+        return {sec_id: qty for sec_id, qty in holdings.items() if qty != 0}
+
+    def iter_holdings(self, start_date, end_date):
+        """
+        Yield (day, {security_id: quantity}) for every day in
+        [start_date, end_date], walking the event stream once.
+        """
+        holdings = defaultdict(Decimal)
+        i = 0
+        n = len(self.events)
+
+        # Trạng thái trước start_date
+        while i < n and self.dates[i] < start_date:
+            _, security_id, delta = self.events[i]
+            holdings[security_id] += delta
+            i += 1
+
+        current = start_date
+        while current <= end_date:
+            while i < n and self.dates[i] == current:
+                _, security_id, delta = self.events[i]
+                holdings[security_id] += delta
+                i += 1
+            yield current, {sec_id: qty for sec_id, qty in holdings.items() if qty != 0}
+            current += timedelta(days=1)
+
+    def security_ids(self):
+        return {security_id for _, security_id, _ in self.events}
+
+
+class PriceSeries:
+    """
+    Closing prices of one security loaded once and forward-filled into a
+    list indexed by day ordinal.
+
+    `price_on` answers exactly like `Security.price_on`: the latest close > 0
+    on or before the day, else the nearest future close, else None.
+    """
+
+    def __init__(self, rows):
+        # rows: (date, close) sorted by date, close > 0
+        self.closes = []
+        self.first = None
+        if not rows:
+            return
+
+        self.first = rows[0][0].toordinal()
+        self.closes = [None] * (rows[-1][0].toordinal() - self.first + 1)
+        for row_date, close in rows:
+            self.closes[row_date.toordinal() - self.first] = close
+
+        last_close = None
+        for i, close in enumerate(self.closes):
+            if close is None:
+                self.closes[i] = last_close
+            else:
+                last_close = close
+
+    @classmethod
+    def for_instruments(cls, instrument_ids):
+        """Load the series of several instruments in one query → {instrument_id: PriceSeries}."""
+        rows = defaultdict(list)
+        prices = (
+            InstrumentPrice.objects
+            .filter(instrument_id__in=instrument_ids, close__gt=0)
+            .order_by("instrument_id", "date")
+            .values_list("instrument_id", "date", "close")
+        )
+        for instrument_id, price_date, close in prices:
+            rows[instrument_id].append((price_date, close))
+        return {instrument_id: cls(rows[instrument_id]) for instrument_id in instrument_ids}
+
+    @classmethod
+    def for_securities(cls, security_ids):
+        """
+        Series of several securities → {security_id: PriceSeries}. Securities
+        on the same instrument share one series (2 queries).
+        """
+        instruments = dict(Security.objects.filter(pk__in=security_ids).values_list("pk", "instrument_id"))
+        series = cls.for_instruments({i for i in instruments.values() if i is not None})
+        return {security_id: series.get(instruments.get(security_id)) or cls([]) for security_id in security_ids}
+
+    @classmethod
+    def for_security(cls, security):
+        if security.instrument_id is None:
+            return cls([])
+        return cls.for_instruments([security.instrument_id])[security.instrument_id]
+
+    def __bool__(self):
+        return bool(self.closes)
+
+    def price_on(self, target_date):
+        if not self.closes:
+            return None
+        i = target_date.toordinal() - self.first
+        if i < 0:
+            return self.closes[0]
+        if i >= len(self.closes):
+            return self.closes[-1]
+        return self.closes[i]
+
+
+class FxRateMatrix:
+    """
+    Forward-filled daily rates of every currency against the USD pivot,
+    loaded from all FX instruments (`EUR=X`, `EURUSD=X`, `EURJPY=X`...) in
+    two queries. Every conversion is then an O(1) lookup by (currency, day):
+
+    - a stored direct pair (`utils_format_currency_pair`) wins,
+    - otherwise the rate is triangulated through USD (EUR→JPY = EUR→USD / JPY→USD),
+    - unknown currencies convert at 1, like `utils_convert_currency` always did.
+
+    Use `FxRateMatrix.current()` for the shared, cached instance and call
+    `FxRateMatrix.invalidate()` when FX prices are ingested.
+    """
+
+    PIVOT = "USD"
+    VERSION_KEY = "fx_matrix_version"
+
+    _current = None
+    _current_version = None
+
+    def __init__(self, pairs):
+        # pairs: {symbol: PriceSeries}
+        self.pairs = pairs
+        self.to_pivot = {}
+
+        # Ưu tiên giống utils_convert_currency: `EUR=X` (đảo ngược) trước `EURUSD=X`
+        for symbol, series in pairs.items():
+            code = symbol[:-2]
+            if len(code) == 6 and code.endswith(self.PIVOT) and series:
+                self.to_pivot.setdefault(code[:3], series)
+        for symbol, series in pairs.items():
+            code = symbol[:-2]
+            if len(code) == 3 and series:
+                inverse = [(date.fromordinal(series.first + i), Decimal("1") / close)
+                           for i, close in enumerate(series.closes)]
+                self.to_pivot[code] = PriceSeries(inverse)
+
+    @classmethod
+    def load(cls):
+        # Cùng mã ở nhiều nguồn: lấy instrument đầu tiên
+        instruments = {}
+        for pk, code in Instrument.objects.filter(code__endswith="=X").order_by("pk").values_list("pk", "code"):
+            instruments.setdefault(code.upper(), pk)
+
+        series = PriceSeries.for_instruments(instruments.values())
+        return cls({code: series[pk] for code, pk in instruments.items()})
+
+    @classmethod
+    def current(cls):
+        """Shared matrix, rebuilt when another process invalidated it."""
+        version = shared_version(cls.VERSION_KEY)
+        if cls._current is None or cls._current_version != version:
+            cls._current = cls.load()
+            cls._current_version = version
+        return cls._current
+
+    @classmethod
+    def invalidate(cls):
+        cls._current = None
+        bump_shared_version(cls.VERSION_KEY)
+
+    def pivot_rate(self, currency, day):
+        if currency == self.PIVOT:
+            return Decimal("1")
+        series = self.to_pivot.get(currency)
+        return series.price_on(day) if series else None
+
+    def rate(self, source, target, day):
+        source = source.upper()
+        target = target.upper()
+        if source == target:
+            return Decimal("1")
+
+        if target == self.PIVOT:
+            rate = self.pivot_rate(source, day)
+            return rate if rate else Decimal("1")
+
+        symbol = f"{target}=X" if source == self.PIVOT else f"{source}{target}=X"
+        direct = self.pairs.get(symbol)
+        if direct:
+            return direct.price_on(day)
+
+        source_rate = self.pivot_rate(source, day)
+        target_rate = self.pivot_rate(target, day)
+        if source_rate and target_rate:
+            return source_rate / target_rate
+        return Decimal("1")
@@ -1,13 +1,27 @@
 from django.contrib.auth.signals import user_logged_in
 from django.db.models.signals import post_save, post_delete, pre_delete
 from django.dispatch import receiver
-from .models import AccountBalance
-from .utils import utils_update_security_prices_for_user, utils_recalc_portfolio, utils_update_account
+from django.utils import timezone
+from .models import AccountBalance, Security, UserPreference
+from .utils import (
+    utils_bump_data_version,
+    utils_stale_instruments,
+    utils_user_instruments,
+    utils_schedule_portfolio_sync,
+    utils_update_account,
+)
+from .jobs import enqueue_recalc
+from .search import SymbolIndex
 from datetime import date as date_dt
 
 @receiver(user_logged_in)
 def on_user_login(sender, request, user, **kwargs):
-    utils_update_security_prices_for_user(user)
+    """
+    No fetching at login (prices are kept fresh by `manage.py refresh_prices`):
+    one query to check for stale instruments, handed to the workers if any.
+    """
+    if utils_stale_instruments(utils_user_instruments(user)):
+        enqueue_recalc('prices', user, timezone.now().date())
 
 #def _affected_accounts_and_date(instance):
 #    if isinstance(instance, (TradeEntry, TradeExit, Transaction)):
@@ -35,5 +49,22 @@ def on_user_login(sender, request, user, **kwargs):
 
 @receiver([post_save, post_delete], sender=AccountBalance)
 def sync_portfolio_on_balance_change(sender, instance, **kwargs):
-    """Whenever a balance row changes → refresh that day’s portfolio total."""
-    utils_recalc_portfolio(instance.account.user, instance.date)
+    """
+    Whenever a balance row changes → refresh the portfolio from that day.
+    Changes within a request / atomic block are merged into one ranged
+    recompute on commit.
+    """
+    utils_schedule_portfolio_sync(instance.account.user_id, instance.date)
+
+
+@receiver([post_save, post_delete], sender=Security)
+def refresh_symbol_index(sender, instance, **kwargs):
+    # Security mới / đổi tên → autocomplete build lại index
+    SymbolIndex.invalidate()
+
+
+@receiver([post_save, post_delete], sender=Security)
+@receiver(post_save, sender=UserPreference)
+def bump_chart_data_version(sender, instance, **kwargs):
+    # Tên mã / tiền tệ hiển thị đổi → chart cache cũ không còn đúng
+    utils_bump_data_version(instance.user_id)
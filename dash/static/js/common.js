@@ -81,3 +81,61 @@ function showConfirm({ title = 'Confirm', body = 'Are you sure?', onConfirm }) {
 
   modal.show();
 }
+
+// Chart data được giữ trong localStorage: lần sau chỉ tải các điểm mới / thay đổi
+// (`since` = nhãn cuối đã có, `version` = token của bản đã lưu)
+function mergeChartSeries(stored, delta, keep) {
+  const added = delta.labels.length;
+  const join = (old, values) =>
+    (old || Array(keep).fill(0)).slice(0, keep).concat(values || Array(added).fill(0));
+
+  const merged = { ...delta };
+  for (const [name, values] of Object.entries(delta)) {
+    if (Array.isArray(values)) {
+      merged[name] = join(stored[name], values);
+    } else if (values && typeof values === 'object') {
+      // datasets theo mã: mã mới / mã không còn trong delta được đệm 0
+      const old = stored[name] || {};
+      merged[name] = {};
+      for (const code of new Set([...Object.keys(old), ...Object.keys(values)])) {
+        merged[name][code] = join(old[code], values[code]);
+      }
+    }
+  }
+  return merged;
+}
+
+function loadChartSeries(url, params) {
+  const query = new URLSearchParams(params);
+  const storageKey = `chart:${url}?${query}`;
+  const maxPoints = Number(params.max_points) || Infinity;
+
+  let stored = null;
+  try {
+    stored = JSON.parse(localStorage.getItem(storageKey));
+  } catch (e) { /* bản lưu hỏng → tải lại toàn bộ */ }
+  // Delta không giảm mẫu lại phần đã lưu → quá nhiều điểm thì tải lại toàn bộ
+  if (stored && stored.data.labels.length && stored.data.labels.length <= 2 * maxPoints) {
+    query.set('since', stored.data.labels[stored.data.labels.length - 1]);
+    query.set('version', stored.version);
+  } else {
+    stored = null;
+  }
+
+  return fetch(`${url}?${query}`)
+    .then(res => res.json())
+    .then(delta => {
+      if (!delta.labels) return delta;  // lỗi (400...) → không lưu
+
+      let data = delta;
+      if (stored && delta.delta_from) {
+        // delta_from = null → server gửi lại toàn bộ series
+        const keep = stored.data.labels.filter(label => label < delta.delta_from).length;
+        data = mergeChartSeries(stored.data, delta, keep);
+      }
+      try {
+        localStorage.setItem(storageKey, JSON.stringify({ version: delta.version, data: data }));
+      } catch (e) { /* hết quota → chỉ không cache */ }
+      return data;
+    });
+}
@@ -1,8 +1,11 @@
 document.addEventListener("DOMContentLoaded", function () {
-  fetch("/api/portfolio/data/")
-    .then(res => res.json())
+  const canvas = document.getElementById('myChart');
+  // Không cần nhiều điểm hơn số pixel của canvas (server giảm mẫu bằng LTTB)
+  const params = { max_points: Math.max(canvas.clientWidth, 100) };
+
+  loadChartSeries('/api/portfolio/data/', params)
     .then(data => {
-      const ctx = document.getElementById('myChart').getContext('2d');
+      const ctx = canvas.getContext('2d');
 
       // Tạo màu cho cột: xanh lá nếu >= 0, đỏ nếu âm
       const barColors = data.transactions.map(v => v >= 0 ? 'rgba(0, 119, 0, 0.6)' : 'rgba(200, 0, 0, 0.6)');
@@ -1,8 +1,10 @@
 document.addEventListener("DOMContentLoaded", function () {
-  fetch("/api/holdings/data/")
-    .then(res => res.json())
+  const canvas = document.getElementById("holdingsEquityChart");
+  const params = { max_points: Math.max(canvas.clientWidth, 100) };
+
+  loadChartSeries('/api/holdings/data/', params)
     .then(data => {
-      const ctx = document.getElementById("holdingsEquityChart").getContext("2d");
+      const ctx = canvas.getContext("2d");
 
       const datasets = Object.entries(data.datasets).map(([name, values]) => ({
         label: name,
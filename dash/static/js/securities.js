@@ -85,88 +85,97 @@ document.addEventListener('click', function (e) {
     }
 });
 
+function renderSearchResults(tbody, rows, timedOut) {
+    // rows đã chuẩn hoá: code / exchange / name / type / currency / country / api_source
+    tbody.innerHTML = '';
+
+    rows.forEach((item, i) => {
+        tbody.insertAdjacentHTML('beforeend', `
+                <tr>
+                    <td>${i + 1}</td>
+                    <td>${item.code}</td>
+                    <td>${item.exchange}</td>
+                    <td>${item.name}</td>
+                    <td>${item.type}</td>
+                    <td>${item.currency}</td>
+                    <td>${item.country}</td>
+                    <td>${item.api_source}</td>
+                    <td><button class="btn btn-sm btn-link" id="btn-add_security" data-api="${item.api_source}">Add</button></td>
+                </tr>
+                `);
+    });
+
+    if (timedOut && timedOut.length) {
+        tbody.insertAdjacentHTML('beforeend',
+            `<tr><td colspan="9" class="text-center text-muted">No answer yet from ${timedOut.join(', ')}, press Enter again to retry</td></tr>`);
+    } else if (!rows.length) {
+        tbody.innerHTML = '<tr><td colspan="9" class="text-center">No results found</td></tr>';
+    }
+}
+
+// Chỉ request mới nhất (autocomplete hoặc Enter) được render: request cũ bị abort,
+// câu trả lời muộn không ghi đè kết quả mới hơn
+let searchController = null;
+let searchSeq = 0;
+
+function cancelSearch() {
+    if (searchController) searchController.abort();
+    searchController = null;
+    searchSeq++;
+}
+
+function fetchSearchResults(url, query, tbody, toRows) {
+    const params = new URLSearchParams({ q: query });
+    cancelSearch();
+    const controller = searchController = new AbortController();
+    const seq = searchSeq;
+
+    return fetch(`${url}?${params.toString()}`, { signal: controller.signal })
+        .then(res => {
+            if (!res.ok) throw new Error('Network response not ok');
+            return res.json();
+        })
+        .then(data => {
+            if (seq === searchSeq) renderSearchResults(tbody, toRows(data), data.timeout);
+        })
+        .catch(() => {
+            if (seq !== searchSeq) return;  // bị thay bởi request mới hơn
+            tbody.innerHTML = '<tr><td colspan="9" class="text-center text-danger">Error loading data</td></tr>';
+        });
+}
+
+// Gõ phím → autocomplete từ index local (chỉ hỏi provider khi quá ít kết quả)
+let autocompleteTimer = null;
+document.addEventListener('input', function (e) {
+    if (!e.target || e.target.id !== 'search-ticker') return;
+
+    const query = e.target.value.trim();
+    const tbody = document.getElementById('securities-table-body');
+    clearTimeout(autocompleteTimer);
+    if (!query) {
+        cancelSearch();
+        tbody.innerHTML = '';
+        return;
+    }
+    autocompleteTimer = setTimeout(() => {
+        fetchSearchResults('/api/security/autocomplete/', query, tbody, data => data.results || []);
+    }, 150);
+});
+
 document.addEventListener('keydown', function (e) {
-    // Check đúng input id và phím Enter
+    // Check đúng input id và phím Enter → tìm trên tất cả provider
     if (e.target && e.target.id === 'search-ticker' && (e.key === 'Enter' || e.keyCode === 13)) {
         e.preventDefault();
+        clearTimeout(autocompleteTimer);
         const query = e.target.value.trim();
         const tbody = document.getElementById('securities-table-body');
 
         if (query.length < 2) {
+            cancelSearch();
             tbody.innerHTML = '';
             return;
         }
 
-        // Build query param string
-        const params = new URLSearchParams({ q: query });
-
-        fetch(`/api/security/search/?${params.toString()}`)
-            .then(res => {
-                if (!res.ok) throw new Error('Network response not ok');
-                return res.json();
-            })
-            .then(data => {
-                tbody.innerHTML = '';
-
-                const yahoo = data.yahoo || [];
-                const eodhd = data.eodhd || [];
-
-                if (Array.isArray(yahoo)) {
-                    yahoo.forEach((item, i) => {
-                        const code = item.symbol || '';
-                        const exchange = item.exchange || '';
-                        const name = item.shortname || item.longname || '';
-                        const type = item.quoteType || '';
-                        const currency = item.currency || '';
-                        const country = item.country || '';
-
-                        tbody.insertAdjacentHTML('beforeend', `
-                <tr>
-                    <td>${i + 1}</td>
-                    <td>${code}</td>
-                    <td>${exchange}</td>
-                    <td>${name}</td>
-                    <td>${type}</td>
-                    <td>${currency}</td>
-                    <td>${country}</td>
-                    <td>yahoo</td>
-                    <td><button class="btn btn-sm btn-link" id="btn-add_security" data-api="yahoo">Add</button></td>
-                </tr>
-                `);
-                    });
-                }
-
-                if (Array.isArray(eodhd)) {
-                    eodhd.forEach((item, j) => {
-                        const code = item.Code || '';
-                        const exchange = item.Exchange || '';
-                        const name = item.Name || '';
-                        const type = item.Type || '';
-                        const currency = item.Currency || '';
-                        const country = item.Country || '';
-
-                        tbody.insertAdjacentHTML('beforeend', `
-                <tr>
-                    <td>${yahoo.length + j + 1}</td>
-                    <td>${code}</td>
-                    <td>${exchange}</td>
-                    <td>${name}</td>
-                    <td>${type}</td>
-                    <td>${currency}</td>
-                    <td>${country}</td>
-                    <td>eodhd</td>
-                    <td><button class="btn btn-sm btn-link" id="btn-add_security" data-api="eodhd">Add</button></td>
-                </tr>
-                `);
-                    });
-                }
-
-                if (!yahoo.length && !eodhd.length) {
-                    tbody.innerHTML = '<tr><td colspan="9" class="text-center">No results found</td></tr>';
-                }
-            })
-            .catch(() => {
-                tbody.innerHTML = '<tr><td colspan="9" class="text-center text-danger">Error loading data</td></tr>';
-            });
+        fetchSearchResults('/api/security/search/', query, tbody, data => Object.values(data.results || {}).flat());
     }
 });
@@ -1,3 +1,1037 @@
-from django.test import TestCase
+import asyncio
+import copy
+import io
+import json
+import requests
+import tempfile
+import threading
+import time
+from datetime import date, datetime, timedelta, timezone
+from pathlib import Path
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import skipUnless
+from unittest.mock import patch
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from . import jobs, utils
+from .markets import last_session_date
+from .providers import get_provider
+from .scheduler import CircuitOpenError, TokenBucket, scheduler
+from .series import FxRateMatrix, shared_version
+from .search import SymbolIndex, autocomplete, remember_symbols, search_cache, search_securities
+from .models import (
+    Account, AccountBalance, Currency, DailyHoldingEquity, Instrument, InstrumentPrice, PortfolioPerformance, RecalcJob, Security,
+    Symbol, TradeEntry, TradeExit, Transaction, UserAPIKey, UserPreference,
+)
+
+PROVIDER_FIXTURES = Path(__file__).parent / "testdata" / "providers"
+
+
+class PortfolioSyncCoalescingTests(TestCase):
+    days = 30
+
+    def setUp(self):
+        usd = Currency.objects.create(code="USD", name="US Dollar", symbol="$")
+        self.user = User.objects.create_user("alice", password="x")
+        UserPreference.objects.create(user=self.user, currency=usd)
+        self.account = Account.objects.create(user=self.user, name="Broker", type="broker", currency=usd)
+        self.start = date.today() - timedelta(days=self.days - 1)
+
+    def save_balances(self):
+        for i in range(self.days):
+            AccountBalance.objects.create(
+                account=self.account,
+                date=self.start + timedelta(days=i),
+                balance=Decimal(i),
+            )
+
+    def test_balance_saves_coalesce_into_one_ranged_recompute(self):
+        with patch("dash.utils.utils_build_portfolio", wraps=utils.utils_build_portfolio) as build:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.save_balances()
+
+        build.assert_called_once_with(self.user, self.start)
+        self.assertEqual(PortfolioPerformance.objects.filter(user=self.user).count(), self.days)
+        self.assertEqual(
+            PortfolioPerformance.objects.get(user=self.user, date=date.today()).balance,
+            Decimal(self.days - 1),
+        )
+
+    def test_query_count_before_and_after(self):
+        # Trước: mỗi lần save → recompute portfolio của ngày đó
+        with patch("dash.signals.utils_schedule_portfolio_sync"):
+            with CaptureQueriesContext(connection) as before:
+                self.save_balances()
+                for i in range(self.days):
+                    utils.utils_recalc_portfolio(self.user, self.start + timedelta(days=i))
+            AccountBalance.objects.all().delete()
+        PortfolioPerformance.objects.all().delete()
+
+        # Sau: gom lại, 1 lần build từ ngày sớm nhất khi commit
+        with CaptureQueriesContext(connection) as after:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.save_balances()
+
+        self.assertLess(len(after), len(before) / 3)
+        self.assertEqual(PortfolioPerformance.objects.filter(user=self.user).count(), self.days)
+
+    def test_defer_scope_runs_once_outside_atomic_block(self):
+        with patch("dash.utils.utils_build_portfolio") as build, \
+                patch.object(connection, "in_atomic_block", False):
+            with utils.utils_defer_portfolio_sync():
+                utils.utils_schedule_portfolio_sync(self.user.id, self.start + timedelta(days=5))
+                utils.utils_schedule_portfolio_sync(self.user.id, self.start)
+                build.assert_not_called()
+
+        build.assert_called_once_with(self.user, self.start)
+
+    def test_failed_scope_drops_its_pending_syncs(self):
+        with patch("dash.utils.utils_build_portfolio") as build:
+            with self.assertRaises(ValueError), utils.utils_defer_portfolio_sync():
+                utils.utils_schedule_portfolio_sync(self.user.id, self.start)
+                raise ValueError
+            with self.captureOnCommitCallbacks(execute=True) as callbacks:
+                utils.utils_schedule_portfolio_sync(self.user.id, date.today())
+                utils.utils_schedule_portfolio_sync(self.user.id, date.today() - timedelta(days=1))
+
+        self.assertEqual(len(callbacks), 1)  # một callback cho cả transaction
+        build.assert_called_once_with(self.user, date.today() - timedelta(days=1))
+
+
+class UpdateAccountSyncTests(TransactionTestCase):
+    def test_replay_outside_a_transaction_builds_the_portfolio_once(self):
+        usd = Currency.objects.create(code="USD", name="US Dollar", symbol="$")
+        user = User.objects.create_user("abby", password="x")
+        UserPreference.objects.create(user=user, currency=usd)
+        account = Account.objects.create(user=user, name="Broker", type="broker", currency=usd)
+        start = date.today() - timedelta(days=5)
+        Transaction.objects.create(account=account, user=user, type="deposit", amount=Decimal(100), date=start)
+        with patch("dash.utils.utils_build_portfolio"):
+            # dòng sau ngày cuối → bị xoá (post_delete xin sync) khi replay
+            AccountBalance.objects.create(account=account, date=date.today() + timedelta(days=3))
+
+        with patch("dash.utils.utils_build_portfolio") as build:
+            utils.utils_update_account(account, start)
+
+        build.assert_called_once_with(user, start)
+
+
+class LedgerDeltaTests(TestCase):
+    """Delta propagation (utils_sync_ledger_change) must end where a full replay does."""
+
+    def setUp(self):
+        usd = Currency.objects.create(code="USD", name="US Dollar", symbol="$")
+        self.user = User.objects.create_user("mona", password="x")
+        UserPreference.objects.create(user=self.user, currency=usd)
+        self.account = Account.objects.create(user=self.user, name="Broker", type="broker", currency=usd)
+        self.security = Security.objects.create(user=self.user, code="AAPL", exchange="US", name="Apple")
+        self.start = date.today() - timedelta(days=20)
+        self.deposit = Transaction.objects.create(account=self.account, user=self.user, type="deposit",
+                                                  amount=Decimal(1000), date=self.start)
+        self.entry = TradeEntry.objects.create(user=self.user, account=self.account, security=self.security,
+                                               quantity=Decimal(5), price=Decimal(100), fee=Decimal(1),
+                                               date=self.day(3))
+        utils.utils_update_account(self.account, self.start)
+
+    def day(self, n):
+        return self.start + timedelta(days=n)
+
+    def change(self, obj, **fields):
+        old = copy.copy(obj)
+        for name, value in fields.items():
+            setattr(obj, name, value)
+        obj.save()
+        utils.utils_sync_ledger_change(old, obj)
+
+    def assert_matches_replay(self):
+        fields = ("balance", "fee", "tax", "principal", "float")
+        stored = {row.date: tuple(getattr(row, f) for f in fields)
+                  for row in AccountBalance.objects.filter(account=self.account)}
+        replayed = {row.date: tuple(getattr(row, f) for f in fields)
+                    for row in utils.utils_replay_ledger(self.account, self.start)}
+        self.assertEqual(stored, replayed)
+
+    def test_edits_moves_creates_and_deletes_match_a_full_replay(self):
+        with patch("dash.utils.utils_update_account", wraps=utils.utils_update_account) as replay:
+            self.change(self.deposit, amount=Decimal(1500), fee=Decimal(2))       # sửa số tiền
+            self.assert_matches_replay()
+            self.change(self.deposit, date=self.day(2))                           # dời ngày
+            self.assert_matches_replay()
+            self.change(self.entry, price=Decimal(110), tax=Decimal(3))           # giá / thuế lệnh mua
+            self.assert_matches_replay()
+
+            interest = Transaction.objects.create(account=self.account, user=self.user, type="interest",
+                                                  amount=Decimal(7), date=self.day(10))
+            utils.utils_sync_ledger_change(None, interest)                         # tạo mới
+            self.assert_matches_replay()
+            old = copy.copy(interest)
+            interest.delete()
+            utils.utils_sync_ledger_change(old, None)                              # xoá
+            self.assert_matches_replay()
+            replay.assert_not_called()  # chỉ dịch chuyển, không replay
+
+            self.change(self.entry, date=self.day(5))                             # dời vị thế → replay
+            self.assert_matches_replay()
+            exit_ = TradeExit.objects.create(user=self.user, entry=self.entry, quantity=Decimal(2),
+                                             price=Decimal(120), fee=Decimal(1), date=self.day(12))
+            utils.utils_sync_ledger_change(None, exit_)
+            self.assert_matches_replay()
+            self.assertEqual(replay.call_count, 2)
+
+    def test_moving_an_exit_to_another_entry_recalcs_both_securities(self):
+        msft = Security.objects.create(user=self.user, code="MSFT", exchange="US", name="Microsoft")
+        other = TradeEntry.objects.create(user=self.user, account=self.account, security=msft,
+                                          quantity=Decimal(5), price=Decimal(50), date=self.day(4))
+        exit_ = TradeExit.objects.create(user=self.user, entry=self.entry, quantity=Decimal(1),
+                                         price=Decimal(120), date=self.day(8))
+        self.client.force_login(self.user)
+
+        response = self.client.put(reverse("api_exit_update", args=[exit_.pk]), content_type="application/json",
+                                   data={"entry": other.pk, "price": "120", "quantity": "1", "fee": "0",
+                                         "tax": "0", "date": self.day(6).isoformat()})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            set(RecalcJob.objects.filter(kind="holdings").values_list("security__code", "start_date")),
+            {("AAPL", self.day(6)), ("MSFT", self.day(6))},
+        )
+
+
+class BalanceStorageTests(TestCase):
+    def setUp(self):
+        usd = Currency.objects.create(code="USD", name="US Dollar", symbol="$")
+        user = User.objects.create_user("lena", password="x")
+        self.daily, self.changes = (
+            Account.objects.create(user=user, name=name, type="broker", currency=usd) for name in ("Daily", "Changes")
+        )
+        self.start = date(2024, 3, 1)
+
+    def write(self, first_day, balances):
+        for account, storage in ((self.daily, "daily"), (self.changes, "changes")):
+            rows = [AccountBalance(account=account, date=self.start + timedelta(days=first_day + i),
+                                   balance=Decimal(b), principal=Decimal(100)) for i, b in enumerate(balances)]
+            utils.utils_write_balances(account, rows, storage=storage)
+
+    def assert_same_series(self, days):
+        series = {
+            account.pk: [(day, bal[account.pk].balance if account.pk in bal else None) for day, bal in
+                         utils.utils_iter_balances([account], self.start - timedelta(days=1),
+                                                   self.start + timedelta(days=days))]
+            for account in (self.daily, self.changes)
+        }
+        self.assertEqual(series[self.changes.pk], series[self.daily.pk])
+
+    def test_change_points_read_back_like_daily_rows(self):
+        self.write(0, [5] * 5 + [8] * 7 + [3] * 8)
+
+        self.assertEqual(self.daily.balances.count(), 20)
+        # Ngày đổi (0, 5, 12) + dòng cuối đánh dấu chuỗi tới đâu
+        self.assertEqual(list(self.changes.balances.values_list("date", flat=True)),
+                         [self.start + timedelta(days=d) for d in (0, 5, 12, 19)])
+        self.assertEqual(utils.utils_balances_on([self.changes], self.start + timedelta(days=9))[self.changes.pk].balance,
+                         Decimal(8))
+        self.assert_same_series(22)
+
+        # Ghi lại từ giữa chuỗi: các change point cũ phía sau bị xoá, chuỗi ngắn lại
+        self.write(7, [8, 8, 9, 9])
+        self.assertFalse(self.changes.balances.filter(date=self.start + timedelta(days=12)).exists())
+        self.assert_same_series(22)
+
+
+class RecalcJobQueueTests(TestCase):
+    def setUp(self):
+        usd = Currency.objects.create(code="USD", name="US Dollar", symbol="$")
+        self.user = User.objects.create_user("jim", password="x")
+        self.accounts = [
+            Account.objects.create(user=self.user, name=f"Broker {i}", type="broker", currency=usd) for i in range(2)
+        ]
+        self.day = date(2024, 5, 10)
+
+    def test_pending_job_absorbs_requests_with_the_earliest_start(self):
+        job = jobs.enqueue_recalc("account", self.user, self.day, account=self.accounts[0])
+        self.assertEqual(jobs.enqueue_recalc("account", self.user, self.day - timedelta(days=3),
+                                             account=self.accounts[0]), job)
+        jobs.enqueue_recalc("account", self.user, self.day + timedelta(days=3), account=self.accounts[0])
+
+        job.refresh_from_db()
+        self.assertEqual(job.start_date, self.day - timedelta(days=3))
+        self.assertEqual(RecalcJob.objects.count(), 1)
+        # Job đang chạy không nhận thêm → job mới
+        RecalcJob.objects.update(status="running")
+        self.assertNotEqual(jobs.enqueue_recalc("account", self.user, self.day, account=self.accounts[0]), job)
+
+    def test_claim_skips_accounts_already_running(self):
+        first = jobs.enqueue_recalc("account", self.user, self.day, account=self.accounts[0])
+        self.assertEqual(jobs.claim_next_job(), first)
+        again = jobs.enqueue_recalc("account", self.user, self.day, account=self.accounts[0])
+        other = jobs.enqueue_recalc("account", self.user, self.day, account=self.accounts[1])
+
+        self.assertEqual(jobs.claim_next_job(), other)
+        self.assertIsNone(jobs.claim_next_job())  # `again` chờ `first` xong
+
+        RecalcJob.objects.filter(pk=first.pk).update(status="done")
+        self.assertEqual(jobs.claim_next_job(), again)
+
+    def test_requeue_stale_jobs_and_status(self):
+        stale = jobs.enqueue_recalc("account", self.user, self.day, account=self.accounts[0])
+        fresh = jobs.enqueue_recalc("account", self.user, self.day, account=self.accounts[1])
+        RecalcJob.objects.update(status="running")
+        RecalcJob.objects.filter(pk=stale.pk).update(updated_at=datetime.now(timezone.utc) - timedelta(hours=1))
+
+        self.assertEqual(jobs.requeue_stale_jobs(timedelta(minutes=30)), 1)
+        stale.refresh_from_db()
+        fresh.refresh_from_db()
+        self.assertEqual((stale.status, fresh.status), ("pending", "running"))
+
+        # job của user khác không tính vào `ahead`
+        jobs.enqueue_recalc("prices", User.objects.create_user("other", password="x"), self.day)
+        queued = jobs.enqueue_recalc("holdings", self.user, self.day)
+        status = jobs.job_status(queued)
+        self.assertEqual((status["status"], status["ahead"], status["start_date"]), ("pending", 1, "2024-05-10"))
+        self.assertEqual(jobs.job_status(fresh)["ahead"], 0)
+
+    def test_progress_reports_the_share_of_days_computed(self):
+        start = date.today() - timedelta(days=39)
+        job = jobs.enqueue_recalc("account", self.user, start, account=self.accounts[0])
+
+        seen = []
+        utils.utils_update_account(self.accounts[0], start, progress=lambda done, total: seen.append((done, total)))
+        self.assertEqual((seen[0], seen[-1], len(seen)), ((0, 40), (39, 40), 40))
+
+        report = jobs._progress_reporter(job)
+        report(10, 40)
+        report(11, 40)  # < PROGRESS_STEP so với lần ghi trước → không ghi
+        self.assertEqual(jobs.job_status(RecalcJob.objects.get(pk=job.pk))["progress"], 25)
+
+        jobs.run_job(jobs.claim_next_job())
+        self.assertEqual(jobs.job_status(RecalcJob.objects.get(pk=job.pk))["progress"], 100)
+
+
+@skipUnless(connection.vendor == "postgresql", "SKIP LOCKED needs PostgreSQL")
+class RecalcJobSkipLockedTests(TransactionTestCase):
+    def test_claim_skips_a_job_locked_by_another_worker(self):
+        usd = Currency.objects.create(code="USD", name="US Dollar", symbol="$")
+        user = User.objects.create_user("kim", password="x")
+        accounts = [Account.objects.create(user=user, name=f"B{i}", type="broker", currency=usd) for i in range(2)]
+        first, second = (jobs.enqueue_recalc("account", user, date(2024, 1, 1), account=a) for a in accounts)
+
+        locked, release = threading.Event(), threading.Event()
+
+        def other_worker():
+            # Worker khác đang claim `first`: giữ row lock cho đến khi được thả
+            with transaction.atomic():
+                RecalcJob.objects.select_for_update().get(pk=first.pk)
+                locked.set()
+                release.wait(10)
+            connection.close()
+
+        thread = threading.Thread(target=other_worker)
+        thread.start()
+        try:
+            self.assertTrue(locked.wait(10))
+            self.assertEqual(jobs.claim_next_job(), second)
+        finally:
+            release.set()
+            thread.join()
+
+
+@skipUnless(connection.vendor == "postgresql", "row locks need PostgreSQL")
+class AccountLockTests(TransactionTestCase):
+    def test_edit_during_a_replay_waits_for_it(self):
+        usd = Currency.objects.create(code="USD", name="US Dollar", symbol="$")
+        user = User.objects.create_user("lee", password="x")
+        account = Account.objects.create(user=user, name="Broker", type="broker", currency=usd)
+        start = date.today() - timedelta(days=5)
+        deposit = Transaction.objects.create(account=account, user=user, type="deposit", amount=Decimal(100), date=start)
+        utils.utils_update_account(account, start)
+
+        read, release = threading.Event(), threading.Event()
+        replay_ledger = utils.utils_replay_ledger
+
+        def paused_replay(*args):
+            rows = replay_ledger(*args)
+            read.set()  # worker đã đọc ledger, chưa ghi
+            release.wait(10)
+            return rows
+
+        def worker():
+            utils.utils_update_account(account, start)
+            connection.close()
+
+        def edit():
+            old = copy.copy(deposit)
+            with utils.utils_lock_accounts(deposit):
+                deposit.amount = Decimal(250)
+                deposit.save()
+                utils.utils_sync_ledger_change(old, deposit)
+            connection.close()
+
+        with patch("dash.utils.utils_replay_ledger", paused_replay):
+            replaying = threading.Thread(target=worker)
+            replaying.start()
+            self.assertTrue(read.wait(10))
+            editing = threading.Thread(target=edit)
+            editing.start()
+            editing.join(0.5)
+            self.assertTrue(editing.is_alive())  # chờ lock của account
+            release.set()
+            replaying.join()
+            editing.join()
+
+        self.assertEqual(set(AccountBalance.objects.filter(account=account).values_list("balance", flat=True)),
+                         {Decimal(250)})
+
+
+@skipUnless(connection.vendor == "postgresql", "COPY needs PostgreSQL")
+class PriceCopyTests(TestCase):
+    def test_large_load_goes_through_copy_and_upserts(self):
+        instrument = Instrument.objects.create(code="AAPL", exchange="US")
+        start = date(2024, 1, 1)
+
+        def load(close):
+            bars = [{"date": start + timedelta(days=i), "close": close, "volume": i} for i in range(30)]
+            return utils.utils_store_prices({instrument.pk: bars})
+
+        with patch("dash.utils.PRICE_COPY_THRESHOLD", 20), patch("dash.utils._copy_prices", wraps=utils._copy_prices) as copy:
+            self.assertEqual(load(1.5), 30)
+            self.assertEqual(load(2.5), 30)  # lần 2: ON CONFLICT cập nhật
+        self.assertEqual(copy.call_count, 2)
+
+        prices = InstrumentPrice.objects.filter(instrument=instrument)
+        self.assertEqual(prices.count(), 30)
+        self.assertEqual(set(prices.values_list("close", flat=True)), {Decimal("2.5")})
+
+
+class ChartCacheTests(TestCase):
+    def setUp(self):
+        usd = Currency.objects.create(code="USD", name="US Dollar", symbol="$")
+        self.user = User.objects.create_user("hana", password="x")
+        UserPreference.objects.create(user=self.user, currency=usd)
+        self.account = Account.objects.create(user=self.user, name="Broker", type="broker", currency=usd)
+        self.client.force_login(self.user)
+
+    def chart(self):
+        return self.client.get(reverse("api_portfolio_chart")).json()
+
+    def holdings(self, **params):
+        response = self.client.get(reverse("api_holdings_data"), params)
+        return json.loads(b"".join(response.streaming_content))
+
+    def test_chart_is_cached_until_the_data_changes(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            AccountBalance.objects.create(account=self.account, date=date.today(), balance=Decimal("100"))
+        self.assertEqual(self.chart()["equity"], [100.0])
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.chart()["equity"], [100.0])
+        self.assertFalse([q for q in queries if "portfolioperformance" in q["sql"]])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            AccountBalance.objects.filter(account=self.account).update(balance=Decimal("250"))
+            utils.utils_schedule_portfolio_sync(self.user.id, date.today())
+        self.assertEqual(self.chart()["equity"], [250.0])
+
+    def test_monthly_rollup_keeps_period_end_values_and_sums_transactions(self):
+        start = date(2024, 1, 1)
+        PortfolioPerformance.objects.bulk_create([
+            PortfolioPerformance(user=self.user, date=start + timedelta(days=i), balance=Decimal(i),
+                                 principal=Decimal(10), transaction=Decimal(1))
+            for i in range(366)
+        ])
+
+        data = self.client.get(reverse("api_portfolio_chart"),
+                               {"from": "2024-02-10", "to": "2024-04-15", "interval": "month"}).json()
+
+        self.assertEqual(data["labels"], ["2024-02-29", "2024-03-31", "2024-04-15"])
+        self.assertEqual(data["equity"], [59.0, 90.0, 105.0])
+        self.assertEqual(data["transactions"], [20.0, 31.0, 15.0])
+        self.assertEqual(len(self.client.get(reverse("api_portfolio_chart"), {"interval": "week"}).json()["labels"]), 53)
+        self.assertEqual(self.client.get(reverse("api_portfolio_chart"), {"interval": "year"}).status_code, 400)
+
+        security = Security.objects.create(user=self.user, code="AAPL", exchange="US", name="Apple")
+        DailyHoldingEquity.objects.bulk_create([
+            DailyHoldingEquity(user=self.user, security=security, date=start + timedelta(days=i),
+                               equity=Decimal(i), currency="USD")
+            for i in range(60)
+        ])
+        data = self.holdings(interval="month")
+        self.assertEqual(data["labels"], ["2024-01-31", "2024-02-29"])
+        self.assertEqual(data["datasets"]["AAPL"], [30.0, 59.0])
+
+    def test_holdings_pivot_converts_fx_and_pads_missing_days(self):
+        start = date(2024, 3, 1)
+        fx = Instrument.objects.create(code="EURUSD=X", exchange="FX")
+        InstrumentPrice.objects.create(instrument=fx, date=start, close=Decimal("1.5"), adjusted_close=Decimal("1.5"))
+        FxRateMatrix.invalidate()
+        aapl = Security.objects.create(user=self.user, code="AAPL", exchange="US", name="Apple")
+        sap = Security.objects.create(user=self.user, code="SAP", exchange="XETRA", name="SAP")
+        DailyHoldingEquity.objects.bulk_create(
+            [DailyHoldingEquity(user=self.user, security=aapl, date=start + timedelta(days=i),
+                                equity=Decimal(10), currency="USD") for i in range(200)]
+            + [DailyHoldingEquity(user=self.user, security=sap, date=start + timedelta(days=i),
+                                  equity=Decimal(2), currency="EUR") for i in range(1, 200)]
+        )
+
+        with CaptureQueriesContext(connection) as queries:
+            data = self.holdings()
+        # Một query cho mọi dòng holdings, không query lại theo dòng / mã
+        self.assertEqual(len([q for q in queries if "dash_dailyholdingequity" in q["sql"]]), 1)
+        self.assertFalse([q for q in queries if 'FROM "dash_security"' in q["sql"]])
+        self.assertEqual(len(data["labels"]), 200)
+        self.assertEqual(data["datasets"]["AAPL"][:2], [10.0, 10.0])
+        self.assertEqual(data["datasets"]["SAP"][:2], [0.0, 3.0])
+        self.assertEqual(self.holdings(), data)  # từ cache
+
+    def test_max_points_downsamples_and_keeps_the_drawdown(self):
+        start = date(2024, 1, 1)
+        PortfolioPerformance.objects.bulk_create([
+            PortfolioPerformance(user=self.user, date=start + timedelta(days=i), transaction=Decimal(1),
+                                 balance=Decimal(5 if i == 200 else 100 + i % 7))
+            for i in range(366)
+        ])
+
+        data = self.client.get(reverse("api_portfolio_chart"), {"max_points": 50}).json()
+
+        self.assertLessEqual(len(data["labels"]), 50)
+        self.assertEqual(min(data["equity"]), 5.0)
+        self.assertIn((start + timedelta(days=200)).isoformat(), data["labels"])
+        self.assertEqual(sum(data["transactions"]), 366.0)
+        self.assertEqual(data["labels"][-1], "2024-12-31")
+
+    def test_since_and_version_return_only_the_changed_points(self):
+        start = date.today() - timedelta(days=9)
+        with self.captureOnCommitCallbacks(execute=True):
+            for i in range(10):
+                AccountBalance.objects.create(account=self.account, date=start + timedelta(days=i), balance=Decimal(i))
+            utils.utils_build_portfolio(self.user, start, date.today())
+        full = self.chart()
+        self.assertIsNone(full["delta_from"])
+        since = {"since": full["labels"][-1], "version": full["version"]}
+
+        self.assertEqual(self.client.get(reverse("api_portfolio_chart"), since).json()["labels"], [])
+
+        changed = start + timedelta(days=7)
+        with self.captureOnCommitCallbacks(execute=True):
+            AccountBalance.objects.filter(account=self.account, date__gte=changed).update(balance=Decimal(50))
+            utils.utils_build_portfolio(self.user, changed, date.today())
+        delta = self.client.get(reverse("api_portfolio_chart"), since).json()
+        self.assertEqual(delta["delta_from"], changed.isoformat())
+        self.assertEqual(delta["equity"], [50.0, 50.0, 50.0])
+
+        # Đổi tiền tệ hiển thị → không biết ngày nào đổi → tải lại toàn bộ
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.userpreference.save()
+        delta = self.client.get(reverse("api_portfolio_chart"), {**since, "version": delta["version"]}).json()
+        self.assertIsNone(delta["delta_from"])
+        self.assertEqual(len(delta["labels"]), 10)
+
+    def test_version_survives_eviction_without_reusing_old_keys(self):
+        before = utils.utils_chart_cache_key("portfolio_chart", self.user.id)
+        cache.delete(f"data_version_{self.user.id}")
+
+        self.assertNotEqual(utils.utils_chart_cache_key("portfolio_chart", self.user.id), before)
+
+        # Version FX / symbol index bị cull → tạo lại lớn hơn, không quay về 1
+        for key, invalidate in ((FxRateMatrix.VERSION_KEY, FxRateMatrix.invalidate),
+                                (SymbolIndex.VERSION_KEY, SymbolIndex.invalidate)):
+            invalidate()
+            invalidate()
+            seen = cache.get(key)
+            cache.delete(key)
+            self.assertGreater(shared_version(key), seen)
+
+
+class FakeProviderHandler(BaseHTTPRequestHandler):
+    """
+    Yahoo chart / EODHD eod endpoints; `SLOW*` symbols answer after 2s.
+    Paths listed in `recorded` are answered with the recorded response.
+    `peak` counts the most parallel requests seen per provider; with a
+    `barriers[provider]` set, its requests wait for each other in groups.
+    """
+    delay = 0.2
+    days = 5
+    hits = []
+    lock = threading.Lock()
+    in_flight = {}
+    peak = {}
+    barriers = {}
+    recorded = {
+        "/v8/finance/spark": "yahoo/v8_finance_spark.json",
+        "/eod-bulk-last-day/US": "eodhd/eod-bulk-last-day_US.json",
+        "/eod/OLD.US": "eodhd/eod_OLD.US.json",
+    }
+
+    def do_GET(self):
+        self.hits.append(self.path)
+        provider = "eodhd" if self.path.startswith("/eod") else "yahoo"
+        # dict của test hiện tại: request muộn của test trước không được đếm
+        in_flight, peak = self.in_flight, self.peak
+        with self.lock:
+            in_flight[provider] = in_flight.get(provider, 0) + 1
+            peak[provider] = max(peak.get(provider, 0), in_flight[provider])
+        try:
+            if provider in self.barriers:
+                self.barriers[provider].wait(timeout=5)
+            payload = self.respond()
+        finally:
+            # trước khi trả lời: client nhận xong mới gửi request kế tiếp
+            with self.lock:
+                in_flight[provider] -= 1
+        self.reply(payload)
+
+    def respond(self):
+        path = self.path.split("?")[0].rstrip("/")
+        symbol = path.split("/")[-1]
+        time.sleep(2 if symbol.startswith("SLOW") else self.delay)
+        if path in self.recorded:
+            return (PROVIDER_FIXTURES / self.recorded[path]).read_bytes()
+        today = datetime.combine(date.today(), datetime.min.time())
+        stamps = [int((today - timedelta(days=i)).timestamp()) for i in reversed(range(self.days))]
+        if self.path.startswith("/eod/"):
+            body = [{"date": date.fromtimestamp(ts).isoformat(), "open": 1, "high": 1, "low": 1,
+                     "close": 10, "volume": 5} for ts in reversed(stamps)]
+        else:
+            quote = {k: [10.0] * self.days for k in ("open", "high", "low", "close")}
+            quote["volume"] = [5] * self.days
+            body = {"chart": {"result": [{"timestamp": stamps, "indicators": {"quote": [quote]}}]}}
+        return json.dumps(body).encode()
+
+    def reply(self, payload):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+class PriceRefreshTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), FakeProviderHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base_url = f"http://127.0.0.1:{cls.server.server_port}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.user = User.objects.create_user("bob", password="x")
+        UserAPIKey.objects.create(user=self.user, key_eodhd="demo")
+        FakeProviderHandler.hits = []
+        FakeProviderHandler.in_flight = {}
+        FakeProviderHandler.peak = {}
+        FakeProviderHandler.barriers = {}
+        scheduler.reset()  # bucket tạo với PRICE_RATE_PROCESSES của refresh()
+        self.addCleanup(scheduler.reset)
+
+    def add_securities(self, codes, api_source="yahoo", user=None):
+        for code in codes:
+            Security.objects.create(user=user or self.user, code=code, exchange="US", name=code, api_source=api_source)
+
+    def refresh(self, deadline=5, concurrency=4, user=None):
+        urls = {"yahoo": self.base_url, "eodhd": self.base_url}
+        # một process: cả rate limit của provider, burst đủ cho 8 request song song
+        with override_settings(PRICE_API_URLS=urls, PRICE_RATE_PROCESSES=1,
+                               PRICE_FETCH_CONCURRENCY={"yahoo": concurrency, "eodhd": concurrency}):
+            return utils.utils_update_security_prices_for_user(user or self.user, deadline=deadline)
+
+    def test_fetches_run_in_parallel_per_provider(self):
+        self.add_securities([f"Y{i}" for i in range(8)])
+        self.add_securities([f"E{i}" for i in range(4)], api_source="eodhd")
+
+        # Các request chờ nhau theo nhóm 4: chỉ qua được nếu thật sự chạy song song
+        FakeProviderHandler.barriers = {"yahoo": threading.Barrier(4), "eodhd": threading.Barrier(4)}
+        report = self.refresh(concurrency=4)
+
+        # 8 yahoo / 4 song song = 2 lượt, eodhd 1 lượt, không vượt giới hạn
+        self.assertEqual(FakeProviderHandler.peak, {"yahoo": 4, "eodhd": 4})
+        self.assertEqual({r["status"] for r in report}, {"ok"})
+        self.assertTrue(all(r["bars"] == FakeProviderHandler.days and r["latency_ms"] is not None for r in report))
+        self.assertEqual(InstrumentPrice.objects.count(), 12 * FakeProviderHandler.days)
+
+    def test_deadline_reports_unfinished_securities(self):
+        self.add_securities(["FAST1", "FAST2", "SLOW1"])
+
+        report = self.refresh(deadline=1)
+
+        status = {r["code"]: r["status"] for r in report}
+        self.assertEqual(status, {"FAST1": "ok", "FAST2": "ok", "SLOW1": "timeout"})
+        self.assertFalse(InstrumentPrice.objects.filter(instrument__code="SLOW1").exists())
+
+    def test_instrument_held_by_many_users_is_fetched_once(self):
+        other = User.objects.create_user("carol", password="x")
+        self.add_securities(["AAPL", "MSFT"])
+        self.add_securities(["AAPL"], user=other)
+
+        self.refresh()
+        report = self.refresh(user=other)
+
+        self.assertEqual(len(FakeProviderHandler.hits), 2)
+        self.assertEqual(report, [])
+        self.assertEqual(InstrumentPrice.objects.filter(instrument__code="AAPL").count(), FakeProviderHandler.days)
+        aapl = Security.objects.get(user=other, code="AAPL")
+        self.assertEqual(aapl.instrument, Security.objects.get(user=self.user, code="AAPL").instrument)
+        self.assertEqual(aapl.price_on(date.today()), Decimal("10"))
+
+    @patch("dash.utils.timezone.now", return_value=datetime(2025, 6, 6, 20, tzinfo=timezone.utc))
+    def test_instruments_behind_are_refreshed_in_batches(self, _now):
+        self.add_securities(["AAPL", "MSFT"])
+        self.add_securities(["SAP", "OLD"], api_source="eodhd")
+        for code, last in (("AAPL", 4), ("MSFT", 4), ("SAP", 5), ("OLD", 3)):
+            InstrumentPrice.objects.create(instrument=Instrument.objects.get(code=code), date=date(2025, 6, last), close=1)
+
+        report = self.refresh()
+
+        # 1 spark + 1 bulk; OLD thiếu 04 và 05/06 → history riêng
+        paths = sorted(hit.split("?")[0] for hit in FakeProviderHandler.hits)
+        self.assertEqual(paths, ["/eod-bulk-last-day/US", "/eod/OLD.US", "/v8/finance/spark"])
+        via = {r["code"]: (r["via"], r["status"], r["bars"]) for r in report}
+        self.assertEqual(via, {
+            "AAPL": ("batch", "ok", 2), "MSFT": ("batch", "ok", 2),
+            "SAP": ("batch", "ok", 1), "OLD": ("history", "ok", 3),
+        })
+        self.assertEqual(
+            list(InstrumentPrice.objects.filter(instrument__code="OLD").order_by("date").values_list("date", "close")),
+            [(date(2025, 6, 3), 1), (date(2025, 6, 4), Decimal("10.05")),
+             (date(2025, 6, 5), Decimal("10.2")), (date(2025, 6, 6), Decimal("10.3"))],
+        )
+        self.assertEqual(Security.objects.get(code="MSFT").price_on(date(2025, 6, 6)), Decimal("470.38"))
+
+
+@override_settings(PRICE_PROVIDER_REPLAY="replay", PRICE_PROVIDER_FIXTURES=str(PROVIDER_FIXTURES))
+class ProviderReplayTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("dave", password="x")
+        UserAPIKey.objects.create(user=self.user, key_eodhd="demo")
+
+    @patch("dash.utils.timezone.now", return_value=datetime(2025, 6, 6, 20, tzinfo=timezone.utc))
+    def test_refresh_replays_recorded_responses(self, _now):
+        for code, source, last in (("AAPL", "yahoo", 4), ("SAP", "eodhd", 5), ("OLD", "eodhd", 3)):
+            security = Security.objects.create(user=self.user, code=code, exchange="US", name=code, api_source=source)
+            InstrumentPrice.objects.create(instrument=security.instrument, date=date(2025, 6, last), close=1)
+
+        report = utils.utils_update_security_prices_for_user(self.user)
+
+        self.assertEqual({r["code"]: r["status"] for r in report}, {"AAPL": "ok", "SAP": "ok", "OLD": "ok"})
+        self.assertEqual(Security.objects.get(code="OLD").price_on(date(2025, 6, 5)), Decimal("10.2"))
+        # spark chỉ có giá đóng cửa → không bịa open/high/low/volume
+        spark_bar = InstrumentPrice.objects.filter(instrument__code="AAPL").latest("date")
+        self.assertIsNotNone(spark_bar.close)
+        self.assertEqual((spark_bar.open, spark_bar.high, spark_bar.low, spark_bar.volume), (None, None, None, None))
+
+    @patch("dash.providers.timezone.now", return_value=datetime(2025, 6, 6, 20, tzinfo=timezone.utc))
+    def test_latest_bars_of_providers_without_a_batch_endpoint(self, _now):
+        # Finnhub / Alpha Vantage: fetch_latest mặc định = fetch_history của vài ngày gần nhất
+        for name, code, close in (("finnhub", "AAPL", Decimal("200.63")), ("alpha_vantage", "IBM", Decimal("268.59"))):
+            with self.subTest(name):
+                with override_settings(PRICE_PROVIDER_FIXTURES=str(PROVIDER_FIXTURES)):
+                    latest = get_provider(name, key="demo", replay="replay").fetch_latest([code], "US", range_days=5)
+
+                bars = latest[code]
+                self.assertEqual(bars[-1]["date"], date(2025, 6, 5))
+                self.assertEqual(bars[-1]["close"], close)
+                self.assertGreaterEqual(bars[0]["date"], date(2025, 6, 1))
+
+    def test_record_then_replay(self):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), FakeProviderHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        urls = {"yahoo": f"http://127.0.0.1:{server.server_port}", "eodhd": ""}
+
+        with tempfile.TemporaryDirectory() as fixtures, \
+                override_settings(PRICE_API_URLS=urls, PRICE_PROVIDER_FIXTURES=fixtures):
+            start = date.today() - timedelta(days=3)
+            recorded = get_provider("yahoo", replay="record").fetch_history("AAPL", "US", start)
+            server.shutdown()
+
+            replayed = asyncio.run(get_provider("yahoo").afetch_history("AAPL", "US", start))
+
+        self.assertEqual(len(recorded), FakeProviderHandler.days)
+        self.assertEqual(replayed, recorded)
+
+
+@override_settings(PRICE_PROVIDER_REPLAY="replay", PRICE_PROVIDER_FIXTURES=str(PROVIDER_FIXTURES))
+@patch("dash.utils.timezone.now", return_value=datetime(2025, 6, 6, 21, tzinfo=timezone.utc))
+class StalePriceRefreshTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("erin", password="x")
+        UserAPIKey.objects.create(user=self.user, key_eodhd="demo")
+
+    def add_security(self, code, source, last, user=None):
+        security = Security.objects.create(user=user or self.user, code=code, exchange="US", name=code, api_source=source)
+        InstrumentPrice.objects.create(instrument=security.instrument, date=date(2025, 6, last), close=1)
+
+    def test_last_session_follows_exchange_close(self, now):
+        # 16:00 New York + 30 phút; thứ 7 → phiên thứ 6
+        self.assertEqual(last_session_date("US", datetime(2025, 6, 6, 20, tzinfo=timezone.utc)), date(2025, 6, 5))
+        self.assertEqual(last_session_date("US", now.return_value), date(2025, 6, 6))
+        self.assertEqual(last_session_date("US", datetime(2025, 6, 8, 12, tzinfo=timezone.utc)), date(2025, 6, 6))
+
+    def test_daemon_refreshes_stale_instruments_once_per_ttl(self, _now):
+        self.add_security("AAPL", "yahoo", 6)
+        self.add_security("SAP", "eodhd", 5)
+        self.add_security("OLD", "eodhd", 3)
+
+        call_command("refresh_prices", "--once", stdout=io.StringIO())
+
+        self.assertEqual(Security.objects.get(code="SAP").price_on(date(2025, 6, 6)), Decimal("302.94"))
+        self.assertEqual(Security.objects.get(code="OLD").price_on(date(2025, 6, 5)), Decimal("10.2"))
+        self.assertEqual(list(Instrument.objects.filter(checked_at__isnull=False).values_list("code", flat=True)
+                              .order_by("code")), ["OLD", "SAP"])
+        self.assertEqual(utils.utils_refresh_stale_prices(), [])
+
+    def test_login_queues_refresh_only_when_stale(self, _now):
+        fresh = User.objects.create_user("frank", password="x")
+        self.add_security("AAPL", "yahoo", 6, user=fresh)
+        self.add_security("SAP", "eodhd", 5)
+
+        with patch("dash.utils.utils_refresh_instruments") as refresh:
+            self.client.force_login(fresh)
+            self.client.force_login(self.user)
+
+        refresh.assert_not_called()
+        self.assertEqual(list(RecalcJob.objects.values_list("user__username", "kind")), [("erin", "prices")])
+
+
+class ScriptedHandler(BaseHTTPRequestHandler):
+    """Answers with the next status of `script` (the last one repeats)."""
+    script = [200]
+    hits = 0
+
+    def do_GET(self):
+        status = self.script[min(type(self).hits, len(self.script) - 1)]
+        type(self).hits += 1
+        payload = b"{}"
+        self.send_response(status)
+        if status == 429:
+            self.send_header("Retry-After", "0")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+class ProviderSchedulerTests(TestCase):
+    def setUp(self):
+        scheduler.reset()
+        self.addCleanup(scheduler.reset)
+        ScriptedHandler.hits = 0
+        server = ThreadingHTTPServer(("127.0.0.1", 0), ScriptedHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        urls = {"yahoo": f"http://127.0.0.1:{server.server_port}"}
+        settings_override = override_settings(PRICE_API_URLS=urls, PRICE_RETRY_BACKOFF=0.01)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.provider = get_provider("yahoo", replay=False)
+
+    @override_settings(PRICE_RATE_PROCESSES=4)
+    def test_each_process_gets_its_share_of_the_rate_limit(self):
+        self.assertEqual(scheduler.bucket("yahoo", 120).rate * 60, 30)
+
+    def test_rate_limited_request_is_retried(self):
+        ScriptedHandler.script = [429, 503, 200]
+
+        self.assertEqual(self.provider.get_json("/quote"), {})
+        self.assertEqual(ScriptedHandler.hits, 3)
+
+    @override_settings(PRICE_RETRY_ATTEMPTS=0, PRICE_BREAKER_THRESHOLD=2)
+    def test_circuit_opens_after_repeated_failures(self):
+        ScriptedHandler.script = [503]
+
+        for _ in range(2):
+            with self.assertRaises(requests.HTTPError):
+                self.provider.get_json("/quote")
+        with self.assertRaises(CircuitOpenError):
+            self.provider.get_json("/quote")
+        self.assertEqual(ScriptedHandler.hits, 2)
+
+    def test_interactive_callers_go_ahead_of_background(self):
+        now = [0.0]
+        waiting = {"background": threading.Event(), "interactive": threading.Event()}
+
+        def clock():
+            # Thread đã vào acquire (sau khi đăng ký interactive) → báo cho test
+            event = waiting.get(threading.current_thread().name)
+            if event:
+                event.set()
+            return now[0]
+
+        def tick():
+            # Thời gian giả: thêm đúng 1 token rồi đánh thức các thread đang chờ
+            with bucket.cond:
+                now[0] += 0.1
+                bucket.cond.notify_all()
+
+        bucket = TokenBucket(per_minute=600, capacity=1, clock=clock)  # 1 token / 0.1s
+        bucket.acquire(0)
+        order = []
+
+        def take(interactive):
+            self.assertTrue(bucket.acquire(100, interactive))
+            order.append(threading.current_thread().name)
+
+        background = threading.Thread(target=take, args=(False,), name="background")
+        background.start()
+        self.assertTrue(waiting["background"].wait(5))
+        interactive = threading.Thread(target=take, args=(True,), name="interactive")
+        interactive.start()
+        self.assertTrue(waiting["interactive"].wait(5))
+
+        tick()
+        interactive.join(5)
+        tick()
+        background.join(5)
+
+        self.assertEqual(order, ["interactive", "background"])
+
+
+class FakeSearchHandler(BaseHTTPRequestHandler):
+    """Yahoo search answers at once, EODHD search after `eodhd_delay`."""
+    eodhd_delay = 1.0
+    hits = []
+
+    def do_GET(self):
+        self.hits.append(self.path)
+        if self.path.startswith("/search/"):
+            time.sleep(self.eodhd_delay)
+            body = [{"Code": "AAPL", "Exchange": "US", "Name": "Apple Inc", "Type": "Common Stock",
+                     "Currency": "USD", "Country": "USA"}]
+        else:
+            body = {"quotes": [
+                {"symbol": "AAPL", "exchange": "NMS", "shortname": "Apple Inc.", "quoteType": "EQUITY"},
+                {"symbol": "APP", "exchange": "NMS", "shortname": "AppLovin Corporation", "quoteType": "EQUITY"},
+            ]}
+        payload = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+class SecuritySearchTests(TestCase):
+    def setUp(self):
+        search_cache.clear()
+        self.addCleanup(search_cache.clear)
+        FakeSearchHandler.hits = []
+        server = ThreadingHTTPServer(("127.0.0.1", 0), FakeSearchHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = f"http://127.0.0.1:{server.server_port}"
+        settings_override = override_settings(PRICE_API_URLS={"yahoo": url, "eodhd": url})
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.keys = {"eodhd": "demo"}
+
+    def test_slow_provider_gives_partial_results_then_cached(self):
+        started = time.monotonic()
+        results, timed_out = search_securities("  App ", self.keys, deadline=0.5)
+
+        self.assertLess(time.monotonic() - started, 0.8)
+        self.assertEqual(timed_out, ["eodhd"])
+        self.assertEqual([r["code"] for r in results["yahoo"]], ["AAPL", "APP"])
+
+        time.sleep(FakeSearchHandler.eodhd_delay)  # EODHD trả lời muộn → vẫn vào cache
+        results, timed_out = search_securities("app", self.keys, deadline=0.5)
+
+        self.assertEqual(timed_out, [])
+        self.assertEqual(results["eodhd"][0]["name"], "Apple Inc")
+        self.assertEqual(len(FakeSearchHandler.hits), 2)
+
+    def test_prefix_extension_reuses_complete_results(self):
+        FakeSearchHandler.eodhd_delay = 0
+        self.addCleanup(setattr, FakeSearchHandler, "eodhd_delay", 1.0)
+        search_securities("app", self.keys)
+
+        results, _ = search_securities("appl", self.keys)
+
+        self.assertEqual(len(FakeSearchHandler.hits), 2)
+        self.assertEqual([r["code"] for r in results["yahoo"]], ["AAPL", "APP"])  # "AppLovin"
+        results, _ = search_securities("apple", self.keys)
+        self.assertEqual([r["code"] for r in results["yahoo"]], ["AAPL"])
+
+    @override_settings(SYMBOL_INDEX_MIN_HITS=1)
+    def test_autocomplete_answers_locally_and_learns_from_providers(self):
+        FakeSearchHandler.eodhd_delay = 0
+        self.addCleanup(setattr, FakeSearchHandler, "eodhd_delay", 1.0)
+        user = User.objects.create_user("gina", password="x")
+        Security.objects.create(user=user, code="MSFT", exchange="US", name="Microsoft Corporation",
+                                isin="US5949181045", api_source="eodhd")
+
+        for query in ("msft", "micro", "US594", "microsfot"):
+            hits, source, _ = autocomplete(query, self.keys)
+            self.assertEqual((hits[0]["code"], source), ("MSFT", "local"), query)
+        self.assertEqual(FakeSearchHandler.hits, [])
+
+        hits, source, _ = autocomplete("app", self.keys)
+        self.assertEqual(source, "network")
+        self.assertEqual(Symbol.objects.count(), 3)  # AAPL.NMS, APP.NMS, AAPL.US
+        hits, source, _ = autocomplete("apple", self.keys)
+        self.assertEqual((hits[0]["code"], source), ("AAPL", "local"))
+
+    def test_symbol_index_answers_without_providers_until_invalidated(self):
+        words = ["Global", "Alpha", "Capital", "Energy", "Holdings", "Tech", "Bank", "Pharma"]
+        Symbol.objects.bulk_create([
+            Symbol(code=f"S{i:04d}", exchange="US", name=f"{words[i % 8]} {words[i // 8 % 8]} {i}", api_source="eodhd")
+            for i in range(2000)
+        ])
+        SymbolIndex.invalidate()
+        index = SymbolIndex.current()
+
+        with patch("dash.search.search_securities") as network:
+            for query, code in (("S0123", "S0123"), ("energy holdings 1955", "S1955"), ("capitl 1234", "S1234")):
+                hits, source, _ = autocomplete(query, self.keys)
+                self.assertEqual((hits[0]["code"], source), (code, "local"), query)
+            network.assert_not_called()
+        self.assertIs(SymbolIndex.current(), index)  # không build lại giữa các lần gõ
+
+        # Security mới → version đổi → index build lại và thấy mã mới
+        user = User.objects.create_user("hugo", password="x")
+        Security.objects.create(user=user, code="ZZZT", exchange="US", name="Zeta Zone", api_source="eodhd")
+        self.assertIsNot(SymbolIndex.current(), index)
+        self.assertEqual(SymbolIndex.current().search("zzzt")[0]["code"], "ZZZT")
+
+    def test_remembered_symbols_are_added_without_a_rebuild(self):
+        SymbolIndex.invalidate()
+        self.addCleanup(SymbolIndex.invalidate)
+        index = SymbolIndex.current()
+        version = cache.get(SymbolIndex.VERSION_KEY)
+        hit = {"code": "NVDA", "exchange": "US", "name": "NVIDIA Corp", "api_source": "eodhd"}
+
+        with patch.object(SymbolIndex, "load") as load:
+            self.assertEqual(remember_symbols({"eodhd": [hit]}), 1)
+            self.assertIs(SymbolIndex.current(), index)
+            self.assertEqual(index.search("nvidia")[0]["code"], "NVDA")
+
+            # Process khác: index riêng chưa có NVDA → thấy sau SYMBOL_INDEX_REFRESH, không build lại
+            SymbolIndex._current = other = SymbolIndex([])
+            self.assertEqual(SymbolIndex.current().search("nvidia"), [])
+            SymbolIndex._checked_at -= settings.SYMBOL_INDEX_REFRESH
+            self.assertIs(SymbolIndex.current(), other)
+            self.assertEqual(other.search("nvidia")[0]["code"], "NVDA")
+            load.assert_not_called()
+        self.assertEqual(cache.get(SymbolIndex.VERSION_KEY), version)
@@ -28,6 +28,7 @@ from .apis import (
     api_account_create,
     api_account_update,
     api_security_search,
+    api_security_autocomplete,
     api_security_add,
     api_security_update,
     api_entry_add,
@@ -35,7 +36,8 @@ from .apis import (
     api_exit_add,
     api_exit_update,
     api_portfolio_chart,
-    api_holdings_data
+    api_holdings_data,
+    api_job_status
 )
 
 #Views
@@ -81,6 +83,7 @@ urlpatterns += [
     path('api/account/<int:id>/', api_account_update, name='api_account_update'),  # PUT, PATCH, DELETE    
     
     path('api/security/search/', api_security_search, name='api_security_search'),
+    path('api/security/autocomplete/', api_security_autocomplete, name='api_security_autocomplete'),
     path('api/security/add/', api_security_add, name='api_security_add'),
     path('api/security/<int:id>/', api_security_update, name='api_security_update'),  # PUT, PATCH, DELETE
 
@@ -92,5 +95,6 @@ urlpatterns += [
 
     path('api/portfolio/data/', api_portfolio_chart, name='api_portfolio_chart'),
     path('api/holdings/data/', api_holdings_data, name='api_holdings_data'),
+    path('api/job/<int:id>/', api_job_status, name='api_job_status'),
     
 ]
\ No newline at end of file
@@ -1,14 +1,25 @@
+import csv
+import io
+import threading
+import time
+from array import array
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor, wait as futures_wait
+from contextlib import contextmanager
 from datetime import date, timedelta
 from decimal import Decimal
 from collections import defaultdict
 from functools import reduce
+from itertools import accumulate, repeat
 from operator import mul
 
-import requests
-
 from django.utils import timezone
-from django.db.models import Max
+from django.db import connection as db_connection, transaction as db_transaction
+from django.conf import settings
+from django.db.models import Case, DecimalField, F, Max, Min, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import TruncMonth, TruncWeek
 from django.contrib.auth.models import User
+from django.core.cache import cache
 
 from .models import (
     Security,
@@ -16,22 +27,29 @@ from .models import (
     PortfolioPerformance,
     TradeEntry,
     TradeExit,
-    SecurityPrice,
+    Instrument,
+    InstrumentPrice,
     Transaction,
     Account,
-    UserAPIKey,
     UserPreference,
     DailyHoldingEquity,
 )
+from .series import FxRateMatrix, PositionTimeline, PriceSeries, bump_shared_version, shared_version
+from .markets import last_session_date
+from .providers import get_provider, provider_keys
 
 
-def utils_update_account(account, start_date=None):
+def utils_update_account(account, start_date=None, sync_portfolio=True, progress=None):
     """
     Re-compute balance / fee / tax / principal *and* equity‐float for `account`
     starting from `start_date`.
 
     If `start_date` is None, the function resumes from the most-recent
     AccountBalance date stored for that account (or today if none exists).
+
+    The series is replayed in memory and written in one transaction with a
+    single bulk upsert. `progress(done, total)` is called for every replayed
+    day. Returns the number of AccountBalance rows written.
     """
 
     # 1️⃣ Xác định ngày bắt đầu
@@ -43,10 +61,133 @@ def utils_update_account(account, start_date=None):
         )
         start_date = last_bal.date if last_bal else date.today()
 
-    # 🧹 Xoá dữ liệu cũ từ start_date trở đi
-    AccountBalance.objects.filter(account=account, date__gte=start_date).delete()
+    # 2️⃣ Replay toàn bộ chuỗi trong bộ nhớ rồi ghi một lần
+    if not sync_portfolio:
+        # Caller (utils_build_portfolio) tự build lại → bỏ các sync do post_delete
+        with _muted_portfolio_sync(account.user_id), utils_lock_accounts(account):
+            return utils_write_balances(account, utils_replay_ledger(account, start_date, progress))
+
+    # Sync do post_delete (dòng thừa) gộp với sync bên dưới → một lần build
+    with utils_defer_portfolio_sync():
+        with utils_lock_accounts(account):
+            written = utils_write_balances(account, utils_replay_ledger(account, start_date, progress))
+        # bulk_create không bắn post_save → tự đồng bộ portfolio
+        utils_schedule_portfolio_sync(account.user_id, start_date)
+    return written
+
+
+BALANCE_FIELDS = ("balance", "fee", "tax", "principal", "float")
+
+
+def _balance_state(bal):
+    return tuple(getattr(bal, field) for field in BALANCE_FIELDS)
+
+
+def utils_compact_balances(rows, prev=None):
+    """
+    Keep only the rows where a balance component or the float changes
+    compared to the day before (`prev` is the stored row preceding
+    `rows`), plus the last row which marks how far the series reaches.
+    """
+    kept = []
+    last_state = _balance_state(prev) if prev else None
+    for row in rows:
+        state = _balance_state(row)
+        if state != last_state:
+            kept.append(row)
+        last_state = state
+
+    if rows and (not kept or kept[-1] is not rows[-1]):
+        kept.append(rows[-1])
+    return kept
+
+
+def utils_write_balances(account, rows, storage=None):
+    """
+    Replace the AccountBalance rows of `account` from `rows[0].date` on with
+    `rows` (a consecutive daily series) in one transaction.
+
+    With `ACCOUNT_BALANCE_STORAGE = 'changes'` only the change points are
+    stored; read them back with `utils_iter_balances`. Returns the number of
+    rows written.
+    """
+    storage = storage or settings.ACCOUNT_BALANCE_STORAGE
+    start, last = rows[0].date, rows[-1].date
+
+    if storage == "changes":
+        prev = (
+            AccountBalance.objects.filter(account=account, date__lt=start)
+            .order_by("-date")
+            .first()
+        )
+        rows = utils_compact_balances(rows, prev)
+        stale = AccountBalance.objects.filter(account=account, date__gte=start).exclude(
+            date__in=[row.date for row in rows]
+        )
+    else:
+        stale = AccountBalance.objects.filter(account=account, date__gt=last)
+
+    with db_transaction.atomic():
+        AccountBalance.objects.bulk_create(
+            rows,
+            batch_size=1000,
+            update_conflicts=True,
+            unique_fields=["account", "date"],
+            update_fields=list(BALANCE_FIELDS),
+        )
+        # post_delete xin sync từ các ngày đó, gộp với sync của utils_update_account
+        stale.delete()
+
+    return len(rows)
+
+
+def utils_iter_balances(accounts, start_date, end_date):
+    """
+    Yield (day, {account_id: AccountBalance}) for every day in
+    [start_date, end_date], expanding the stored rows (daily or change
+    points) into a daily series. Rows are streamed from a single query;
+    accounts without any row yet are left out of the mapping.
+    """
+    account_ids = [getattr(a, "pk", a) for a in accounts]
+    base = AccountBalance.objects.filter(account_id__in=account_ids)
+    anchor = (
+        base.filter(account=OuterRef("account"), date__lt=start_date)
+        .order_by("-date")
+        .values("date")[:1]
+    )
+    rows = (
+        base.filter(
+            Q(date__gte=start_date, date__lte=end_date)
+            | Q(date__lt=start_date, date=Subquery(anchor))
+        )
+        .order_by("date")
+        .iterator(chunk_size=2000)
+    )
+
+    state = {}
+    pending = next(rows, None)
+    current = start_date
+    while current <= end_date:
+        while pending is not None and pending.date <= current:
+            state[pending.account_id] = pending
+            pending = next(rows, None)
+        yield current, dict(state)
+        current += timedelta(days=1)
+
+
+def utils_balances_on(accounts, on_date):
+    """{account_id: AccountBalance} in effect on `on_date`."""
+    return next(utils_iter_balances(accounts, on_date, on_date))[1]
 
-    # 2️⃣ Lấy balance trước đó (nếu có)
+
+def utils_replay_ledger(account, start_date, progress=None):
+    """
+    Build the unsaved AccountBalance rows of `account` from `start_date`
+    up to today (or the last dated activity if later), one row per day.
+    `progress(done, total)` is called after each day.
+    """
+
+    # Lấy balance trước đó (nếu có)
     prev_bal = (
         AccountBalance.objects.filter(account=account, date__lt=start_date)
         .order_by("-date")
@@ -57,12 +198,12 @@ def utils_update_account(account, start_date=None):
     tax = prev_bal.tax if prev_bal else Decimal("0")
     principal = prev_bal.principal if prev_bal else Decimal("0")
 
-    # 3️⃣ Lấy giao dịch, entries, exits
+    # Lấy giao dịch, entries, exits
     transactions = account.transactions.filter(date__gte=start_date).order_by("date")
     entries = account.entries.filter(date__gte=start_date).order_by("date")
     exits = TradeExit.objects.filter(entry__account=account, date__gte=start_date).order_by("date")
 
-    # 4️⃣ Gom dữ liệu theo ngày
+    # Gom dữ liệu theo ngày
     daily_changes = defaultdict(lambda: Decimal("0"))
     daily_fee = defaultdict(lambda: Decimal("0"))
     daily_tax = defaultdict(lambda: Decimal("0"))
@@ -85,62 +226,226 @@ def utils_update_account(account, start_date=None):
         daily_fee[ex.date] += ex.fee
         daily_tax[ex.date] += ex.tax
 
-    # 5️⃣ Duyệt từng ngày và cập nhật balance + equity
+    # Duyệt từng ngày, không đụng DB cho phần balance / khối lượng nắm giữ
     all_dates = set(daily_changes.keys()) | set(daily_principal.keys())
-    if not all_dates:
-        all_dates = {start_date}
+    last = max([date.today(), start_date, *all_dates])
 
-    today = date.today()
-    current = min(all_dates)
-    last = max(today, max(all_dates))
+    timeline = PositionTimeline.for_account(account)
+    prices = PriceSeries.for_securities(timeline.security_ids())
 
-    while current <= last:
+    total = (last - start_date).days + 1
+    rows = []
+    for current, holdings in timeline.iter_holdings(start_date, last):
+        if progress:
+            progress(len(rows), total)
         balance += daily_changes[current]
         fee += daily_fee[current]
         tax += daily_tax[current]
         principal += daily_principal[current]
 
-        float_equity = utils_calc_float_equity(account, current)
-
-        AccountBalance.objects.update_or_create(
+        rows.append(AccountBalance(
             account=account,
             date=current,
-            defaults={
-                "balance": balance,
-                "fee": fee,
-                "tax": tax,
-                "principal": principal,
-                "float": float_equity,
-            },
+            balance=balance,
+            fee=fee,
+            tax=tax,
+            principal=principal,
+            float=utils_float_equity(holdings, prices, current),
+        ))
+
+    return rows
+
+
+
+# ---------------------------------------------------------------------- #
+#  ➕  Delta mode: dịch chuyển các dòng AccountBalance thay vì replay
+# ---------------------------------------------------------------------- #
+LEDGER_FIELDS = ("balance", "fee", "tax", "principal")
+
+
+def utils_ledger_effect(obj):
+    """
+    Contribution of a Transaction / TradeEntry / TradeExit to the running
+    balance / fee / tax / principal columns of its account.
+    """
+    effect = dict.fromkeys(LEDGER_FIELDS, Decimal("0"))
+    effect["fee"] = obj.fee
+    effect["tax"] = obj.tax
+
+    if isinstance(obj, Transaction):
+        effect["balance"] = obj.net_amount
+        if obj.type in ("deposit", "withdrawal"):
+            effect["principal"] = obj.net_amount
+    elif isinstance(obj, TradeEntry):
+        effect["balance"] = -obj.net_amount
+    elif isinstance(obj, TradeExit):
+        effect["balance"] = obj.net_amount
+
+    return effect
+
+
+def _ledger_account(obj):
+    return obj.entry.account if isinstance(obj, TradeExit) else obj.account
+
+
+ACCOUNT_LOCK = 4201  # namespace advisory lock (PostgreSQL) của các account
+
+
+@contextmanager
+def utils_lock_accounts(*objs):
+    """
+    Hold a per-account lock on the accounts of `objs` (Account / Transaction
+    / TradeEntry / TradeExit, None is skipped).
+
+    Ledger writes, delta shifts and replays of one account take this lock, so
+    a replay never reads the ledger before an edit and then overwrites the
+    rows that edit has shifted. PostgreSQL uses advisory locks, which do not
+    need a transaction: a long replay keeps writing its job progress. Other
+    databases fall back to SELECT ... FOR UPDATE in a transaction.
+    """
+    # khoá theo thứ tự pk → không deadlock giữa 2 request
+    ids = sorted({obj.pk if isinstance(obj, Account) else _ledger_account(obj).pk
+                  for obj in objs if obj is not None})
+
+    if db_connection.vendor != "postgresql":
+        with db_transaction.atomic():
+            list(Account.objects.select_for_update().filter(pk__in=ids).values_list("pk", flat=True))
+            yield
+        return
+
+    # Trong transaction: khoá theo transaction (nhả khi commit / rollback)
+    in_transaction = db_connection.in_atomic_block
+    lock = "pg_advisory_xact_lock" if in_transaction else "pg_advisory_lock"
+    with db_connection.cursor() as cursor:
+        for pk in ids:
+            cursor.execute(f"SELECT {lock}(%s, %s)", [ACCOUNT_LOCK, pk])
+    try:
+        yield
+    finally:
+        if not in_transaction:
+            with db_connection.cursor() as cursor:
+                for pk in reversed(ids):
+                    cursor.execute("SELECT pg_advisory_unlock(%s, %s)", [ACCOUNT_LOCK, pk])
+
+
+def utils_ledger_touches_float(old, new):
+    """True when the change moves a position (quantity, date, security...)."""
+    if isinstance(old or new, Transaction):
+        return False
+    if old is None or new is None:
+        return True
+    if isinstance(new, TradeEntry):
+        keys = ("account_id", "security_id", "quantity", "date")
+    else:
+        keys = ("entry_id", "quantity", "date")
+    return any(getattr(old, k) != getattr(new, k) for k in keys)
+
+
+def utils_shift_account(account, from_date, delta):
+    """
+    Add `delta` ({'balance', 'fee', 'tax', 'principal'}) to every
+    AccountBalance row of `account` on or after `from_date` with one UPDATE.
+
+    Returns the number of rows shifted, or None when the stored series does
+    not cover `from_date` and has to be replayed instead.
+    """
+    if not AccountBalance.objects.filter(account=account, date=from_date).exists():
+        # Change-point storage: chép trạng thái trước đó sang `from_date`
+        prev = (
+            AccountBalance.objects.filter(account=account, date__lt=from_date)
+            .order_by("-date")
+            .first()
         )
+        reaches = AccountBalance.objects.filter(account=account, date__gt=from_date).exists()
+        if settings.ACCOUNT_BALANCE_STORAGE != "changes" or prev is None or not reaches:
+            return None
+        prev.pk = None
+        prev.date = from_date
+        prev.save()
+
+    return AccountBalance.objects.filter(account=account, date__gte=from_date).update(
+        **{field: F(field) + delta[field] for field in LEDGER_FIELDS}
+    )
 
-        current += timedelta(days=1)
 
+def utils_sync_ledger_change(old, new, replay=None):
+    """
+    Propagate the change of a Transaction / TradeEntry / TradeExit into
+    AccountBalance. `old` is a copy taken before the edit and `new` the saved
+    object; either is None for a create / delete.
+
+    Cash-only changes (amounts, prices, fees, taxes) shift the later rows in
+    place; a full replay only runs when a position quantity or date moved.
+    `replay(account, start_date)` performs those replays (default:
+    `utils_update_account`, the write APIs queue a RecalcJob instead).
+
+    Callers saving the ledger row should do it inside
+    `utils_lock_accounts(old, new)` so the save and the shift are atomic
+    with respect to a running replay.
+    """
+    with utils_defer_portfolio_sync(), utils_lock_accounts(old, new):
+        _sync_ledger_change(old, new, replay or utils_update_account)
+
+
+def _sync_ledger_change(old, new, replay):
+    changes = [(obj, sign) for obj, sign in ((old, -1), (new, 1)) if obj is not None]
+
+    if utils_ledger_touches_float(old, new):
+        starts = {}
+        for obj, _ in changes:
+            account = _ledger_account(obj)
+            starts[account] = min(obj.date, starts.get(account, obj.date))
+        for account, start_date in starts.items():
+            replay(account, start_date)
+        return
+
+    # Gom các delta theo (account, date)
+    deltas = defaultdict(lambda: dict.fromkeys(LEDGER_FIELDS, Decimal("0")))
+    accounts = {}
+    for obj, sign in changes:
+        account = _ledger_account(obj)
+        accounts[account.pk] = account
+        delta = deltas[(account.pk, obj.date)]
+        for field, value in utils_ledger_effect(obj).items():
+            delta[field] += sign * value
+
+    replayed = set()
+    for (account_id, from_date), delta in sorted(deltas.items(), key=lambda kv: kv[0][1]):
+        if account_id in replayed or not any(delta.values()):
+            continue
+        account = accounts[account_id]
+        if utils_shift_account(account, from_date, delta) is None:
+            # Replay từ ngày sớm nhất đã bao gồm các delta phía sau
+            replay(account, from_date)
+            replayed.add(account_id)
+            continue
+        # UPDATE không bắn post_save → tự đồng bộ portfolio
+        utils_schedule_portfolio_sync(account.user_id, from_date)
 
 
 # ---------------------------------------------------------------------- #
 #  🔧  HÀM PHỤ: tính equity-float cho một ngày cụ thể
 # ---------------------------------------------------------------------- #
 def utils_calc_float_equity(account, on_date):
-    entries = TradeEntry.objects.filter(account=account)
-    holdings = defaultdict(Decimal)
-
-    for entry in entries:
-        remain = entry.remaining_quantity_at(until_date=on_date)
-        if remain > 0:
-            holdings[entry.security_id] += remain
-
+    holdings = PositionTimeline.for_account(account).holdings_on(on_date)
     if not holdings:
         return Decimal("0")
 
-    equity = Decimal("0")
-    securities = Security.objects.in_bulk(holdings.keys())  # tránh N+1
+    prices = PriceSeries.for_securities(holdings.keys())  # tránh N+1
+    return utils_float_equity(holdings, prices, on_date)
+
 
+def utils_float_equity(holdings, prices, on_date):
+    """
+    Mark `holdings` ({security_id: quantity}) to market on `on_date` using
+    `prices` ({security_id: PriceSeries}).
+    """
+    equity = Decimal("0")
     for sec_id, qty in holdings.items():
-        security = securities.get(sec_id)
-        if not security:
+        series = prices.get(sec_id)
+        if not series or qty <= 0:
             continue
-        price = security.price_on(on_date)
+        price = series.price_on(on_date)
         if price:
             equity += qty * price
 
@@ -148,157 +453,340 @@ def utils_calc_float_equity(account, on_date):
 
 
 
-def utils_fetch_security_prices_eodhd(user, security_code, period_days=90, start_date=None):
+def utils_update_security_prices_for_user(user, deadline=None):
     """
-    Trả về list dict {'date', 'open', 'high', 'low', 'close', 'adjusted_close', 'volume'}
-    cho security_code, tối đa 90 ngày gần nhất (free plan), giống utils_fetch_security_prices_yahoo.
-    Nếu có start_date thì sẽ lọc lại sau khi fetch.
+    Refresh the shared price series of every instrument held by `user`
+    (see `utils_refresh_instruments`). Returns the per-instrument report.
     """
-    user_api, _ = UserAPIKey.objects.get_or_create(user=user)
+    instruments = list(Instrument.objects.filter(securities__user=user).distinct())
+    return utils_refresh_instruments(instruments, keys=provider_keys(user), deadline=deadline, label=user.username)
+
 
-    key_eodhd = user_api.key_eodhd
+def utils_user_instruments(user):
+    """Queryset of the instruments behind `user`'s securities."""
+    return Instrument.objects.filter(pk__in=Security.objects.filter(user=user).values('instrument'))
 
-    if not key_eodhd:
-        print("EODHD API key missing (Setting.key_eodhd).")
-        return []
 
-    url = (
-        f"https://eodhd.com/api/eod/{security_code}"
-        f"?period={period_days}d&api_token={key_eodhd}&fmt=json"
+def utils_stale_instruments(instruments, now=None):
+    """
+    Instruments of the `instruments` queryset missing the bar of the last
+    session closed on their exchange (`last_session_date`), leaving out
+    those already tried within PRICE_STALE_TTL seconds (holiday, provider
+    late...). One query.
+    """
+    now = now or timezone.now()
+    recent = now - timedelta(seconds=settings.PRICE_STALE_TTL)
+    candidates = (
+        instruments
+        .filter(Q(checked_at__isnull=True) | Q(checked_at__lte=recent))
+        .annotate(latest=Max('prices__date'))
     )
+    return [
+        instrument for instrument in candidates
+        if instrument.latest is None or instrument.latest < last_session_date(instrument.exchange, now)
+    ]
 
-    try:
-        r = requests.get(url, timeout=10, verify=False)
-        r.raise_for_status()
-        raw = r.json()
-    except Exception as exc:
-        print(f"[EODHD] request failed for {security_code}: {exc}")
-        return []
-
-    if not isinstance(raw, list):
-        print(f"[EODHD] bad response for {security_code}: {raw}")
-        return []
-
-    prices = []
-    for row in reversed(raw):  # oldest → newest
-        try:
-            row_date = date.fromisoformat(row["date"])
-            if start_date and row_date < start_date:
-                continue  # bỏ dữ liệu quá cũ
-            prices.append({
-                "date": row_date,
-                "open": Decimal(str(row["open"])),
-                "high": Decimal(str(row["high"])),
-                "low": Decimal(str(row["low"])),
-                "close": Decimal(str(row["close"])),
-                "adjusted_close": Decimal(str(row.get("adjusted_close", row["close"]))),
-                "volume": int(row["volume"]),
-            })
-        except (KeyError, ValueError) as exc:
-            print(f"[EODHD] parse error {security_code} {row}: {exc}")
-
-    return prices
-
-
-def utils_fetch_security_prices_yahoo(security_code, period_days=90, start_date=None):
-    # Xác định range param cho yahoo API
-    # Nếu start_date có, tính từ đó đến hôm nay, else 3 tháng
-    end_date = timezone.now().date()
-    if not start_date:
-        start_date = end_date - timedelta(days=period_days)
-    
-    delta_days = (end_date - start_date).days
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36"
+
+def utils_refresh_stale_prices(instruments=None, deadline=None, label="stale"):
+    """
+    Refresh the stale ones of `instruments` (default: every instrument held
+    by someone). Each instrument is fetched once, with the API keys of its
+    first holder, all within one `deadline`. Returns the merged report.
+    """
+    started = time.monotonic()
+    deadline = settings.PRICE_REFRESH_DEADLINE if deadline is None else deadline
+    if instruments is None:
+        instruments = Instrument.objects.filter(pk__in=Security.objects.values('instrument'))
+
+    stale = utils_stale_instruments(instruments)
+    owners = dict(
+        Security.objects.filter(instrument__in=stale)
+        .values_list('instrument')
+        .annotate(owner=Min('user'))
+    )
+    by_owner = defaultdict(list)
+    for instrument in stale:
+        if instrument.pk in owners:
+            by_owner[owners[instrument.pk]].append(instrument)
+
+    report = []
+    for owner in User.objects.filter(pk__in=by_owner):
+        left = deadline - (time.monotonic() - started)
+        report += utils_refresh_instruments(by_owner[owner.pk], keys=provider_keys(owner), deadline=max(0, left),
+                                            label=label)
+    return report
+
+
+def _weekdays_between(start_date, end_date):
+    """Mon–Fri days in [start_date, end_date)."""
+    return [start_date + timedelta(days=i) for i in range((end_date - start_date).days)
+            if (start_date + timedelta(days=i)).weekday() < 5]
+
+
+def _run_fetches(tasks, providers, started, deadline):
+    """
+    Run `tasks` ({key: (provider name, fn)}) on one thread pool per provider
+    (sized by its `concurrency`) until `deadline` seconds after `started`.
+    `fn(timeout)` gets the time left, capped at 10s.
+    → {key: (result, t0, t1)}; keys still running at the deadline are missing.
+    """
+    def timed(fn):
+        t0 = time.monotonic()
+        # Không request nào được chạy quá deadline chung
+        result = fn(max(0.1, min(10, deadline - (t0 - started))))
+        return result, t0, time.monotonic()
+
+    # Mỗi provider một pool riêng → giới hạn số request song song theo provider
+    pools = {
+        name: ThreadPoolExecutor(providers[name].concurrency, f"prices-{name}")
+        for name in {name for name, _ in tasks.values()}
+    }
+    futures = {key: pools[name].submit(timed, fn) for key, (name, fn) in tasks.items()}
+    futures_wait(futures.values(), timeout=max(0, deadline - (time.monotonic() - started)))
+    for pool in pools.values():
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    return {
+        key: future.result()
+        for key, future in futures.items()
+        if future.done() and not future.cancelled()
     }
-    url = f"https://query1.finance.yahoo.com/v8/finance/chart/{security_code}?range={delta_days}d&interval=1d"
-    try:
-        r = requests.get(url, headers=headers, verify=False, timeout = 10)
-        r.raise_for_status()
-        data = r.json()
-    except Exception as e:
-        print(f"Yahoo fetch error for {security_code}: {e}")
-        return []
 
-    try:
-        timestamps = data['chart']['result'][0]['timestamp']
-        indicators = data['chart']['result'][0]['indicators']['quote'][0]
-    except (KeyError, IndexError):
-        return []
-
-    prices = []
-    for i, ts in enumerate(timestamps):
-        dt = date.fromtimestamp(ts)
-        prices.append({
-            'date': dt,
-            'open': indicators['open'][i] or 0,
-            'high': indicators['high'][i] or 0,
-            'low': indicators['low'][i] or 0,
-            'close': indicators['close'][i] or 0,
-            'volume': indicators['volume'][i] or 0,
-            'adjusted_close': indicators.get('adjclose', [0]*len(timestamps))[i] or 0
-        })
-    return prices
-
-
-def utils_update_security_prices_for_user(user):
-    securities = Security.objects.filter(user=user)
-    for security in securities:
-        latest_price = SecurityPrice.objects.filter(security=security).order_by('-date').first()
-        if latest_price:
-            start_date = latest_price.date + timedelta(days=1)
+
+def utils_refresh_instruments(instruments, keys=None, deadline=None, label="prices"):
+    """
+    Fetch the missing bars of `instruments` and store them in the shared
+    InstrumentPrice table, so each instrument is fetched once however many
+    users hold it. `keys` is {provider name: API key} (see `provider_keys`).
+
+    Instruments a few days behind are grouped by (provider, exchange) and
+    refreshed with one `fetch_latest` request per `batch_size` symbols
+    (EODHD bulk last day, Yahoo spark). Per-symbol `fetch_history` is only
+    used for new instruments, providers without a multi-symbol endpoint and
+    trading days the batch did not cover.
+
+    Requests run in parallel (`concurrency` per provider, keep-alive
+    session) and the whole refresh stops after `deadline` seconds (default
+    `PRICE_REFRESH_DEADLINE`); instruments not fetched by then are reported
+    as 'timeout' and picked up next time.
+    Returns one report dict per instrument: code, provider, status
+    ('ok' / 'empty' / 'timeout' / 'skipped'), via ('batch' / 'history'),
+    bars, latency_ms.
+    """
+    started = time.monotonic()
+    deadline = settings.PRICE_REFRESH_DEADLINE if deadline is None else deadline
+    today = timezone.now().date()
+    keys = keys or {}
+
+    latest = dict(
+        InstrumentPrice.objects.filter(instrument__in=instruments)
+        .values_list('instrument')
+        .annotate(latest=Max('date'))
+    )
+
+    report = {}
+    start_dates = {}
+    providers = {}
+    groups = defaultdict(list)  # (provider, exchange) -> [instrument]
+    history = []
+    for instrument in instruments:
+        start_date = latest[instrument.pk] + timedelta(days=1) if latest.get(instrument.pk) else today - timedelta(days=90)
+        name = instrument.api_source
+        if start_date > today:
+            continue
+        if name not in providers:
+            providers[name] = get_provider(name, keys.get(name))
+        if providers[name] is None:
+            print(f"Unknown api_source '{name}' for {instrument.code}, skipping.")
+            report[instrument.pk] = {'code': instrument.code, 'provider': name, 'status': 'skipped',
+                                     'via': None, 'bars': 0, 'latency_ms': 0}
+            continue
+        start_dates[instrument.pk] = start_date
+        if (latest.get(instrument.pk) and providers[name].batch_size > 1
+                and (today - start_date).days < settings.PRICE_BATCH_MAX_GAP_DAYS):
+            groups[name, instrument.exchange].append(instrument)
         else:
-            start_date = timezone.now().date() - timedelta(days=90)
-        print("start date = " + str(start_date))
-        if start_date > timezone.now().date():
+            history.append(instrument)
+
+    def entry(instrument, status='timeout', via='batch'):
+        report[instrument.pk] = {'code': instrument.code, 'provider': instrument.api_source, 'status': status,
+                                 'via': via, 'bars': 0, 'latency_ms': None}
+        return report[instrument.pk]
+
+    # 1️⃣ Request gộp theo (provider, exchange)
+    batches = {}
+    for (name, exchange), members in groups.items():
+        provider = providers[name]
+        for i in range(0, len(members), provider.batch_size):
+            chunk = members[i:i + provider.batch_size]
+            fn = lambda timeout, provider=provider, exchange=exchange, codes=[m.code for m in chunk]: \
+                provider.fetch_latest(codes, exchange, range_days=settings.PRICE_BATCH_MAX_GAP_DAYS, timeout=timeout)
+            batches[name, exchange, i] = (name, fn, chunk)
+
+    bars = {}
+    results = _run_fetches({key: (name, fn) for key, (name, fn, _) in batches.items()}, providers, started, deadline)
+    for key, (name, fn, chunk) in batches.items():
+        if key not in results:
+            for instrument in chunk:
+                entry(instrument)
             continue
 
-        if security.api_source == 'eodhd':
-            symbol = f"{security.code}.{security.exchange}"
-            prices = utils_fetch_security_prices_eodhd(user, symbol, start_date=start_date)
-            if not prices:
+        prices, t0, t1 = results[key]
+        for instrument in chunk:
+            start_date = start_dates[instrument.pk]
+            got = prices.get(instrument.code)
+            dates = {bar['date'] for bar in got or []}
+            # Thiếu ngày giao dịch giữa start_date và bar mới nhất → lấy history từng mã
+            if got is None or any(d not in dates for d in _weekdays_between(start_date, max(dates, default=start_date))):
+                history.append(instrument)
                 continue
+            new = [bar for bar in got if bar['date'] >= start_date]
+            row = entry(instrument, 'ok' if new else 'empty')
+            row.update(bars=len(new), latency_ms=round((t1 - t0) * 1000))
+            if new:
+                bars[instrument.pk] = new
+
+    # 2️⃣ History từng mã cho mã mới / còn thiếu ngày
+    tasks = {}
+    for instrument in history:
+        provider = providers[instrument.api_source]
+        fn = lambda timeout, provider=provider, instrument=instrument: provider.fetch_history(
+            instrument.code, instrument.exchange, start_dates[instrument.pk], timeout=timeout)
+        tasks[instrument.pk] = (instrument.api_source, fn)
+
+    results = _run_fetches(tasks, providers, started, deadline)
+    for instrument in history:
+        row = entry(instrument, via='history')
+        if instrument.pk not in results:
+            continue
 
-            for p in prices:
-                SecurityPrice.objects.update_or_create(
-                    security=security,
-                    date=p['date'],
-                    defaults={
-                        'open': p['open'],
-                        'high': p['high'],
-                        'low': p['low'],
-                        'close': p['close'],
-                        'adjusted_close': p['adjusted_close'],
-                        'volume': p['volume'],
-                    }
-                )
-            print(f"Updated prices from EODHD for {security.code} from {start_date} to {timezone.now().date()}")
+        prices, t0, t1 = results[instrument.pk]
+        row.update(bars=len(prices), latency_ms=round((t1 - t0) * 1000))
+        if not prices:
+            # request bị cắt bởi deadline chung
+            row['status'] = 'timeout' if t1 - started >= deadline else 'empty'
             continue
+        row['status'] = 'ok'
+        bars[instrument.pk] = prices
+
+    # Ghi DB ở thread chính, tất cả bars trong một lần upsert
+    fx_updated = False
+    for instrument in instruments:
+        if instrument.pk in bars:
+            print(f"Updated prices from {instrument.api_source} for {instrument.code} "
+                  f"from {start_dates[instrument.pk]} to {today}")
+            fx_updated |= utils_is_fx_symbol(instrument.code)
+    utils_store_prices(bars)
+    # đã hỏi provider → không hỏi lại trong PRICE_STALE_TTL (kể cả khi chưa có bar mới)
+    checked = [pk for pk, row in report.items() if row['status'] in ('ok', 'empty')]
+    Instrument.objects.filter(pk__in=checked).update(checked_at=timezone.now())
+
+    # Giá FX mới → bảng tỷ giá cache phải load lại
+    if fx_updated:
+        FxRateMatrix.invalidate()
+
+    counts = defaultdict(int)
+    for row in report.values():
+        counts[row['status']] += 1
+    print(f"[PRICES] {label}: {dict(counts)} in {time.monotonic() - started:.2f}s, "
+          f"{len(batches)} batch + {len(tasks)} history requests")
+    return list(report.values())
+
 
+PRICE_FIELDS = ['open', 'high', 'low', 'close', 'adjusted_close', 'volume']
+PRICE_COPY_THRESHOLD = 20000  # từ bao nhiêu dòng thì dùng COPY (PostgreSQL)
 
-        elif security.api_source == 'yahoo' or not security.api_source:
-            prices = utils_fetch_security_prices_yahoo(security.code, start_date=start_date)
-            if not prices:
+
+def _to_decimal(value):
+    if value is None or isinstance(value, Decimal):
+        return value
+    return Decimal(str(value))
+
+
+def utils_normalize_bars(bars):
+    """
+    {instrument_id: [bar dict]} → [(instrument_id, date, open, high, low, close,
+    adjusted_close, volume)] with prices as Decimal. Bars without a date are
+    dropped; a date repeated for one security keeps the last bar.
+    """
+    rows = {}
+    for instrument_id, items in bars.items():
+        for bar in items:
+            bar_date = bar.get('date')
+            if bar_date is None:
                 continue
+            close = _to_decimal(bar.get('close'))
+            rows[instrument_id, bar_date] = (
+                instrument_id,
+                bar_date,
+                _to_decimal(bar.get('open')),
+                _to_decimal(bar.get('high')),
+                _to_decimal(bar.get('low')),
+                close,
+                _to_decimal(bar['adjusted_close']) if 'adjusted_close' in bar else close,
+                None if bar.get('volume') is None else int(bar['volume']),
+            )
+    return list(rows.values())
+
+
+def utils_store_prices(bars, batch_size=5000):
+    """
+    Upsert daily bars of one or many instruments: `bars` is
+    {instrument_id: [{'date', 'open', 'high', 'low', 'close', 'adjusted_close', 'volume'}]}.
 
-            for p in prices:
-                SecurityPrice.objects.update_or_create(
-                    security=security,
-                    date=p['date'],
-                    defaults={
-                        'open': p['open'],
-                        'high': p['high'],
-                        'low': p['low'],
-                        'close': p['close'],
-                        'adjusted_close': p['adjusted_close'],
-                        'volume': p['volume'],
-                    }
-                )
-            print(f"Updated prices for {security.code} from {start_date} to {timezone.now().date()}")
+    Rows are written with bulk INSERT ... ON CONFLICT (instrument, date) DO
+    UPDATE; large loads on PostgreSQL go through COPY into a temp table and
+    one merge. Returns the number of rows written.
+    """
+    rows = utils_normalize_bars(bars)
+    if not rows:
+        return 0
+
+    columns = ['instrument_id', 'date'] + PRICE_FIELDS
+    with db_transaction.atomic():
+        if db_connection.vendor == 'postgresql' and len(rows) >= PRICE_COPY_THRESHOLD:
+            _copy_prices(columns, rows)
         else:
-            print(f"Unknown api_source '{security.api_source}' for {security.code}, skipping.")
+            InstrumentPrice.objects.bulk_create(
+                [InstrumentPrice(**dict(zip(columns, row))) for row in rows],
+                batch_size=batch_size,
+                update_conflicts=True,
+                unique_fields=['instrument', 'date'],
+                update_fields=PRICE_FIELDS,
+            )
+    return len(rows)
+
+
+def _copy_prices(columns, rows):
+    """COPY → bảng tạm → merge vào InstrumentPrice bằng một câu INSERT ... ON CONFLICT."""
+    table = InstrumentPrice._meta.db_table
+
+    buf = io.StringIO()
+    csv.writer(buf).writerows(['' if v is None else v for v in row] for row in rows)
+    buf.seek(0)
+
+    cols = ", ".join(columns)
+    updates = ", ".join(f"{c} = EXCLUDED.{c}" for c in PRICE_FIELDS)
+    with db_connection.cursor() as cursor:
+        # Chỉ các cột được COPY (không có `id` NOT NULL của bảng chính)
+        cursor.execute(
+            f"CREATE TEMP TABLE instrumentprice_stage ON COMMIT DROP "
+            f"AS SELECT {cols} FROM {table} WITH NO DATA"
+        )
+        cursor.cursor.copy_expert(f"COPY instrumentprice_stage ({cols}) FROM STDIN WITH (FORMAT csv)", buf)
+        cursor.execute(
+            f"INSERT INTO {table} ({cols}) SELECT {cols} FROM instrumentprice_stage "
+            f"ON CONFLICT (instrument_id, date) DO UPDATE SET {updates}"
+        )
+        # Drop ngay: lần load sau trong cùng transaction ngoài tạo lại được
+        cursor.execute("DROP TABLE instrumentprice_stage")
+
 
 # ---- helper -------------------------------------------------------------
+def utils_is_fx_symbol(code: str) -> bool:
+    return code.upper().endswith("=X")
+
+
 def utils_format_currency_pair(source: str, target: str) -> str:
     source = source.upper()
     target = target.upper()
@@ -307,100 +795,399 @@ def utils_format_currency_pair(source: str, target: str) -> str:
 
 
 def utils_convert_currency(source: str, target: str, as_of: date) -> Decimal:
-    source = source.upper()
-    target = target.upper()
+    """Rate to convert `source` into `target` on `as_of` (see FxRateMatrix)."""
+    return FxRateMatrix.current().rate(source, target, as_of)
 
-    if source == target:
-        return Decimal("1")
-
-    if target == "USD":
-        reverse_symbol = utils_format_currency_pair("USD", source)
-        security = Security.objects.filter(code=reverse_symbol).first()
-        if security:
-            quote = security.price_on(as_of)
-            if quote and quote != 0:
-                return Decimal("1") / quote
-            print(f"[DEBUG] No price found for {reverse_symbol} at {as_of}")
-        else:
-            print(f"[DEBUG] reverse_symbol {reverse_symbol} does not exist")
-
-    symbol = utils_format_currency_pair(source, target)
-    security = Security.objects.filter(code=symbol).first()
-    if not security:
-        return Decimal("1")
-
-    quote = security.price_on(as_of)
-    return quote if quote else Decimal("1")
 
+def utils_build_portfolio(user, start_date, end_date=None):
+    """
+    Compute PortfolioPerformance of `user` for every day in
+    [start_date, end_date] (default: today) in one pass and write it with a
+    single bulk upsert.
 
-def utils_recalc_portfolio(user, day):
-    """Aggregate all account balances for `user` on `day` → USD totals."""
+    Balances come from `utils_iter_balances`, transactions are summed per
+    (date, currency) in the database and both are converted through the
+    shared FxRateMatrix. Returns the number of rows written.
+    """
+    end_date = end_date or timezone.now().date()
     try:
         target_currency = UserPreference.objects.get(user=user).currency.code
     except UserPreference.DoesNotExist:
         # fallback nếu user chưa có thiết lập
         target_currency = "USD"
-    print(f"[INFO] target currency {target_currency}") 
-    
-    # Kiểm tra nếu balance của mỗi account chưa được update đến ngày `day`, thì gọi update
-    accounts = Account.objects.filter(user=user)
+
+    # Account nào chưa có balance tới `end_date` thì update trước
+    accounts = list(Account.objects.filter(user=user).select_related('currency'))
+    latest = dict(
+        AccountBalance.objects.filter(account__in=accounts)
+        .values_list('account')
+        .annotate(latest=Max('date'))
+    )
     for account in accounts:
-        latest_balance = (
-            AccountBalance.objects
-            .filter(account=account)
-            .aggregate(latest=Max('date'))['latest']
-        )
-        if latest_balance is None or latest_balance < day:
-            utils_update_account(account)
+        if latest.get(account.pk) is None or latest[account.pk] < end_date:
+            start_date = min(start_date, latest.get(account.pk) or end_date)
+            utils_update_account(account, sync_portfolio=False)
+
+    print(f"↻ Recalculating portfolio for {user.username} from {start_date} to {end_date} ({target_currency})")
+
+    currencies = {account.pk: account.currency.code for account in accounts}
+    fx = FxRateMatrix.current()
+
+    # Transaction: gom theo (ngày, currency) ngay trong DB
+    money_in = ['deposit', 'transfer_in', 'dividien', 'interest']
+    money_out = ['withdrawal', 'transfer_out', 'fee']
+    tx_rows = (
+        Transaction.objects
+        .filter(account__user=user, date__gte=start_date, date__lte=end_date)
+        .values('date', 'account__currency__code')
+        .annotate(net=Sum(Case(
+            When(type__in=money_in, then=F('amount') - F('fee') - F('tax')),
+            When(type__in=money_out, then=-(F('amount') + F('fee') + F('tax'))),
+            default=Value(Decimal('0')),
+            output_field=DecimalField(max_digits=16, decimal_places=6),
+        )))
+    )
+    daily_tx = defaultdict(lambda: Decimal('0'))
+    for row in tx_rows:
+        daily_tx[row['date']] += row['net'] * fx.rate(row['account__currency__code'], target_currency, row['date'])
+
+    rows = []
+    for day, balances in utils_iter_balances(accounts, start_date, end_date):
+        totals = dict.fromkeys(('principal', 'balance', 'float', 'fee', 'tax'), Decimal('0'))
+        for account_id, bal in balances.items():
+            rate = fx.rate(currencies[account_id], target_currency, day)
+            for field in totals:
+                totals[field] += (getattr(bal, field) or 0) * rate
+
+        rows.append(PortfolioPerformance(user=user, date=day, transaction=daily_tx[day], **totals))
+
+    PortfolioPerformance.objects.bulk_create(
+        rows,
+        batch_size=1000,
+        update_conflicts=True,
+        unique_fields=['user', 'date'],
+        update_fields=['principal', 'balance', 'float', 'fee', 'tax', 'transaction'],
+    )
+    utils_bump_data_version(user.id, start_date)
+    return len(rows)
+
+
+def utils_recalc_portfolio(user, day):
+    """Aggregate all account balances for `user` on `day` → totals in the user's currency."""
+    return utils_build_portfolio(user, day, day)
+
+
+def utils_recalc_from(user, start_date):
+    return utils_build_portfolio(user, start_date)
+
+
+# ---------------------------------------------------------------------- #
+#  ⏳  Gom các yêu cầu đồng bộ portfolio → 1 lần build / user
+# ---------------------------------------------------------------------- #
+_portfolio_sync = threading.local()
+
+
+def _pending_portfolio_sync():
+    if not hasattr(_portfolio_sync, "pending"):
+        _portfolio_sync.pending = {}
+        _portfolio_sync.depth = 0
+        _portfolio_sync.queued = False
+    return _portfolio_sync.pending
 
 
-    qs = (
-        AccountBalance.objects
-        .select_related('account')
-        .filter(account__user=user, date=day)
+def utils_schedule_portfolio_sync(user_id, from_date):
+    """
+    Ask for the portfolio of `user_id` to be recomputed from `from_date`.
+
+    Requests are merged per user (earliest date wins). Inside
+    `utils_defer_portfolio_sync()` they run when the scope exits, inside an
+    atomic block when it commits, otherwise right away.
+    """
+    pending = _pending_portfolio_sync()
+    if _portfolio_sync.queued and not _flush_registered():
+        # Transaction trước đã rollback (callback bị bỏ) → bỏ luôn các sync của nó
+        pending.clear()
+        _portfolio_sync.queued = False
+    pending[user_id] = min(from_date, pending.get(user_id, from_date))
+
+    if not _portfolio_sync.depth:
+        _run_portfolio_sync()
+
+
+@contextmanager
+def utils_defer_portfolio_sync():
+    """
+    Collect portfolio sync requests and run one ranged build per user at the
+    end. If the block raises, its requests are dropped with its writes.
+    """
+    _pending_portfolio_sync()
+    _portfolio_sync.depth += 1
+    failed = True
+    try:
+        yield
+        failed = False
+    finally:
+        _portfolio_sync.depth -= 1
+        if not _portfolio_sync.depth:
+            if failed:
+                _portfolio_sync.pending = {}  # không rò sang request sau trên cùng thread
+            else:
+                _run_portfolio_sync()
+
+
+@contextmanager
+def _muted_portfolio_sync(user_id):
+    """Drop the syncs of `user_id` scheduled inside the block (the caller rebuilds it)."""
+    before = _pending_portfolio_sync().get(user_id)
+    _portfolio_sync.depth += 1
+    try:
+        yield
+    finally:
+        _portfolio_sync.depth -= 1
+        if before is None:
+            _portfolio_sync.pending.pop(user_id, None)
+        else:
+            _portfolio_sync.pending[user_id] = before
+        if not _portfolio_sync.depth:
+            _run_portfolio_sync()
+
+
+def _run_portfolio_sync():
+    """Flush the pending syncs now, or once when the current transaction commits."""
+    if not _portfolio_sync.pending:
+        return
+    if not db_connection.in_atomic_block:
+        _flush_portfolio_sync()
+    elif not (_portfolio_sync.queued and _flush_registered()):
+        # Một callback / transaction
+        _portfolio_sync.queued = True
+        db_transaction.on_commit(_flush_portfolio_sync)
+
+
+def _flush_registered():
+    return db_connection.in_atomic_block and any(
+        func is _flush_portfolio_sync for _, func, _ in db_connection.run_on_commit
     )
 
-    totals = {
-        'principal': Decimal('0'),
-        'balance'  : Decimal('0'),
-        'float'    : Decimal('0'),
-        'fee'      : Decimal('0'),
-        'tax'      : Decimal('0'),
-    }
 
-    for bal in qs:
-        print(f"[INFO] Account Balance currency {bal.account.currency.code}")
-        fx = utils_convert_currency(bal.account.currency.code, target_currency, bal.date)
-        print (f"convert fx = {fx}")
-        totals['principal'] += (bal.principal or 0) * fx
-        totals['balance']   += (bal.balance   or 0) * fx
-        totals['float']     += (bal.float     or 0) * fx
-        totals['fee']       += (bal.fee       or 0) * fx
-        totals['tax']       += (bal.tax       or 0) * fx
-
-    # Tính transaction trong ngày đó
-    txs = Transaction.objects.filter(account__user=user, date=day)
-    total_tx = Decimal('0')
-    for tx in txs:
-        fx = utils_convert_currency(tx.account.currency.code, target_currency, tx.date)
-        total_tx += tx.net_amount * fx
-
-    totals['transaction'] = total_tx
-
-    PortfolioPerformance.objects.update_or_create(
-        user=user,
-        date=day,
-        defaults=totals,
+def _flush_portfolio_sync():
+    pending = _pending_portfolio_sync()
+    _portfolio_sync.queued = False
+    if not pending:
+        return
+    _portfolio_sync.pending = {}
+
+    users = User.objects.in_bulk(pending.keys())
+    for user_id, from_date in pending.items():
+        if user_id in users:
+            utils_build_portfolio(users[user_id], from_date)
+
+
+# ---------------------------------------------------------------------- #
+#  📉  Gom chart theo tuần / tháng trong DB
+# ---------------------------------------------------------------------- #
+CHART_INTERVALS = {'day': None, 'week': TruncWeek, 'month': TruncMonth}
+
+
+def utils_filter_dates(queryset, start_date=None, end_date=None):
+    if start_date:
+        queryset = queryset.filter(date__gte=start_date)
+    if end_date:
+        queryset = queryset.filter(date__lte=end_date)
+    return queryset
+
+
+def utils_period_ends(queryset, interval, **aggregates):
+    """
+    Roll `queryset` (rows with a `date`) up to `interval` ('week' / 'month')
+    in one GROUP BY query → {last date of each period: {aggregate: value}}.
+
+    Rows on those dates carry the end-of-period values (equity, principal);
+    `aggregates` (e.g. transaction=Sum('transaction')) cover the whole period.
+    """
+    rows = (
+        queryset.order_by()
+        .annotate(period=CHART_INTERVALS[interval]('date'))
+        .values('period')
+        .annotate(last=Max('date'), **aggregates)
     )
+    return {row.pop('last'): row for row in rows}
 
 
-def utils_recalc_from(user, start_date):
-    today = timezone.now().date()
-    current = start_date
-    while current <= today:
-        print(f"↻ Recalculating portfolio for {user.username} on {current}")
-        utils_recalc_portfolio(user, current)
-        current += timedelta(days=1)
+def utils_period_start(day, interval):
+    """First day of the `interval` period (Monday / 1st of the month) containing `day`."""
+    if interval == 'week':
+        return day - timedelta(days=day.weekday())
+    if interval == 'month':
+        return day.replace(day=1)
+    return day
+
+
+def utils_pivot_holdings(rows, target_currency, fx):
+    """
+    Pivot (date, code, currency, equity) rows ordered by date straight into
+    chart columns → (labels [date], {code: array of floats per label}).
+    One pass over the cursor; each (currency, date) FX rate is looked up once.
+    """
+    labels = []
+    datasets = {}
+    rates = {}
+    for day, code, currency, equity in rows:
+        if not labels or labels[-1] != day:
+            labels.append(day)
+        equity = float(equity)
+        if currency != target_currency:
+            rate = rates.get((currency, day))
+            if rate is None:
+                rate = rates[currency, day] = float(fx.rate(currency, target_currency, day))
+            equity *= rate
+        values = datasets.get(code)
+        if values is None:
+            values = datasets[code] = array('d')
+        # Ngày mã không có dòng → 0; trùng mã trong cùng ngày → dòng sau ghi đè
+        if len(values) == len(labels):
+            values[-1] = equity
+            continue
+        values.extend(repeat(0.0, len(labels) - 1 - len(values)))
+        values.append(equity)
+    for values in datasets.values():
+        values.extend(repeat(0.0, len(labels) - len(values)))
+    return labels, datasets
+
+
+def _lttb(xs, ys, max_points):
+    """Largest-Triangle-Three-Buckets: indexes of `max_points` points keeping the shape of (xs, ys)."""
+    n = len(ys)
+    every = (n - 2) / (max_points - 2)
+    # Tổng cộng dồn → trung bình bucket kế tiếp trong O(1)
+    sum_x = list(accumulate(xs, initial=0))
+    sum_y = list(accumulate(ys, initial=0))
+
+    selected = [0]
+    a = 0
+    for i in range(max_points - 2):
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, n)
+        avg_x = (sum_x[next_end] - sum_x[end]) / (next_end - end)
+        avg_y = (sum_y[next_end] - sum_y[end]) / (next_end - end)
+
+        ax, ay = xs[a], ys[a]
+        a = max(range(start, end),
+                key=lambda j: abs((ax - avg_x) * (ys[j] - ay) - (ax - xs[j]) * (avg_y - ay)))
+        selected.append(a)
+    selected.append(n - 1)
+    return selected
+
+
+def utils_downsample(xs, ys, max_points):
+    """
+    Indexes of at most `max_points` points of the (xs, ys) curve, chosen by
+    LTTB. The highest and lowest points and the peak / trough of the
+    deepest drawdown are always kept. All indexes if the curve is short.
+    """
+    n = len(ys)
+    if not max_points or n <= max_points:
+        return list(range(n))
+
+    peak = trough = dd_peak = 0
+    for i, y in enumerate(ys):
+        if y > ys[peak]:
+            peak = i
+        if ys[peak] - y > ys[dd_peak] - ys[trough]:
+            dd_peak, trough = peak, i
+    must = {peak, ys.index(min(ys)), dd_peak, trough}  # peak lúc này = điểm cao nhất
+
+    if max_points - len(must) < 3:
+        return _lttb(xs, ys, max(max_points, 3))
+    return sorted(set(_lttb(xs, ys, max_points - len(must))) | must)
+
+
+# ---------------------------------------------------------------------- #
+#  🔖  Version dữ liệu của user → key cache của chart
+# ---------------------------------------------------------------------- #
+def _data_version_key(user_id):
+    return f"data_version_{user_id}"
+
+
+def utils_data_version(user_id):
+    """Current version of `user_id`'s chart data (balances, holdings, preferences)."""
+    # Bắt đầu từ thời điểm hiện tại (µs) chứ không từ 1: key bị evict rồi tạo
+    # lại cũng không trùng version cũ → không đọc lại chart cũ
+    return shared_version(_data_version_key(user_id))
+
+
+def _data_changes_key(user_id):
+    return f"data_changes_{user_id}"
+
+
+DATA_CHANGES_KEPT = 20  # số version gần nhất còn biết được ngày thay đổi
+
+
+def utils_bump_data_version(user_id, from_date=None):
+    """
+    New data version for `user_id` once the current transaction commits (so
+    no reader caches pre-commit data under the new version).
+
+    `from_date`: first chart date the write changed, logged with the new
+    version so `utils_chart_changes` can send clients only the points from
+    there on; None = everything may have changed (names, currency...).
+    """
+    def bump():
+        version = bump_shared_version(_data_version_key(user_id))
+        if version is None:  # chưa có hoặc đã bị evict → không còn biết version cũ đổi gì
+            return
+        changes = cache.get(_data_changes_key(user_id)) or []
+        changes = changes[-(DATA_CHANGES_KEPT - 1):] + [(version, from_date)]
+        cache.set(_data_changes_key(user_id), changes, timeout=None)
+
+    db_transaction.on_commit(bump)
+
+
+def _chart_token(data_version, fx_version=None):
+    return str(data_version) if fx_version is None else f"{data_version}.{fx_version}"
+
+
+def utils_chart_changes(user_id, token, fx=True):
+    """
+    Compare a client's chart version `token` with the current one →
+    (current token, first changed date): `date.max` when nothing changed,
+    None when the client must reload everything (unknown / too old token,
+    FX rates changed, or a change without a date).
+    """
+    versions = cache.get_many([_data_version_key(user_id), _data_changes_key(user_id), FxRateMatrix.VERSION_KEY])
+    data_version = versions.get(_data_version_key(user_id)) or utils_data_version(user_id)
+    fx_version = (versions.get(FxRateMatrix.VERSION_KEY) or shared_version(FxRateMatrix.VERSION_KEY)) if fx else None
+    current = _chart_token(data_version, fx_version)
+    if token == current:
+        return current, date.max
+
+    try:
+        client_data, _, client_fx = token.partition(".")
+        client_data = int(client_data)
+    except (AttributeError, ValueError):
+        return current, None
+    if fx and client_fx != str(fx_version):
+        return current, None
+
+    # Cần đủ mọi version client → hiện tại trong log, và mỗi lần đều có ngày
+    changes = dict(versions.get(_data_changes_key(user_id)) or [])
+    missed = range(client_data + 1, data_version + 1)
+    if not missed or len(missed) > len(changes) or any(changes.get(v) is None for v in missed):
+        return current, None
+    return current, min(changes[v] for v in missed)
+
+
+def utils_chart_cache_key(name, user_id, fx=True):
+    """
+    Cache key of a chart of `user_id`: changes with its data version and
+    (`fx`) the FX rates.
+    """
+    versions = cache.get_many([FxRateMatrix.VERSION_KEY, _data_version_key(user_id)])  # 1 round trip
+    data_version = versions.get(_data_version_key(user_id)) or utils_data_version(user_id)
+    fx_version = (versions.get(FxRateMatrix.VERSION_KEY) or shared_version(FxRateMatrix.VERSION_KEY)) if fx else '-'
+    return f"{name}_{user_id}_v{data_version}_fx{fx_version}"
+
 
 def utils_calculate_drawdown(entries):  # entries: list of PortfolioPerformance ordered by date
     peak = Decimal('1.0')
@@ -492,45 +1279,57 @@ def utils_calculate_twrr(entries):
 
     return twrr
 
-def utils_recalc_daily_holdings(user: User, security: Security, from_date: date):
-
-    DailyHoldingEquity.objects.filter(
-        user=user,
-        security=security,
-        date__gte=from_date
-    ).delete()
-
+def utils_recalc_daily_holdings(user: User, security: Security, from_date: date, progress=None):
+    """
+    Rebuild DailyHoldingEquity of (`user`, `security`) from `from_date` to
+    today. Entries, exits and prices are loaded once; the daily
+    quantity × price series is computed in memory and written with a single
+    bulk_create. `progress(done, total)` is called for every day. Returns
+    the number of rows written.
+    """
     today = date.today()
-    current_date = from_date
+    entries = TradeEntry.objects.filter(account__user=user, security=security)
 
-    while current_date <= today:
-        qty = 0
-        entries = TradeEntry.objects.filter(
-            account__user=user,
-            security=security,
-            date__lte=current_date
-        )
-        for entry in entries:
-            qty += entry.remaining_quantity_at(current_date)
+    timeline = PositionTimeline.from_entries(entries)
+    prices = PriceSeries.for_security(security)
 
+    # Currency = account của entry gần nhất tính đến ngày đó
+    entry_currencies = list(
+        entries.order_by("date", "id").values_list("date", "account__currency__code")
+    )
+    entry_dates = [d for d, _ in entry_currencies]
+
+    total = (today - from_date).days + 1
+    rows = []
+    for done, (current_date, holdings) in enumerate(timeline.iter_holdings(from_date, today)):
+        if progress:
+            progress(done, total)
+        qty = holdings.get(security.pk, 0)
         if qty == 0:
-            current_date += timedelta(days=1)
             continue
 
-        price = security.price_on(current_date)
+        price = prices.price_on(current_date)
         if not price:
-            current_date += timedelta(days=1)
             continue
 
-        equity = qty * price
-        currency = entries.first().account.currency.code if entries else "USD"
+        i = bisect_right(entry_dates, current_date)
+        currency = (entry_currencies[i - 1][1] if i else None) or "USD"
 
-        DailyHoldingEquity.objects.create(
+        rows.append(DailyHoldingEquity(
             user=user,
             security=security,
             date=current_date,
-            equity=equity,
-            currency=currency
-        )
+            equity=qty * price,
+            currency=currency,
+        ))
+
+    with db_transaction.atomic():
+        DailyHoldingEquity.objects.filter(
+            user=user,
+            security=security,
+            date__gte=from_date
+        ).delete()
+        DailyHoldingEquity.objects.bulk_create(rows, batch_size=1000)
+    utils_bump_data_version(user.id, from_date)
 
-        current_date += timedelta(days=1)
+    return len(rows)
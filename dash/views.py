@@ -7,13 +7,13 @@ from django.contrib.auth.forms import AuthenticationForm
 from django.core.paginator import Paginator
 from django.http import JsonResponse
 
-from .models import Account, Transaction, UserAPIKey, Security, TradeEntry, TradeExit, AccountBalance, SecurityPrice, PortfolioPerformance, UserAPIKey, UserPreference, Currency, Language
+from .models import Account, Transaction, UserAPIKey, Security, TradeEntry, TradeExit, AccountBalance, InstrumentPrice, PortfolioPerformance, UserAPIKey, UserPreference, Currency, Language
 from .forms import AccountForm, TransactionForm, EntryForm, ExitForm
 
 from django.db.models import Prefetch
 from django.db.models import OuterRef, Subquery
 
-from .utils import utils_calculate_drawdown, utils_calculate_twrr, utils_recalc_from, utils_recalc_daily_holdings
+from .utils import utils_calculate_drawdown, utils_calculate_twrr, utils_recalc_from, utils_recalc_daily_holdings, utils_balances_on
 from django.db.models import Min
 
 
@@ -44,13 +44,11 @@ def dash_view(request):
     })
 
 def accounts_view(request):
-    balances_qs = AccountBalance.objects.filter(date__lte=date.today()).order_by('-date')
-    accounts_list = Account.objects.filter(user=request.user).prefetch_related(
-        Prefetch('balances', queryset=balances_qs, to_attr='prefetched_balances')
-    ).order_by('id')
+    accounts_list = Account.objects.filter(user=request.user).order_by('id')
+    balances = utils_balances_on(accounts_list, date.today())
 
     for account in accounts_list:
-        latest = next((b for b in account.prefetched_balances), None)
+        latest = balances.get(account.id)
         account.balance = latest.balance if latest else 0
         account.principal = latest.principal if latest else 0
         account.equity = latest.equity if latest else 0
@@ -132,9 +130,9 @@ def account_edit(request, acc_id):
 
 
 def securities_view(request):
-    # Subquery lấy giá close và date mới nhất cho mỗi security
-    latest_prices = SecurityPrice.objects.filter(
-        security=OuterRef('pk')
+    # Subquery lấy giá close và date mới nhất cho mỗi security (giá dùng chung theo instrument)
+    latest_prices = InstrumentPrice.objects.filter(
+        instrument=OuterRef('instrument')
     ).order_by('-date')
 
     securities_list = Security.objects.filter(user=request.user).annotate(
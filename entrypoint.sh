@@ -2,11 +2,15 @@
 
 set -e
 
-echo "==> Running migrations..."
-python manage.py migrate --noinput
+# Chỉ một service (web) migrate; worker đặt RUN_MIGRATIONS=0
+if [ "${RUN_MIGRATIONS:-1}" = "1" ]; then
+  echo "==> Running migrations..."
+  python manage.py migrate --noinput
+  python manage.py createcachetable
 
-echo "==> Running fill_data..."
-python manage.py fill_data
+  echo "==> Running fill_data..."
+  python manage.py fill_data
+fi
 
 echo "==> Starting server..."
 exec "$@"